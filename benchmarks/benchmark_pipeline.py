@@ -0,0 +1,221 @@
+import argparse
+import gc
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+from binance.helpers import interval_to_milliseconds
+
+from config import default_dataset_directory
+from dataset_utils.data_preprocessing import (apply_hampel_filter, apply_robust_scaler, apply_sg_filter,
+                                              apply_standard_scaler)
+from dataset_utils.dataset_generation import KLINE_COLUMNS, get_kline_dtypes, transform_into_sliding_windows
+from dataset_utils.fake_binance import generate_synthetic_klines
+from dataset_utils.feature_creation import add_class_up
+from dataset_utils.feature_selection import three_step_feature_selection
+from dataset_utils.indicator_bank import BANKS, compute_indicator_bank
+from logger import logger
+from paper_inspired_models.tripathi_and_sharma import add_new_features
+
+DEFAULT_SIZES = [10000, 1000000, 10000000]
+
+# slowdown over the baseline, as a ratio of the wall times, above which a stage is flagged
+DEFAULT_THRESHOLD = 1.25
+
+# 2017-08-17, when the oldest Binance pairs were listed
+SYNTHETIC_START_TIMESTAMP_MILLIS = 1502928000000
+
+# rows of the last part of the dataset turned into copied sliding windows, since copying every window of the largest
+# datasets would not fit in memory
+SLIDING_WINDOWS_MAX_ROWS = 100000
+SLIDING_WINDOW_SIZE = 30
+
+# rows of the last part of the dataset the indicator banks are computed on, and the periods of every bank, since the
+# banks of the largest datasets would not fit in memory either
+INDICATOR_BANK_MAX_ROWS = 100000
+INDICATOR_BANK_PERIODS = range(2, 101)
+
+
+def synthetic_raw_dataset(n_rows, interval='1m', seed=0, high_precision=False):
+    """
+    Generate a deterministic synthetic dataset with the schema of `dataset_generation.download_raw_dataset`.
+
+    Args:
+        n_rows (int): Number of klines.
+        interval (str, optional): Duration of each candlestick. Defaults to '1m'.
+        seed (int, optional): Seed of the synthetic price path. Defaults to 0.
+        high_precision (bool, optional): Whether prices and volumes are float64 instead of float32. Defaults to False.
+
+    Returns:
+        pandas.DataFrame: The klines, with the same columns and data types as the downloaded ones.
+    """
+
+    interval_millis = interval_to_milliseconds(interval)
+    columns = generate_synthetic_klines(SYNTHETIC_START_TIMESTAMP_MILLIS,
+                                        SYNTHETIC_START_TIMESTAMP_MILLIS + n_rows * interval_millis - 1, interval, seed)
+
+    dtypes = get_kline_dtypes(high_precision)
+    return pd.DataFrame({column: columns[column].astype(dtypes[column]) for column in KLINE_COLUMNS})
+
+
+def _labeled_dataset(df):
+    df = df.copy()
+    add_class_up(df, 1, 0.1)
+    df = add_new_features(df)
+    df.dropna(inplace=True)
+    return df
+
+
+def _stages(raw_df):
+    """
+    Get the benchmarked stages, as (name, setup, run) tuples, where setup builds the input of the stage outside of
+    the measurements and run is the measured call.
+    """
+
+    labeled_df = _labeled_dataset(raw_df)
+    windows_df = labeled_df.iloc[-SLIDING_WINDOWS_MAX_ROWS:]
+
+    return [
+        ('add_class_up', raw_df.copy, lambda df: add_class_up(df, 1, 0.1)),
+        ('add_new_features', raw_df.copy, add_new_features),
+        ('compute_indicator_bank', raw_df.iloc[-INDICATOR_BANK_MAX_ROWS:].copy,
+         lambda df: compute_indicator_bank(df, [(family, INDICATOR_BANK_PERIODS) for family in BANKS])),
+        ('apply_hampel_filter', labeled_df.copy, lambda df: apply_hampel_filter(df, 'close')),
+        ('apply_sg_filter', labeled_df.copy, lambda df: apply_sg_filter(df, 'close')),
+        ('apply_standard_scaler', labeled_df.copy, lambda df: apply_standard_scaler(df, exclude_columns=['up'])),
+        ('apply_robust_scaler', labeled_df.copy, lambda df: apply_robust_scaler(df, exclude_columns=['up'])),
+        ('transform_into_sliding_windows', windows_df.copy,
+         lambda df: transform_into_sliding_windows(df, SLIDING_WINDOW_SIZE)),
+        ('transform_into_sliding_windows_view', labeled_df.copy,
+         lambda df: transform_into_sliding_windows(df, SLIDING_WINDOW_SIZE, mode='view')),
+        ('three_step_feature_selection', labeled_df.copy,
+         lambda df: three_step_feature_selection(df, exclude_columns=['up'], boruta_sample_size=2000,
+                                                 boruta_max_iter=10)),
+    ]
+
+
+def _measure(setup, run, repeat):
+    # wall time, as the best of several runs without tracing
+    seconds = []
+    for _ in range(repeat):
+        stage_input = setup()
+        gc.collect()
+        started_at = time.perf_counter()
+        run(stage_input)
+        seconds.append(time.perf_counter() - started_at)
+        del stage_input
+
+    # peak memory allocated by the stage, in a separate traced run, since tracing slows it down
+    stage_input = setup()
+    gc.collect()
+    tracemalloc.start()
+    run(stage_input)
+    _, peak_bytes = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {'seconds': min(seconds), 'peak_bytes': peak_bytes}
+
+
+def run_benchmarks(sizes=None, repeat=3, stage_names=None):
+    """
+    Benchmark every pipeline stage on synthetic datasets of several sizes.
+
+    Args:
+        sizes (list, optional): Numbers of rows of the synthetic datasets. Defaults to DEFAULT_SIZES.
+        repeat (int, optional): Number of timed runs of each stage, of which the fastest is kept. Defaults to 3.
+        stage_names (list, optional): Names of the stages to benchmark. Defaults to every stage.
+
+    Returns:
+        dict: The results, with the environment they were measured in and, for every size and stage, the wall time
+        in seconds and the peak memory allocated in bytes.
+    """
+
+    results = {
+        'timestamp': int(time.time()),
+        'environment': {
+            'python': sys.version.split()[0],
+            'platform': platform.platform(),
+            'numpy': np.__version__,
+            'pandas': pd.__version__,
+        },
+        'sizes': {},
+    }
+
+    for n_rows in sizes or DEFAULT_SIZES:
+        logger.info(f'Benchmarking the pipeline stages on {n_rows} rows')
+
+        size_results = results['sizes'][str(n_rows)] = {}
+        for name, setup, run in _stages(synthetic_raw_dataset(n_rows)):
+            if stage_names is not None and name not in stage_names:
+                continue
+            size_results[name] = _measure(setup, run, repeat)
+            logger.info(f'{name} on {n_rows} rows: {size_results[name]["seconds"]:.4f}s, '
+                        f'{size_results[name]["peak_bytes"] / 2 ** 20:.1f} MiB peak')
+
+    return results
+
+
+def find_regressions(results, baseline, threshold=DEFAULT_THRESHOLD):
+    """
+    Compare benchmark results with a baseline and find the stages that got slower.
+
+    Args:
+        results (dict): Results of `run_benchmarks`.
+        baseline (dict): Results of a previous `run_benchmarks` to compare with.
+        threshold (float, optional): Ratio of the wall times above which a stage is flagged. Defaults to
+            DEFAULT_THRESHOLD.
+
+    Returns:
+        list: (size, stage, ratio) tuples of the stages whose wall time grew above the threshold.
+    """
+
+    regressions = []
+    for n_rows, size_results in results['sizes'].items():
+        for name, stage_results in size_results.items():
+            baseline_results = baseline['sizes'].get(n_rows, {}).get(name)
+            if baseline_results is None or baseline_results['seconds'] == 0:
+                continue
+
+            ratio = stage_results['seconds'] / baseline_results['seconds']
+            if ratio > threshold:
+                regressions.append((n_rows, name, ratio))
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the dataset pipeline stages on synthetic klines.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES, help='numbers of rows')
+    parser.add_argument('--repeat', type=int, default=3, help='timed runs of each stage')
+    parser.add_argument('--stages', nargs='+', help='names of the stages to benchmark (default: all)')
+    parser.add_argument('--output', help='JSON file to write the results to')
+    parser.add_argument('--baseline', help='JSON file of previous results to compare with')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help='slowdown ratio over the baseline that is flagged')
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.sizes, args.repeat, args.stages)
+
+    output_path = args.output or os.path.join(default_dataset_directory, 'benchmarks', f'{results["timestamp"]}.json')
+    os.makedirs(os.path.dirname(output_path) or '.', exist_ok=True)
+    with open(output_path, 'w') as output_file:
+        json.dump(results, output_file, indent=2)
+    logger.info(f'Wrote the benchmark results to {output_path}')
+
+    if args.baseline is not None:
+        with open(args.baseline) as baseline_file:
+            regressions = find_regressions(results, json.load(baseline_file), args.threshold)
+
+        for n_rows, name, ratio in regressions:
+            logger.warning(f'{name} on {n_rows} rows is {ratio:.2f}x slower than the baseline')
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -10,3 +10,8 @@ config.read('config-local.ini')
 api_key = config['binance']['api_key']
 api_secret = config['binance']['api_secret']
 default_dataset_directory = config['training']['default_dataset_directory']
+metrics_enabled = config.getboolean('metrics', 'enabled', fallback=False)
+metrics_export = config.get('metrics', 'export', fallback='log')
+metrics_path = config.get('metrics', 'path', fallback='./datasets/metrics')
+metrics_profile_stage = config.get('metrics', 'profile_stage', fallback='') or None
+metrics_trace_memory = config.getboolean('metrics', 'trace_memory', fallback=False)
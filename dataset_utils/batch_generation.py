@@ -0,0 +1,166 @@
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+import pandas as pd
+
+from dataset_utils.data_preprocessing import PreprocessingPipeline
+from dataset_utils.dataset_generation import download_raw_dataset, split_train_val_test
+from dataset_utils.feature_creation import add_class_up
+from dataset_utils.feature_pipeline import add_features
+from logger import logger
+from metrics import stage
+
+
+@stage()
+def build_datasets(tasks, start_timestamp_millis, end_timestamp_millis, output_directory, feature_specs,
+                   training_size=0.7, validation_size=0.15, pipeline_params=None, store=None, client=None,
+                   max_workers=None):
+    """
+    Build the training, validation and test sets of a grid of (symbol, interval, forecast horizon, forecast gap,
+    trading fee) tasks on a process pool.
+
+    The klines and features of every (symbol, interval) pair are computed only once, in the main process, and placed
+    in shared memory, where the workers read them without any copy being pickled. Each worker then labels the
+    dataset, splits it and fits the preprocessing pipeline of a single task. The features of the next pair are
+    computed while the workers process the tasks of the previous ones.
+
+    The sets of each task are written to `{output_directory}/{symbol}_{interval}_{horizon}_{gap}_{fee}/` as
+    `x_train.npy`, `y_train.npy`, `x_val.npy`, `y_val.npy`, `x_test.npy` and `y_test.npy`, along with the fitted
+    pipeline in `pipeline.npz`.
+
+    Args:
+        tasks (list): (symbol, interval, forecast_horizon, forecast_gap, trading_fee_percentage) tuples.
+        start_timestamp_millis (int): Start of the time range of the klines in Unix timestamp milliseconds.
+        end_timestamp_millis (int): End of the time range of the klines in Unix timestamp milliseconds.
+        output_directory (str): Directory the datasets are written to.
+        feature_specs (list): (indicator, params) pairs, see `feature_pipeline.compute_features`.
+        training_size (float, optional): Percentage of each dataset used for training. Defaults to 0.7.
+        validation_size (float, optional): Percentage of each dataset used for validation. Defaults to 0.15.
+        pipeline_params (dict, optional): Keyword arguments of the PreprocessingPipeline of every task, excluding
+            `exclude_columns`. Defaults to the pipeline defaults.
+        store (dataset_utils.kline_store.KlineStore, optional): Store the klines are read from and downloaded into.
+        client (binance.Client, optional): Client used to download the klines.
+        max_workers (int, optional): Number of worker processes. Defaults to the number of processors.
+
+    Returns:
+        list: For every task, in the order of `tasks`, a dict with its output directory, number of rows and the
+        seconds spent on each step.
+    """
+
+    logger.info(f'Building {len(tasks)} datasets with {max_workers or os.cpu_count()} workers')
+
+    # group the tasks by (symbol, interval), keeping their order
+    pair_tasks = {}
+    for task_index, (symbol, interval, *_) in enumerate(tasks):
+        pair_tasks.setdefault((symbol, interval), []).append(task_index)
+
+    results = [None] * len(tasks)
+    shared_memories = {}
+    pending = {}
+    started_at = time.perf_counter()
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = {}
+        try:
+            for (symbol, interval), task_indices in pair_tasks.items():
+                feature_started_at = time.perf_counter()
+                df = download_raw_dataset(symbol, interval, start_timestamp_millis, end_timestamp_millis, store=store,
+                                          client=client)
+                df = add_features(df, feature_specs)
+                feature_seconds = time.perf_counter() - feature_started_at
+
+                shared_memory, shared_array = _to_shared_memory(df.to_numpy(dtype=np.float64))
+                shared_memories[(symbol, interval)] = shared_memory
+                pending[(symbol, interval)] = len(task_indices)
+                logger.info(f'Computed the features of {symbol} {interval} in {feature_seconds:.2f}s')
+
+                for task_index in task_indices:
+                    future = executor.submit(_build_dataset, shared_memory.name, shared_array.shape,
+                                             df.columns.tolist(), tasks[task_index], output_directory, training_size,
+                                             validation_size, pipeline_params)
+                    futures[future] = task_index
+                    results[task_index] = {'feature_seconds': feature_seconds}
+
+                del shared_array
+
+            for completed, future in enumerate(as_completed(futures), 1):
+                task_index = futures[future]
+                results[task_index].update(future.result())
+
+                symbol, interval, forecast_horizon, forecast_gap, trading_fee_percentage = tasks[task_index]
+                logger.info(f'[{completed}/{len(tasks)}] Built {symbol} {interval} horizon {forecast_horizon} gap '
+                            f'{forecast_gap} fee {trading_fee_percentage} ({results[task_index]["rows"]} rows) in '
+                            f'{results[task_index]["seconds"]:.2f}s')
+
+                # release the features of a pair as soon as all of its tasks are done
+                pending[(symbol, interval)] -= 1
+                if pending[(symbol, interval)] == 0:
+                    _release_shared_memory(shared_memories.pop((symbol, interval)))
+        finally:
+            executor.shutdown(cancel_futures=True)
+            for shared_memory in shared_memories.values():
+                _release_shared_memory(shared_memory)
+
+    logger.info(f'Built {len(tasks)} datasets in {time.perf_counter() - started_at:.2f}s')
+
+    return results
+
+
+def _to_shared_memory(array):
+    shared_memory = SharedMemory(create=True, size=max(array.nbytes, 1))
+    shared_array = np.ndarray(array.shape, dtype=array.dtype, buffer=shared_memory.buf)
+    shared_array[:] = array
+    return shared_memory, shared_array
+
+
+def _release_shared_memory(shared_memory):
+    shared_memory.close()
+    shared_memory.unlink()
+
+
+def _build_dataset(shared_memory_name, shape, columns, task, output_directory, training_size, validation_size,
+                   pipeline_params):
+    symbol, interval, forecast_horizon, forecast_gap, trading_fee_percentage = task
+    timings = {}
+    started_at = time.perf_counter()
+
+    shared_memory = SharedMemory(name=shared_memory_name)
+    try:
+        # the label and the filters only add or replace columns, so the shared features are never written to
+        shared_array = np.ndarray(shape, dtype=np.float64, buffer=shared_memory.buf)
+        shared_array.flags.writeable = False
+        df = pd.DataFrame(shared_array, columns=columns, copy=False)
+
+        add_class_up(df, forecast_horizon, trading_fee_percentage, forecast_gap=forecast_gap)
+        df = df.dropna()
+        timings['label_seconds'] = time.perf_counter() - started_at
+
+        step_started_at = time.perf_counter()
+        df_train, df_val, df_test = split_train_val_test(df, training_size, validation_size)
+        pipeline = PreprocessingPipeline(exclude_columns=['up'], **(pipeline_params or {}))
+        x_train = pipeline.fit_transform(df_train)
+        x_val, x_test = pipeline.transform(df_val), pipeline.transform(df_test)
+        timings['preprocessing_seconds'] = time.perf_counter() - step_started_at
+
+        step_started_at = time.perf_counter()
+        directory = os.path.join(output_directory,
+                                 f'{symbol}_{interval}_{forecast_horizon}_{forecast_gap}_{trading_fee_percentage}')
+        os.makedirs(directory, exist_ok=True)
+        for name, x, split in (('train', x_train, df_train), ('val', x_val, df_val), ('test', x_test, df_test)):
+            np.save(os.path.join(directory, f'x_{name}.npy'), x)
+            np.save(os.path.join(directory, f'y_{name}.npy'), split['up'].to_numpy())
+        pipeline.save(os.path.join(directory, 'pipeline.npz'))
+        with open(os.path.join(directory, 'columns.json'), 'w') as columns_file:
+            json.dump(pipeline.columns, columns_file)
+        timings['write_seconds'] = time.perf_counter() - step_started_at
+
+        rows = len(df)
+        del df, df_train, df_val, df_test, shared_array
+    finally:
+        shared_memory.close()
+
+    return {'directory': directory, 'rows': rows, 'seconds': time.perf_counter() - started_at, **timings}
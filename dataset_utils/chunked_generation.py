@@ -0,0 +1,131 @@
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from dataset_utils.data_preprocessing import apply_hampel_filter, apply_sg_filter
+from dataset_utils.feature_creation import add_classes_up
+from dataset_utils.feature_pipeline import add_features
+from logger import logger
+from metrics import stage
+
+# rows of warm-up per period of the longest indicator, so that the EMA-based indicators converge to the values they
+# have over the whole history (their error decays by a factor of about e^-2 per period)
+WARMUP_ROWS_PER_PERIOD = 20
+
+
+@stage()
+def generate_dataset_in_chunks(store, symbol, interval, output_directory, feature_specs, forecast_horizons_and_gaps,
+                               trading_fee_percentage, label_columns=None, chunk_size=500000, warmup_rows=None,
+                               hampel_columns=(), hampel_window_size=15, hampel_n_sigmas=3, sg_columns=(),
+                               sg_window_size=51, sg_polynomial_degree=5, sg_mode='nearest', dtype=np.float64):
+    """
+    Generate the labeled feature dataset of the klines in a store, processing them in time-ordered chunks so that the
+    peak memory is bounded by the chunk size rather than by the length of the history.
+
+    Every chunk is read with the preceding rows needed to warm up the indicators and the following rows needed to
+    label it, plus the rows around it needed by the filter windows. After labeling, computing the features, dropping
+    NaNs and filtering, only the rows of the chunk itself are written to disk.
+
+    Args:
+        store (dataset_utils.kline_store.KlineStore): Store containing the klines.
+        symbol (str): The currency pair.
+        interval (str): Duration of each candlestick.
+        output_directory (str): Directory the dataset is written to, see `load_chunked_dataset`.
+        feature_specs (list): (indicator, params) pairs, see `feature_pipeline.compute_features`.
+        forecast_horizons_and_gaps (list): (forecast_horizon, forecast_gap) pairs of the "up" classes.
+        trading_fee_percentage (float): Fee as a percentage of the asset purchased, used in calculations.
+        label_columns (list, optional): Names of the "up" class columns, see `feature_creation.add_classes_up`.
+        chunk_size (int, optional): Number of klines processed at once. Defaults to 500000.
+        warmup_rows (int, optional): Number of rows preceding each chunk fed to the indicators. Defaults to
+            WARMUP_ROWS_PER_PERIOD times the longest period among the feature specs.
+        hampel_columns (list, optional): Columns to apply the Hampel filter to. Defaults to none.
+        hampel_window_size (int, optional): Size of the Hampel sliding window. Defaults to 15.
+        hampel_n_sigmas (int, optional): Number of standard deviations of the Hampel threshold. Defaults to 3.
+        sg_columns (list, optional): Columns to apply the Savitzky-Golay filter to. Defaults to none.
+        sg_window_size (int, optional): Length of the Savitzky-Golay filter window. Defaults to 51.
+        sg_polynomial_degree (int, optional): Order of the Savitzky-Golay polynomial. Defaults to 5.
+        sg_mode (str, optional): How the Savitzky-Golay filter handles the array borders. Defaults to 'nearest'.
+        dtype (numpy.dtype, optional): Data type of the dataset. Defaults to numpy.float64.
+    """
+
+    columns = store.columns(symbol, interval)
+    n_rows = len(columns['open_time'])
+
+    if warmup_rows is None:
+        warmup_rows = WARMUP_ROWS_PER_PERIOD * max([value for _, params in feature_specs
+                                                    for key, value in params.items() if 'period' in key] + [1])
+    lookahead_rows = max(forecast_horizon + forecast_gap for forecast_horizon, forecast_gap
+                         in forecast_horizons_and_gaps)
+    # the Savitzky-Golay filter is applied to the output of the Hampel filter, so their windows add up
+    filter_margin = (hampel_window_size // 2 if hampel_columns else 0) + (sg_window_size // 2 if sg_columns else 0)
+
+    logger.info(f'Generating the {symbol} {interval} dataset from {n_rows} klines in chunks of {chunk_size}, with '
+                f'{warmup_rows} warm-up and {lookahead_rows} look-ahead rows')
+
+    os.makedirs(output_directory, exist_ok=True)
+    part_paths = []
+    dataset_columns = None
+
+    for chunk_start in range(0, n_rows, chunk_size):
+        chunk_end = min(chunk_start + chunk_size, n_rows)
+        read_start = max(chunk_start - warmup_rows - filter_margin, 0)
+        read_end = min(chunk_end + lookahead_rows + filter_margin, n_rows)
+
+        # the index keeps the position of every row in the store
+        df = pd.DataFrame({column: np.array(values[read_start:read_end]) for column, values in columns.items()},
+                          index=pd.RangeIndex(read_start, read_end))
+        add_classes_up(df, forecast_horizons_and_gaps, trading_fee_percentage, column_names=label_columns)
+        df = add_features(df, feature_specs)
+        df.dropna(inplace=True)
+
+        if hampel_columns:
+            apply_hampel_filter(df, list(hampel_columns), window_size=hampel_window_size, n_sigmas=hampel_n_sigmas)
+        for column in sg_columns:
+            apply_sg_filter(df, column, window_size=sg_window_size, polynomial_degree=sg_polynomial_degree,
+                            mode=sg_mode)
+
+        # keep only the rows of the chunk
+        df = df.loc[chunk_start:chunk_end - 1]
+        dataset_columns = df.columns.tolist()
+
+        part_path = os.path.join(output_directory, f'part-{len(part_paths):05d}.npy')
+        np.save(part_path, df.to_numpy(dtype=dtype))
+        part_paths.append(part_path)
+
+    # concatenate the parts into a single memory-mappable array, one part at a time
+    parts = [np.load(part_path, mmap_mode='r') for part_path in part_paths]
+    dataset = np.lib.format.open_memmap(os.path.join(output_directory, 'dataset.npy'), mode='w+', dtype=dtype,
+                                        shape=(sum(len(part) for part in parts), len(dataset_columns or [])))
+    offset = 0
+    for part, part_path in zip(parts, part_paths):
+        dataset[offset:offset + len(part)] = part
+        offset += len(part)
+        del part
+        os.remove(part_path)
+    dataset.flush()
+
+    with open(os.path.join(output_directory, 'columns.json'), 'w') as columns_file:
+        json.dump(dataset_columns or [], columns_file)
+
+
+def load_chunked_dataset(directory, mmap_mode='r'):
+    """
+    Load a dataset written by `generate_dataset_in_chunks`.
+
+    Args:
+        directory (str): Directory the dataset was written to.
+        mmap_mode (str, optional): Memory-map mode of the array, or None to read it into memory. Defaults to 'r'.
+
+    Returns:
+        tuple: A 2-tuple containing:
+
+            - numpy.ndarray: The dataset, with one row per kline and one column per feature or class
+            - list: Column names of the dataset
+    """
+
+    with open(os.path.join(directory, 'columns.json')) as columns_file:
+        columns = json.load(columns_file)
+
+    return np.load(os.path.join(directory, 'dataset.npy'), mmap_mode=mmap_mode), columns
@@ -1,40 +1,126 @@
+import json
+
 import numpy as np
 import pandas as pd
-from scipy.signal import savgol_filter
+from scipy.signal import savgol_coeffs, savgol_filter
 from sklearn.preprocessing import RobustScaler, StandardScaler
 
 from logger import logger
+from metrics import stage
 
 
-def apply_hampel_filter(df, column, window_size=15, n_sigmas=3):
+@stage()
+def apply_hampel_filter(df, column, window_size=15, n_sigmas=3, return_outliers=False, causal=False):
     """
     Apply Hampel filter to detect and treat outliers in the specified column.
 
     Args:
         df (pd.DataFrame): DataFrame containing the data.
-        column (str): Name of the column to apply the filter to.
+        column (str or list): Name of the column to apply the filter to, or a list of column names.
         window_size (int, optional): Size of the sliding window. Defaults to 15.
         n_sigmas (int, optional): Number of standard deviations to use as threshold. Defaults to 3.
+        return_outliers (bool, optional): Whether to return the outliers mask. Defaults to False.
+        causal (bool, optional): Whether each value is compared with the window ending at it instead of the window
+            centered on it, so that no future value is used, as in `streaming_features.StreamingHampelFilter`.
+            Defaults to False.
+
+    Returns:
+        pd.Series or pd.DataFrame: Only if return_outliers is True, the boolean mask of the outliers that were replaced,
+        as a Series for a single column or as a DataFrame for a list of columns.
     """
 
-    logger.info(f'Applying Hampel filter to {column}')
+    columns = [column] if isinstance(column, str) else list(column)
+
+    logger.info(f'Applying Hampel filter to {", ".join(columns)}')
+
+    outliers_masks = {}
+    for filtered_column in columns:
+        rolling_median, outliers = _hampel_outliers(df[filtered_column].to_numpy(dtype=np.float64), window_size,
+                                                    n_sigmas, causal=causal)
 
-    # Calculate the rolling median
-    rolling_median = df[column].rolling(window=window_size, center=True).median()
+        # replace outliers with the rolling median, keeping the data type of the column
+        df.loc[outliers, filtered_column] = rolling_median[outliers].astype(df[filtered_column].dtype, copy=False)
+        outliers_masks[filtered_column] = outliers
+
+    if return_outliers:
+        if isinstance(column, str):
+            return pd.Series(outliers_masks[column], index=df.index, name=column)
+        return pd.DataFrame(outliers_masks, index=df.index)
+
+
+def _hampel_outliers(values, window_size, n_sigmas, causal=False):
+    """
+    Identify the outliers of an array with the Hampel filter.
 
-    # Calculate the threshold
-    rolling_mad = df[column].rolling(window=window_size, center=True).apply(
-        lambda x: np.median(np.abs(x - np.median(x))))
+    Args:
+        values (numpy.ndarray): 1-D input array.
+        window_size (int): Size of the sliding window.
+        n_sigmas (int): Number of standard deviations to use as threshold.
+        causal (bool, optional): Whether the window ends at each value instead of being centered on it. Defaults to
+            False.
+
+    Returns:
+        tuple: A 2-tuple containing:
+
+            - numpy.ndarray: Rolling median, to replace the outliers with
+            - numpy.ndarray: Boolean mask of the outliers
+    """
+
+    # calculate the center-aligned rolling median and median absolute deviation in a single pass
+    rolling_median, rolling_mad = _rolling_median_and_mad(values, window_size, center=not causal)
+
+    # calculate the threshold
     threshold = n_sigmas * rolling_mad
 
-    # Identify outliers
-    outliers = np.abs(df[column] - rolling_median) > threshold
+    # identify outliers
+    return rolling_median, np.abs(values - rolling_median) > threshold
 
-    # Replace outliers with the rolling median
-    df.loc[outliers, column] = rolling_median[outliers]
 
+def _rolling_median_and_mad(values, window_size, chunk_size=65536, center=True):
+    """
+    Compute the rolling median and median absolute deviation of an array, with the same alignment and NaN handling
+    as pandas `rolling(window=window_size, center=center)`.
+
+    The windows are strided views over the array and are processed in chunks, so that both statistics are computed
+    by NumPy's partition-based median without calling Python for every row.
 
-def apply_sg_filter(df, column, window_size=51, polynomial_degree=5, mode='nearest'):
+    Args:
+        values (numpy.ndarray): 1-D input array.
+        window_size (int): Size of the sliding window.
+        chunk_size (int, optional): Number of windows processed at once. Defaults to 65536.
+        center (bool, optional): Whether the windows are centered on each value instead of ending at it. Defaults to
+            True.
+
+    Returns:
+        tuple: A 2-tuple containing:
+
+            - numpy.ndarray: Rolling median
+            - numpy.ndarray: Rolling median absolute deviation
+    """
+
+    rolling_median = np.full(len(values), np.nan)
+    rolling_mad = np.full(len(values), np.nan)
+    if len(values) < window_size:
+        return rolling_median, rolling_mad
+
+    # the window of the i-th value spans [i - window_size // 2, i + (window_size - 1) // 2] when centered, and
+    # [i - window_size + 1, i] otherwise
+    windows = np.lib.stride_tricks.sliding_window_view(values, window_size)
+    offset = window_size // 2 if center else window_size - 1
+
+    for chunk_start in range(0, len(windows), chunk_size):
+        chunk = windows[chunk_start:chunk_start + chunk_size]
+        chunk_median = np.median(chunk, axis=1)
+        chunk_mad = np.median(np.abs(chunk - chunk_median[:, np.newaxis]), axis=1)
+
+        rolling_median[offset + chunk_start:offset + chunk_start + len(chunk)] = chunk_median
+        rolling_mad[offset + chunk_start:offset + chunk_start + len(chunk)] = chunk_mad
+
+    return rolling_median, rolling_mad
+
+
+@stage()
+def apply_sg_filter(df, column, window_size=51, polynomial_degree=5, mode='nearest', causal=False):
     """
     Apply Savitzky-Golay filter to smooth the specified column in the DataFrame.
 
@@ -46,13 +132,63 @@ def apply_sg_filter(df, column, window_size=51, polynomial_degree=5, mode='neare
         polynomial_degree (int, optional): The order of the polynomial used to fit the samples.
             Must be less than window_size. Defaults to 5.
         mode (str, optional): Determines how the array borders are handled. Default is 'nearest'.
+        causal (bool, optional): Whether each value is smoothed with the polynomial fitted to the window ending at it
+            instead of the window centered on it, so that no future value is used, as in
+            `streaming_features.StreamingSGFilter`. The mode is then ignored. Defaults to False.
     """
 
     logger.info(f'Applying Savitzky-Golay filter to {column}')
 
-    df[column] = savgol_filter(df[column], window_size, polynomial_degree, mode=mode)
+    if causal:
+        df[column] = _causal_savgol_filter(df[column].to_numpy(dtype=np.float64), window_size, polynomial_degree)
+    else:
+        df[column] = savgol_filter(df[column], window_size, polynomial_degree, mode=mode)
+
+
+def causal_savgol_coefficients(window_size, polynomial_degree):
+    """
+    Compute the end-point Savitzky-Golay coefficients of every window length up to `window_size`, which evaluate at
+    the last sample the polynomial fitted to the samples of the window.
+
+    Args:
+        window_size (int): The length of the filter window.
+        polynomial_degree (int): The order of the polynomial used to fit the samples.
+
+    Returns:
+        list: For every length n from 0 to `window_size`, the n coefficients to take the dot product of with the last
+        n samples. Windows too short to fit the polynomial return their last sample as is.
+    """
+
+    coefficients = [np.zeros(0)]
+    for length in range(1, window_size + 1):
+        if length <= polynomial_degree:
+            # the polynomial goes through every sample
+            coefficients.append(np.eye(length)[-1])
+        else:
+            coefficients.append(savgol_coeffs(length, polynomial_degree, pos=length - 1, use='dot'))
+
+    return coefficients
+
+
+def _causal_savgol_filter(values, window_size, polynomial_degree):
+    """
+    Smooth an array with the causal Savitzky-Golay filter, fitting every polynomial to the window ending at each
+    value, or to every value so far during the first `window_size - 1` values.
+    """
+
+    coefficients = causal_savgol_coefficients(window_size, polynomial_degree)
+    filtered = np.empty(len(values))
 
+    for i in range(min(window_size - 1, len(values))):
+        filtered[i] = np.dot(coefficients[i + 1], values[:i + 1])
 
+    if len(values) >= window_size:
+        filtered[window_size - 1:] = np.lib.stride_tricks.sliding_window_view(values, window_size) @ coefficients[-1]
+
+    return filtered
+
+
+@stage()
 def apply_standard_scaler(df, exclude_columns=None):
     logger.info(f'Applying Standard Scaler to all columns except {exclude_columns}')
 
@@ -63,6 +199,7 @@ def apply_standard_scaler(df, exclude_columns=None):
         df[df.columns.difference(exclude_columns)])
 
 
+@stage()
 def apply_robust_scaler(df, exclude_columns=None):
     logger.info(f'Applying Robust Scaler to all columns except {exclude_columns}')
 
@@ -71,3 +208,344 @@ def apply_robust_scaler(df, exclude_columns=None):
 
     df[df.columns.difference(exclude_columns)] = RobustScaler().fit_transform(
         df[df.columns.difference(exclude_columns)])
+
+
+class IncrementalStandardScaler:
+    """
+    Standard scaler whose statistics are updated with the rows entering and leaving the training set instead of being
+    refitted, so that walk-forward folds only pay for the rows that changed. Statistics are merged and unmerged with
+    the parallel variance algorithm of Chan et al., in float64.
+
+    Attributes:
+        n_samples_seen (int): Number of rows the statistics are computed over.
+        mean (numpy.ndarray): Mean of every column.
+        m2 (numpy.ndarray): Sum of squared deviations from the mean of every column.
+    """
+
+    def __init__(self):
+        self.n_samples_seen = 0
+        self.mean = None
+        self.m2 = None
+
+    def partial_fit(self, values):
+        """
+        Add rows to the statistics.
+
+        Args:
+            values (numpy.ndarray): 2-D array of rows to add.
+
+        Returns:
+            IncrementalStandardScaler: The scaler.
+        """
+
+        values = np.asarray(values, dtype=np.float64)
+        if len(values) == 0:
+            return self
+
+        n, mean = len(values), values.mean(axis=0)
+        m2 = np.square(values - mean).sum(axis=0)
+
+        if self.n_samples_seen == 0:
+            self.n_samples_seen, self.mean, self.m2 = n, mean, m2
+            return self
+
+        total = self.n_samples_seen + n
+        delta = mean - self.mean
+        self.m2 = self.m2 + m2 + np.square(delta) * self.n_samples_seen * n / total
+        self.mean = self.mean + delta * n / total
+        self.n_samples_seen = total
+
+        return self
+
+    def remove(self, values):
+        """
+        Remove rows previously added from the statistics.
+
+        Args:
+            values (numpy.ndarray): 2-D array of rows to remove.
+
+        Returns:
+            IncrementalStandardScaler: The scaler.
+        """
+
+        values = np.asarray(values, dtype=np.float64)
+        if len(values) == 0:
+            return self
+
+        n, mean = len(values), values.mean(axis=0)
+        m2 = np.square(values - mean).sum(axis=0)
+
+        remaining = self.n_samples_seen - n
+        if remaining <= 0:
+            self.__init__()
+            return self
+
+        remaining_mean = (self.mean * self.n_samples_seen - mean * n) / remaining
+        delta = mean - remaining_mean
+        self.m2 = np.maximum(self.m2 - m2 - np.square(delta) * remaining * n / self.n_samples_seen, 0)
+        self.mean = remaining_mean
+        self.n_samples_seen = remaining
+
+        return self
+
+    @property
+    def scale(self):
+        """
+        numpy.ndarray: Standard deviation of every column, with the same zero-variance handling as scikit-learn.
+        """
+
+        scale = np.sqrt(self.m2 / self.n_samples_seen)
+        scale[scale == 0] = 1
+        return scale
+
+    def transform(self, values, dtype=np.float32):
+        """
+        Standardize rows with the current statistics.
+
+        Args:
+            values (numpy.ndarray): 2-D array of rows.
+            dtype (numpy.dtype, optional): Data type of the output. Defaults to numpy.float32.
+
+        Returns:
+            numpy.ndarray: The standardized rows.
+        """
+
+        return ((np.asarray(values, dtype=np.float64) - self.mean) / self.scale).astype(dtype, copy=False)
+
+
+def walk_forward_scalers(values, splits):
+    """
+    Fit a standard scaler on the training rows of every walk-forward fold, updating it with the rows that entered and
+    left the training set since the previous fold instead of refitting it.
+
+    Args:
+        values (numpy.ndarray): 2-D array of the features of the whole dataset.
+        splits (iterable): (train, validation, test) slices of every fold in time order, e.g. from
+            `dataset_generation.walk_forward_splits`.
+
+    Yields:
+        tuple: A 4-tuple with the training, validation and test slices of the fold and the scaler fitted on its
+        training rows. The same scaler is updated for the next fold, so it must be used before advancing.
+    """
+
+    scaler = IncrementalStandardScaler()
+    train_start, train_end = 0, 0
+
+    for train, validation, test in splits:
+        if train.start < train_start or train.start >= train_end:
+            # not a forward move of the training window, so start over
+            scaler = IncrementalStandardScaler().partial_fit(values[train])
+        else:
+            scaler.remove(values[train_start:train.start])
+            scaler.partial_fit(values[train_end:train.stop])
+        train_start, train_end = train.start, train.stop
+
+        yield train, validation, test, scaler
+
+
+class PreprocessingPipeline:
+    """
+    Preprocessing chaining the Hampel filter, the Savitzky-Golay filter, the standard scaler and the robust scaler.
+
+    The filters are stateless and are applied to every dataset. The scalers are fitted once, on the training data, and
+    both are folded into a single per-column center and scale, so that transforming val/test/live data is one pass
+    over a contiguous float32 array. The fitted state can be saved and loaded for inference.
+
+    Args:
+        exclude_columns (list, optional): Columns left out of the output, e.g. the class. Defaults to None.
+        hampel_columns (list, optional): Columns to apply the Hampel filter to. Defaults to ['close'].
+        hampel_window_size (int, optional): Size of the Hampel sliding window. Defaults to 15.
+        hampel_n_sigmas (int, optional): Number of standard deviations of the Hampel threshold. Defaults to 3.
+        sg_columns (list, optional): Columns to apply the Savitzky-Golay filter to. Defaults to ['close'].
+        sg_window_size (int, optional): Length of the Savitzky-Golay filter window. Defaults to 51.
+        sg_polynomial_degree (int, optional): Order of the Savitzky-Golay polynomial. Defaults to 5.
+        sg_mode (str, optional): How the Savitzky-Golay filter handles the array borders. Defaults to 'nearest'.
+        dtype (numpy.dtype, optional): Data type of the output. Defaults to numpy.float32.
+        causal (bool, optional): Whether the filters only use past values, so that live candles filtered with
+            `create_streaming_filters` get the same values as the training data. Defaults to False.
+
+    Attributes:
+        columns (list): Columns of the output, in order, set when fitted.
+        center (numpy.ndarray): Value subtracted from each column, set when fitted.
+        scale (numpy.ndarray): Value each column is divided by after subtracting the center, set when fitted.
+    """
+
+    def __init__(self, exclude_columns=None, hampel_columns=('close',), hampel_window_size=15, hampel_n_sigmas=3,
+                 sg_columns=('close',), sg_window_size=51, sg_polynomial_degree=5, sg_mode='nearest', dtype=np.float32,
+                 causal=False):
+        self.exclude_columns = list(exclude_columns) if exclude_columns is not None else []
+        self.hampel_columns = list(hampel_columns)
+        self.hampel_window_size = hampel_window_size
+        self.hampel_n_sigmas = hampel_n_sigmas
+        self.sg_columns = list(sg_columns)
+        self.sg_window_size = sg_window_size
+        self.sg_polynomial_degree = sg_polynomial_degree
+        self.sg_mode = sg_mode
+        self.dtype = np.dtype(dtype)
+        self.causal = causal
+        self.columns = None
+        self.center = None
+        self.scale = None
+
+    @stage()
+    def fit(self, df):
+        """
+        Fit the scalers on the training data, after filtering it.
+
+        Args:
+            df (pandas.DataFrame): Training data.
+
+        Returns:
+            PreprocessingPipeline: The fitted pipeline.
+        """
+
+        logger.info(f'Fitting the preprocessing pipeline on {len(df)} rows')
+
+        self.columns = [column for column in df.columns if column not in self.exclude_columns]
+        values = np.column_stack([self._filter_column(column, df[column].to_numpy(dtype=np.float64))
+                                  for column in self.columns])
+
+        # standard scaler, with the same zero-variance handling as scikit-learn
+        mean = values.mean(axis=0)
+        std = values.std(axis=0)
+        std[std == 0] = 1
+
+        # robust scaler, fitted on the standardized data
+        standardized = (values - mean) / std
+        median = np.median(standardized, axis=0)
+        interquartile_range = np.subtract(*np.percentile(standardized, [75, 25], axis=0))
+        interquartile_range[interquartile_range == 0] = 1
+
+        # ((x - mean) / std - median) / iqr = (x - (mean + std * median)) / (std * iqr)
+        self.center = mean + std * median
+        self.scale = std * interquartile_range
+
+        return self
+
+    @stage()
+    def transform(self, data, apply_filters=True):
+        """
+        Filter and scale data with the fitted state.
+
+        Args:
+            data (pandas.DataFrame or numpy.ndarray): Data to transform. A DataFrame is converted once into a contiguous
+                array with the fitted columns; an array must already have them, in order, and is transformed in place
+                if it has the output data type.
+            apply_filters (bool, optional): Whether to filter the data before scaling it. Live candles already
+                filtered by the streaming filters are only scaled. Defaults to True.
+
+        Returns:
+            numpy.ndarray: The transformed data, with the fitted columns.
+        """
+
+        logger.info(f'Applying the preprocessing pipeline to {len(data)} rows')
+
+        if self.center is None:
+            raise ValueError('The preprocessing pipeline must be fitted before transforming data')
+
+        if isinstance(data, pd.DataFrame):
+            # a single contiguous output array, filled column by column in float64 to keep the precision of large
+            # values such as timestamps
+            values = np.empty((len(data), len(self.columns)), dtype=self.dtype)
+            for i, column in enumerate(self.columns):
+                column_values = data[column].to_numpy(dtype=np.float64)
+                if apply_filters:
+                    column_values = self._filter_column(column, column_values)
+                values[:, i] = (column_values - self.center[i]) / self.scale[i]
+            return values
+
+        values = np.asarray(data, dtype=self.dtype)
+        for i, column in enumerate(self.columns):
+            if apply_filters and (column in self.hampel_columns or column in self.sg_columns):
+                values[:, i] = self._filter_column(column, values[:, i].astype(np.float64))
+        values -= self.center.astype(self.dtype)
+        values /= self.scale.astype(self.dtype)
+
+        return values
+
+    def fit_transform(self, df):
+        """
+        Fit the pipeline on the training data and transform it.
+
+        Args:
+            df (pandas.DataFrame): Training data.
+
+        Returns:
+            numpy.ndarray: The transformed training data.
+        """
+
+        return self.fit(df).transform(df)
+
+    def save(self, path):
+        """
+        Save the configuration and fitted state of the pipeline to a `.npz` file.
+
+        Args:
+            path (str): Path of the file.
+        """
+
+        if self.center is None:
+            raise ValueError('The preprocessing pipeline must be fitted before saving it')
+
+        config = {key: value for key, value in vars(self).items() if key not in ('center', 'scale')}
+        config['dtype'] = self.dtype.name
+        np.savez(path, config=json.dumps(config), center=self.center, scale=self.scale)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load a pipeline saved with `save`, ready to transform data without refitting.
+
+        Args:
+            path (str): Path of the file.
+
+        Returns:
+            PreprocessingPipeline: The loaded pipeline.
+        """
+
+        with np.load(path) as saved:
+            config = json.loads(str(saved['config']))
+            columns = config.pop('columns')
+            pipeline = cls(**config)
+            pipeline.columns = columns
+            pipeline.center = saved['center']
+            pipeline.scale = saved['scale']
+
+        return pipeline
+
+    def create_streaming_filters(self):
+        """
+        Create the streaming counterparts of the filters of a causal pipeline, to filter live candles one at a time
+        with the same results as `transform`.
+
+        Returns:
+            dict: Column name to the list of its filters, in the order they are applied, to be passed to
+            `streaming_features.StreamingFeatureEngine`.
+        """
+
+        from dataset_utils.streaming_features import StreamingHampelFilter, StreamingSGFilter
+
+        if not self.causal:
+            raise ValueError('Only the filters of a causal pipeline can be applied to live candles')
+
+        filters = {}
+        for column in self.hampel_columns:
+            filters.setdefault(column, []).append(StreamingHampelFilter(self.hampel_window_size, self.hampel_n_sigmas))
+        for column in self.sg_columns:
+            filters.setdefault(column, []).append(StreamingSGFilter(self.sg_window_size, self.sg_polynomial_degree))
+
+        return filters
+
+    def _filter_column(self, column, values):
+        if column in self.hampel_columns:
+            rolling_median, outliers = _hampel_outliers(values, self.hampel_window_size, self.hampel_n_sigmas,
+                                                        causal=self.causal)
+            values = np.where(outliers, rolling_median, values)
+
+        if column in self.sg_columns:
+            if self.causal:
+                values = _causal_savgol_filter(values, self.sg_window_size, self.sg_polynomial_degree)
+            else:
+                values = savgol_filter(values, self.sg_window_size, self.sg_polynomial_degree, mode=self.sg_mode)
+
+        return values
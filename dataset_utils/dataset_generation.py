@@ -5,10 +5,56 @@ import pandas as pd
 from binance import Client
 
 from config import api_key, api_secret
+from dataset_utils.kline_downloader import download_klines_concurrently
 from logger import logger
+from metrics import stage
+
+# columns of interest of the klines, with their position in the Binance REST API payload
+KLINE_PAYLOAD_INDICES = {
+    'open_time': 0,
+    'open': 1,
+    'high': 2,
+    'low': 3,
+    'close': 4,
+    'volume': 5,
+    'quote_asset_volume': 7,
+    'number_of_trades': 8,
+    'taker_buy_base_asset_volume': 9,
+    'taker_buy_quote_asset_volume': 10,
+}
+KLINE_COLUMNS = list(KLINE_PAYLOAD_INDICES)
+
+# compact data type of each column: float32 keeps about 7 significant digits of the prices and volumes, which is
+# enough for the features, at half the memory of float64
+COMPACT_KLINE_DTYPES = {column: np.float32 for column in KLINE_COLUMNS} | {
+    'open_time': np.int64,
+    'number_of_trades': np.uint32,
+}
+
+# data type of each column when precision matters, the same as the ones pandas infers from the payload
+HIGH_PRECISION_KLINE_DTYPES = {column: np.float64 for column in KLINE_COLUMNS} | {
+    'open_time': np.int64,
+    'number_of_trades': np.int64,
+}
+
+
+def get_kline_dtypes(high_precision=False):
+    """
+    Get the data type of every kline column.
+
+    Args:
+        high_precision (bool, optional): Whether prices and volumes are float64 instead of float32. Defaults to False.
+
+    Returns:
+        dict: Column name to numpy data type, for every column in KLINE_COLUMNS.
+    """
+
+    return HIGH_PRECISION_KLINE_DTYPES if high_precision else COMPACT_KLINE_DTYPES
 
 
-def download_raw_dataset(symbol, interval, start_timestamp_millis, end_timestamp_millis=int(time.time() * 1000)):
+@stage()
+def download_raw_dataset(symbol, interval, start_timestamp_millis, end_timestamp_millis=int(time.time() * 1000),
+                         store=None, client=None, max_workers=None, high_precision=False):
     """Download the latest candlestick historical data and return it as a DataFrame.
 
     Args:
@@ -16,6 +62,13 @@ def download_raw_dataset(symbol, interval, start_timestamp_millis, end_timestamp
         interval (str): Duration of each candlestick. Must be one of the predefined interval choices.
         start_timestamp_millis (int): Start of the time range in Unix timestamp milliseconds.
         end_timestamp_millis (int, optional): End of the time range in Unix timestamp milliseconds.
+        store (dataset_utils.kline_store.KlineStore, optional): Local kline store. If given, only the klines missing
+            from it are downloaded and the requested range is then served from disk.
+        client (binance.Client, optional): Client used to download the klines. Created only when needed if not given.
+        max_workers (int, optional): If given, the klines are downloaded in concurrent chunks with this maximum number
+            of concurrent requests. Defaults to None (serial download).
+        high_precision (bool, optional): Whether prices and volumes are float64 instead of float32. Ignored when
+            serving from a store, which keeps its own data types. Defaults to False.
 
     Returns:
         pandas.DataFrame: The downloaded dataset as a DataFrame.
@@ -23,24 +76,65 @@ def download_raw_dataset(symbol, interval, start_timestamp_millis, end_timestamp
 
     logger.info('Downloading the raw dataset')
 
+    if store is not None:
+        if store.missing_ranges(symbol, interval, start_timestamp_millis, end_timestamp_millis):
+            store.update(client or Client(api_key, api_secret), symbol, interval, start_timestamp_millis,
+                         end_timestamp_millis, max_workers=max_workers)
+
+        return store.load(symbol, interval, start_timestamp_millis, end_timestamp_millis)
+
     # create client
-    client = Client(api_key, api_secret)
+    if client is None:
+        client = Client(api_key, api_secret)
 
     # download candlestick data
-    candles = client.get_historical_klines(symbol=symbol, interval=interval, start_str=start_timestamp_millis,
-                                           end_str=end_timestamp_millis)
+    if max_workers is None:
+        candles = client.get_historical_klines(symbol=symbol, interval=interval, start_str=start_timestamp_millis,
+                                               end_str=end_timestamp_millis)
+    else:
+        candles = download_klines_concurrently(client, [symbol], interval, start_timestamp_millis,
+                                               end_timestamp_millis, max_workers=max_workers)[symbol]
+
+    return klines_to_dataframe(candles, high_precision=high_precision)
+
+
+def klines_to_arrays(candles, high_precision=False):
+    """
+    Parse klines in the Binance REST API format straight into one typed array per column of interest, without
+    building any intermediate table.
+
+    Args:
+        candles (list): Klines as returned by `binance.Client.get_historical_klines`.
+        high_precision (bool, optional): Whether prices and volumes are float64 instead of float32. Defaults to False.
+
+    Returns:
+        dict: Column name to numpy.ndarray, for every column in KLINE_COLUMNS, with the types of `get_kline_dtypes`.
+    """
+
+    dtypes = get_kline_dtypes(high_precision)
+
+    # numpy parses the decimal strings of the payload itself while filling each preallocated array
+    return {column: np.fromiter((candle[index] for candle in candles), dtype=dtypes[column], count=len(candles))
+            for column, index in KLINE_PAYLOAD_INDICES.items()}
 
-    # get columns of interest and set data type
-    df = pd.DataFrame(
-        candles,
-        columns=['open_time', 'open', 'high', 'low', 'close', 'volume', 'close_time', 'quote_asset_volume',
-                 'number_of_trades', 'taker_buy_base_asset_volume', 'taker_buy_quote_asset_volume', 'ignore']
-    ).drop(['close_time', 'ignore'], axis=1).apply(pd.to_numeric)
 
-    return df
+def klines_to_dataframe(candles, high_precision=False):
+    """
+    Convert klines in the Binance REST API format into a DataFrame with the columns of interest.
+
+    Args:
+        candles (list): Klines as returned by `binance.Client.get_historical_klines`.
+        high_precision (bool, optional): Whether prices and volumes are float64 instead of float32. Defaults to False.
+
+    Returns:
+        pandas.DataFrame: The klines as a DataFrame.
+    """
+
+    return pd.DataFrame(klines_to_arrays(candles, high_precision=high_precision), copy=False)
 
 
-def transform_into_sliding_windows(df, window_size, stride=1):
+@stage()
+def transform_into_sliding_windows(df, window_size, stride=1, mode='copy', memmap_path=None):
     """
     Transform a dataset with class "up" into sliding windows and return the results as numpy arrays.
 
@@ -48,40 +142,59 @@ def transform_into_sliding_windows(df, window_size, stride=1):
         df (pandas.DataFrame): Input DataFrame containing the dataset with an 'up' column.
         window_size (int): Size of the sliding windows to be created.
         stride (int, optional): Stride of the sliding windows. Defaults to 1.
+        mode (str, optional): How the X windows are returned. Defaults to 'copy'.
+
+            - 'copy': a new contiguous array holding every window.
+            - 'view': a read-only strided view over the feature array, without copying any window.
+            - 'memmap': a memory-mapped `.npy` file at `memmap_path` holding every window.
+        memmap_path (str, optional): Path of the `.npy` file to write when mode is 'memmap'.
 
     Returns:
         tuple: A 3-tuple containing:
 
-            - numpy.ndarray: X windows data
+            - numpy.ndarray: X windows data, with shape (windows, window_size, features)
             - numpy.ndarray: up values corresponding to each window
             - list: Column names of the input DataFrame (excluding 'up')
     """
 
     logger.info('Transforming the dataset into sliding windows')
 
+    if mode not in ('copy', 'view', 'memmap'):
+        raise ValueError(f'Unknown sliding windows mode: {mode}')
+    if mode == 'memmap' and memmap_path is None:
+        raise ValueError('memmap_path is required when mode is "memmap"')
+
     # separate the dataframe from the class "up"
-    up_series = df['up']
+    up_array = df['up'].to_numpy()
     df = df.drop('up', axis=1)
 
     # get its numpy array representation
-    df_array = df.values
+    df_array = df.to_numpy()
 
-    # initialize the lists
-    x_windows_list = []
-    up_list = []
+    # build every window as a strided view, with shape (windows, window_size, features)
+    n_windows = max(len(df_array) - (window_size - 1), 0)
+    x_windows = np.lib.stride_tricks.as_strided(
+        df_array,
+        shape=(n_windows, window_size, df_array.shape[1]),
+        strides=(df_array.strides[0], df_array.strides[0], df_array.strides[1]),
+        writeable=False
+    )[::stride]
 
-    # iterate over the dataset
-    for i in range(0, len(df) - (window_size - 1), stride):
-        # append new X window
-        x_window = df_array[i:i + window_size]
-        x_windows_list.append(x_window)
+    # each window is labeled with the class "up" of its last row
+    up_windows = up_array[window_size - 1::stride]
 
-        # append new class "up" value
-        up_list.append(up_series[i + window_size - 1])
+    if mode == 'copy':
+        x_windows = np.ascontiguousarray(x_windows)
+    elif mode == 'memmap':
+        x_memmap = np.lib.format.open_memmap(memmap_path, mode='w+', dtype=x_windows.dtype, shape=x_windows.shape)
+        x_memmap[:] = x_windows
+        x_memmap.flush()
+        x_windows = x_memmap
 
-    return np.array(x_windows_list), np.array(up_list), df.columns.tolist()
+    return x_windows, up_windows, df.columns.tolist()
 
 
+@stage()
 def split_train_val_test(df, training_size, validation_size):
     """
     Split the dataset into training, validation and test sets.
@@ -112,6 +225,46 @@ def split_train_val_test(df, training_size, validation_size):
     return train_df, val_df, test_df
 
 
+def walk_forward_splits(n_rows, n_folds, test_size, validation_size=0, train_size=None, gap=0):
+    """
+    Generate walk-forward splits of a time-ordered dataset, as slices that index any array or DataFrame (with
+    `iloc`) without copying it.
+
+    The test sets of the folds are consecutive blocks at the end of the dataset. Each fold trains on the rows before
+    its validation set, either all of them (expanding window) or the last `train_size` ones (rolling window). `gap`
+    rows are purged before the validation and test sets, so that no training or validation label looks into the
+    following set; it should be at least `forecast_horizon + forecast_gap`.
+
+    Args:
+        n_rows (int): Number of rows of the dataset.
+        n_folds (int): Number of folds.
+        test_size (int): Number of rows of every test set.
+        validation_size (int, optional): Number of rows of every validation set. Defaults to 0.
+        train_size (int, optional): Number of rows of every training set. Defaults to None (expanding window).
+        gap (int, optional): Number of rows purged before the validation and test sets. Defaults to 0.
+
+    Yields:
+        tuple: A 3-tuple of slices, the training, validation and test rows of the fold, in time order.
+    """
+
+    logger.info(f'Generating {n_folds} walk-forward splits of {n_rows} rows')
+
+    first_test_start = n_rows - n_folds * test_size
+    first_train_end = first_test_start - gap - (validation_size + gap if validation_size else 0)
+    if first_train_end <= 0 or (train_size is not None and first_train_end < train_size):
+        raise ValueError(f'{n_rows} rows are not enough for {n_folds} folds of {test_size} test rows')
+
+    for fold in range(n_folds):
+        test_start = first_test_start + fold * test_size
+        validation_end = test_start - gap if validation_size else test_start
+        validation_start = validation_end - validation_size
+        train_end = validation_start - gap
+        train_start = 0 if train_size is None else train_end - train_size
+
+        yield (slice(train_start, train_end), slice(validation_start, validation_end),
+               slice(test_start, test_start + test_size))
+
+
 def split_x_y(df, y_column='up'):
     """
     Split the dataset into X and y.
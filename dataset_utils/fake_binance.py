@@ -0,0 +1,414 @@
+import asyncio
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+from binance import Client
+from binance.helpers import interval_to_milliseconds
+from websockets.asyncio.server import serve
+
+
+def generate_synthetic_klines(start_timestamp_millis, end_timestamp_millis, interval='1m', seed=0):
+    """
+    Generate deterministic synthetic klines with the columns of the raw Binance payload.
+
+    Every candle is a pure function of the seed and its open time, so overlapping or adjacent time ranges always
+    produce the same values for the candles they share.
+
+    Args:
+        start_timestamp_millis (int): Start of the time range in Unix timestamp milliseconds.
+        end_timestamp_millis (int): End of the time range in Unix timestamp milliseconds (inclusive).
+        interval (str, optional): Duration of each candlestick. Defaults to '1m'.
+        seed (int, optional): Seed of the synthetic price path. Defaults to 0.
+
+    Returns:
+        dict: Column name to numpy.ndarray, with the columns 'open_time', 'open', 'high', 'low', 'close', 'volume',
+        'close_time', 'quote_asset_volume', 'number_of_trades', 'taker_buy_base_asset_volume' and
+        'taker_buy_quote_asset_volume'.
+    """
+
+    interval_millis = interval_to_milliseconds(interval)
+
+    # candles are aligned to multiples of the interval, as in Binance
+    first_index = -(-start_timestamp_millis // interval_millis)
+    last_index = end_timestamp_millis // interval_millis
+    index = np.arange(first_index, max(last_index + 1, first_index), dtype=np.int64)
+
+    # each candle opens at the close of the previous one
+    close = np.round(np.exp(_log_close(index, seed)), 2)
+    open_ = np.round(np.exp(_log_close(index - 1, seed)), 2)
+    high = np.round(np.maximum(open_, close) * (1 + 0.005 * np.abs(_uniform_noise(index, seed, 1))), 2)
+    low = np.round(np.minimum(open_, close) * (1 - 0.005 * np.abs(_uniform_noise(index, seed, 2))), 2)
+
+    volume = np.round(10 + 5 * (_uniform_noise(index, seed, 3) + 1), 5)
+    taker_ratio = 0.5 + 0.25 * _uniform_noise(index, seed, 4)
+    number_of_trades = (100 + 50 * (_uniform_noise(index, seed, 5) + 1)).astype(np.int64)
+
+    return {
+        'open_time': index * interval_millis,
+        'open': open_,
+        'high': high,
+        'low': low,
+        'close': close,
+        'volume': volume,
+        'close_time': (index + 1) * interval_millis - 1,
+        'quote_asset_volume': np.round(volume * close, 5),
+        'number_of_trades': number_of_trades,
+        'taker_buy_base_asset_volume': np.round(volume * taker_ratio, 5),
+        'taker_buy_quote_asset_volume': np.round(volume * taker_ratio * close, 5),
+    }
+
+
+def synthetic_klines_to_payload(columns):
+    """
+    Convert synthetic kline columns into the raw Binance payload, i.e. a list of klines where each kline is a list of
+    12 values and every price or volume is a string.
+
+    Args:
+        columns (dict): Kline columns as returned by `generate_synthetic_klines`.
+
+    Returns:
+        list: The klines in the Binance REST API format.
+    """
+
+    return [
+        [int(open_time), f'{open_:.8f}', f'{high:.8f}', f'{low:.8f}', f'{close:.8f}', f'{volume:.8f}',
+         int(close_time), f'{quote_asset_volume:.8f}', int(number_of_trades), f'{taker_base:.8f}',
+         f'{taker_quote:.8f}', '0']
+        for open_time, open_, high, low, close, volume, close_time, quote_asset_volume, number_of_trades, taker_base,
+        taker_quote in zip(*columns.values())
+    ]
+
+
+def _log_close(index, seed):
+    """
+    Compute the synthetic log close price of the given candles: slow and fast cycles plus some noise.
+
+    Args:
+        index (numpy.ndarray): Candle indices (open time divided by the interval).
+        seed (int): Seed of the price path.
+
+    Returns:
+        numpy.ndarray: Log close prices.
+    """
+
+    return (0.3 * np.sin(index / 5000) + 0.05 * np.sin(index / 97) + 0.01 * _uniform_noise(index, seed, 0)
+            + np.log(100 + seed))
+
+
+def _uniform_noise(index, seed, stream):
+    """
+    Hash candle indices into deterministic noise uniformly distributed in [-1, 1).
+
+    Args:
+        index (numpy.ndarray): Candle indices (open time divided by the interval).
+        seed (int): Seed of the noise.
+        stream (int): Identifier of an independent noise stream for the same candles.
+
+    Returns:
+        numpy.ndarray: Noise values.
+    """
+
+    # splitmix64 finalizer over the index, mixed with the seed and the stream
+    with np.errstate(over='ignore'):
+        x = index.astype(np.uint64) * np.uint64(0x9E3779B97F4A7C15) + np.uint64((seed * 1000003 + stream) % 2 ** 64)
+        x ^= x >> np.uint64(30)
+        x *= np.uint64(0xBF58476D1CE4E5B9)
+        x ^= x >> np.uint64(27)
+        x *= np.uint64(0x94D049BB133111EB)
+        x ^= x >> np.uint64(31)
+
+    return (x >> np.uint64(11)).astype(np.float64) / 2 ** 52 - 1
+
+
+class FakeClient:
+    """
+    Offline stand-in for `binance.Client` serving deterministic synthetic klines.
+
+    Args:
+        listing_timestamp_millis (int, optional): Open time of the first available kline. Defaults to 1502942400000
+            (the first BTCUSDT kline on Binance).
+        now_millis (int, optional): Current time seen by the fake exchange; klines opening later are not available and
+            the kline containing it is still open. Defaults to 1720009820000.
+        seed (int, optional): Seed of the synthetic price path. Defaults to 0.
+
+    Attributes:
+        requests (list): (symbol, interval, start, end) of every kline request received, for inspection.
+    """
+
+    def __init__(self, listing_timestamp_millis=1502942400000, now_millis=1720009820000, seed=0):
+        self.listing_timestamp_millis = listing_timestamp_millis
+        self.now_millis = now_millis
+        self.seed = seed
+        self.requests = []
+
+    def get_klines(self, symbol, interval, startTime=None, endTime=None, limit=500):
+        """
+        Return up to `limit` klines opening within [startTime, endTime], as `binance.Client.get_klines` does.
+        """
+
+        self.requests.append((symbol, interval, startTime, endTime))
+
+        interval_millis = interval_to_milliseconds(interval)
+        start = max(startTime if startTime is not None else 0, self.listing_timestamp_millis)
+        end = min(endTime if endTime is not None else self.now_millis, self.now_millis)
+        end = min(end, -(-start // interval_millis) * interval_millis + (limit - 1) * interval_millis)
+
+        return synthetic_klines_to_payload(generate_synthetic_klines(start, end, interval, self.seed))
+
+    def get_historical_klines(self, symbol, interval, start_str=None, end_str=None, limit=None):
+        """
+        Return every kline opening within [start_str, end_str], as `binance.Client.get_historical_klines` does with
+        timestamps in milliseconds.
+        """
+
+        self.requests.append((symbol, interval, start_str, end_str))
+
+        start = max(start_str if start_str is not None else 0, self.listing_timestamp_millis)
+        end = min(end_str if end_str is not None else self.now_millis, self.now_millis)
+
+        return synthetic_klines_to_payload(generate_synthetic_klines(start, end, interval, self.seed))
+
+
+class FakeKlineServer:
+    """
+    Local HTTP server imitating the Binance klines REST endpoint, serving the klines of a `FakeClient`.
+
+    Every request is delayed by `latency_seconds`. Requests exceeding the weight budget of the current minute, and
+    every `throttle_every`-th klines request, are answered with a 429 response and a Retry-After header.
+
+    Args:
+        latency_seconds (float, optional): Delay of every response. Defaults to 0.05.
+        weight_per_minute (int, optional): Weight budget per minute, as in Binance. Defaults to 6000.
+        throttle_every (int, optional): If given, every n-th klines request is rate limited regardless of the budget.
+        retry_after_seconds (int, optional): Value of the Retry-After header of rate limited responses. Defaults to 1.
+        client (FakeClient, optional): Source of the klines. Defaults to a new FakeClient.
+
+    Attributes:
+        api_url (str): Base URL of the API, set once the server is started.
+        kline_requests (int): Number of klines requests received.
+        throttled_requests (int): Number of klines requests answered with a 429 response.
+    """
+
+    def __init__(self, latency_seconds=0.05, weight_per_minute=6000, throttle_every=None, retry_after_seconds=1,
+                 client=None):
+        self.latency_seconds = latency_seconds
+        self.weight_per_minute = weight_per_minute
+        self.throttle_every = throttle_every
+        self.retry_after_seconds = retry_after_seconds
+        self.client = client if client is not None else FakeClient()
+        self.api_url = None
+        self.kline_requests = 0
+        self.throttled_requests = 0
+        self._used_weight = 0
+        self._minute = None
+        self._lock = threading.Lock()
+        self._server = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def start(self):
+        """
+        Start serving in a background thread on a free local port.
+        """
+
+        fake_server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                fake_server._handle(self)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.api_url = f'http://127.0.0.1:{self._server.server_port}/api'
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        """
+        Stop serving.
+        """
+
+        self._server.shutdown()
+        self._server.server_close()
+
+    def create_client(self):
+        """
+        Create a `binance.Client` sending its requests to this server.
+
+        Returns:
+            binance.Client: The client.
+        """
+
+        client = Client(ping=False)
+        client.API_URL = self.api_url
+
+        return client
+
+    def _handle(self, handler):
+        time.sleep(self.latency_seconds)
+
+        url = urlparse(handler.path)
+        if url.path == '/api/v3/ping':
+            return self._respond(handler, 200, {})
+        if url.path != '/api/v3/klines':
+            return self._respond(handler, 404, {'code': -1, 'msg': 'Not found'})
+
+        with self._lock:
+            self.kline_requests += 1
+            minute = int(time.time() // 60)
+            if minute != self._minute:
+                self._minute, self._used_weight = minute, 0
+            self._used_weight += 2
+            throttled = (self._used_weight > self.weight_per_minute
+                         or self.throttle_every is not None and self.kline_requests % self.throttle_every == 0)
+            if throttled:
+                self.throttled_requests += 1
+
+        if throttled:
+            return self._respond(handler, 429, {'code': -1003, 'msg': 'Too many requests'},
+                                 {'Retry-After': str(self.retry_after_seconds)})
+
+        params = {key: values[0] for key, values in parse_qs(url.query).items()}
+        klines = self.client.get_klines(
+            symbol=params['symbol'], interval=params['interval'],
+            startTime=int(params['startTime']) if 'startTime' in params else None,
+            endTime=int(params['endTime']) if 'endTime' in params else None,
+            limit=int(params.get('limit', 500))
+        )
+
+        self._respond(handler, 200, klines, {'x-mbx-used-weight-1m': str(self._used_weight)})
+
+    @staticmethod
+    def _respond(handler, status_code, body, headers=None):
+        payload = json.dumps(body).encode()
+        handler.send_response(status_code)
+        handler.send_header('Content-Type', 'application/json')
+        handler.send_header('Content-Length', str(len(payload)))
+        for name, value in (headers or {}).items():
+            handler.send_header(name, value)
+        handler.end_headers()
+        handler.wfile.write(payload)
+
+
+class FakeKlineStreamServer:
+    """
+    Local websocket server imitating the Binance combined kline streams, replaying recorded klines at accelerated
+    speed.
+
+    Clients connect to `/stream?streams=<symbol>@kline_<interval>/...` as on Binance. Every kline of the requested
+    symbols is sent in time order, first as `updates_per_kline` updates of the still open kline and then as the closed
+    kline, waiting `interval / speedup` between consecutive open times. The connection stays open after the replay.
+
+    With `disconnect_after`, the server drops the first connection after that many open times, as Binance does under
+    load or during maintenance, and the next connections resume `missed_klines` open times later, since the streams
+    never send the klines that closed while the client was away.
+
+    Args:
+        klines (dict): Symbol to its recorded klines in the Binance REST API format, e.g. from
+            `FakeClient.get_historical_klines`.
+        interval (str): Duration of each candlestick.
+        speedup (float, optional): How many times faster than real time the klines are replayed. Defaults to 600.
+        updates_per_kline (int, optional): Number of updates of each kline sent before it closes. Defaults to 1.
+        disconnect_after (int, optional): Number of open times replayed before the first connection is dropped.
+            Defaults to None (never dropped).
+        missed_klines (int, optional): Number of open times skipped when the next connection resumes after the drop.
+            Defaults to 0.
+
+    Attributes:
+        url (str): Base URL of the streams, set once the server is started.
+        sent_messages (int): Number of messages sent.
+    """
+
+    def __init__(self, klines, interval, speedup=600, updates_per_kline=1, disconnect_after=None, missed_klines=0):
+        self.klines = klines
+        self.interval = interval
+        self.speedup = speedup
+        self.updates_per_kline = updates_per_kline
+        self.disconnect_after = disconnect_after
+        self.missed_klines = missed_klines
+        self._resume_index = 0
+        self._dropped = False
+        self.url = None
+        self.sent_messages = 0
+        self._server = None
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.stop()
+
+    async def start(self):
+        """
+        Start serving on a free local port.
+        """
+
+        self._server = await serve(self._replay, '127.0.0.1', 0)
+        self.url = f'ws://127.0.0.1:{self._server.sockets[0].getsockname()[1]}'
+
+    async def stop(self):
+        """
+        Stop serving and close every connection.
+        """
+
+        self._server.close()
+        await self._server.wait_closed()
+
+    async def _replay(self, websocket):
+        query = parse_qs(urlparse(websocket.request.path).query)
+        streams = query.get('streams', [''])[0].split('/')
+        symbols = [symbol for symbol in self.klines if f'{symbol.lower()}@kline_{self.interval}' in streams]
+
+        # klines of every symbol merged by open time
+        klines_by_open_time = {}
+        for symbol in symbols:
+            for kline in self.klines[symbol]:
+                klines_by_open_time.setdefault(kline[0], []).append((symbol, kline))
+
+        open_times = sorted(klines_by_open_time)
+        for index in range(self._resume_index, len(open_times)):
+            if self.disconnect_after is not None and not self._dropped and index == self.disconnect_after:
+                self._dropped = True
+                self._resume_index = index + self.missed_klines
+                await websocket.close()
+                return
+
+            open_time = open_times[index]
+            for update in range(self.updates_per_kline + 1):
+                for symbol, kline in klines_by_open_time[open_time]:
+                    await websocket.send(json.dumps(_kline_stream_message(symbol, self.interval, kline,
+                                                                          update == self.updates_per_kline)))
+                    self.sent_messages += 1
+            await asyncio.sleep(interval_to_milliseconds(self.interval) / 1000 / self.speedup)
+
+        await websocket.wait_closed()
+
+
+def _kline_stream_message(symbol, interval, kline, closed):
+    open_time, open_, high, low, close, volume, close_time, quote_asset_volume, number_of_trades, taker_base, \
+        taker_quote, _ = kline
+
+    return {
+        'stream': f'{symbol.lower()}@kline_{interval}',
+        'data': {
+            'e': 'kline',
+            'E': close_time if closed else open_time,
+            's': symbol,
+            'k': {
+                't': open_time, 'T': close_time, 's': symbol, 'i': interval, 'o': open_, 'c': close, 'h': high,
+                'l': low, 'v': volume, 'n': number_of_trades, 'x': closed, 'q': quote_asset_volume, 'V': taker_base,
+                'Q': taker_quote, 'B': '0'
+            }
+        }
+    }
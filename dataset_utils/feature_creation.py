@@ -2,6 +2,7 @@ import numpy as np
 import talib
 
 from logger import logger
+from metrics import stage
 
 
 def add_class_up(df, forecast_horizon, trading_fee_percentage, forecast_gap=0):
@@ -20,27 +21,84 @@ def add_class_up(df, forecast_horizon, trading_fee_percentage, forecast_gap=0):
 
     logger.info('Calculating the class "up"')
 
-    # get the index of 'close' column
-    close_index = df.columns.tolist().index('close')
+    add_classes_up(df, [(forecast_horizon, forecast_gap)], trading_fee_percentage, column_names=['up'])
 
-    # get its numpy array representation
-    df_array = df.values
+
+@stage()
+def add_classes_up(df, forecast_horizons_and_gaps, trading_fee_percentage, column_names=None):
+    """
+    Calculate and add to the dataset one class "up" column per forecast horizon and gap pair, all of them computed
+    from a single scan of the "close" column. See `add_class_up` for the meaning of each column.
+
+    The scan builds forward rolling maxima of "close" over power-of-two windows, so any horizon is answered as the
+    maximum of two overlapping windows. This costs O(n log h) for the largest horizon h, instead of O(n * h) per
+    horizon.
+
+    Args:
+        df (pandas.DataFrame): Input DataFrame containing the dataset.
+        forecast_horizons_and_gaps (list): List of (forecast_horizon, forecast_gap) pairs.
+        trading_fee_percentage (float): Fee as a percentage of the asset purchased, used in calculations.
+        column_names (list, optional): Names of the new columns, one per pair. Defaults to
+            "up_{forecast_horizon}_{forecast_gap}".
+    """
+
+    logger.info(f'Calculating the class "up" for {len(forecast_horizons_and_gaps)} horizons')
+
+    if column_names is None:
+        column_names = [f'up_{forecast_horizon}_{forecast_gap}'
+                        for forecast_horizon, forecast_gap in forecast_horizons_and_gaps]
+
+    close = df['close'].to_numpy(dtype=np.float64)
+    n = len(close)
 
     # calculate profit thresholds for all rows in advance
-    profit_thresholds = df_array[:, close_index] / (1 - trading_fee_percentage / 100) ** 2
+    profit_thresholds = close / (1 - trading_fee_percentage / 100) ** 2
+
+    # forward maxima of every window size needed, i.e. window_maxima[w][i] = max(close[i:i + w])
+    window_maxima = _forward_window_maxima(close, {forecast_horizon for forecast_horizon, _ in
+                                                   forecast_horizons_and_gaps})
+
+    for (forecast_horizon, forecast_gap), column_name in zip(forecast_horizons_and_gaps, column_names):
+        # rows whose forecast window is complete; the last few rows are left as NaN
+        n_labeled = max(n - (forecast_gap + forecast_horizon), 0)
+
+        up = np.full(n, np.nan)
+        forecast_maxima = window_maxima[forecast_horizon][1 + forecast_gap:1 + forecast_gap + n_labeled]
+        up[:n_labeled] = forecast_maxima > profit_thresholds[:n_labeled]
+
+        # add the new column in place
+        df[column_name] = up
+
+
+def _forward_window_maxima(values, window_sizes):
+    """
+    Compute the forward rolling maximum of an array for several window sizes, ignoring NaNs.
+
+    Args:
+        values (numpy.ndarray): 1-D input array.
+        window_sizes (iterable): Window sizes (positive integers) to compute.
+
+    Returns:
+        dict: For each window size w, an array of length len(values) - w + 1 whose i-th value is max(values[i:i + w]).
+    """
+
+    window_sizes = sorted(set(window_sizes))
+    results = {}
 
-    # iterate over the dataset
-    up_list = []
-    for i in range(0, len(df) - (forecast_gap + forecast_horizon)):
-        forecast_window = df_array[i + 1 + forecast_gap:i + 1 + forecast_gap + forecast_horizon, close_index]
-        up_list.append(np.any(forecast_window > profit_thresholds[i]))
+    # levels[k] holds the maxima over windows of size 2 ** k
+    levels = [values]
+    for window_size in window_sizes:
+        level = window_size.bit_length() - 1
+        while len(levels) <= level:
+            previous, half = levels[-1], 2 ** (len(levels) - 1)
+            levels.append(np.fmax(previous[:-half], previous[half:]) if len(previous) > half else previous[:0])
 
-    # add NaNs for the last few rows, as it was not possible to compute "up" for them
-    up_list.extend([np.nan] * (forecast_gap + forecast_horizon))
+        # combine the two overlapping power-of-two windows that cover the whole window
+        level_maxima, offset = levels[level], window_size - 2 ** level
+        n_windows = max(len(values) - window_size + 1, 0)
+        results[window_size] = np.fmax(level_maxima[:n_windows], level_maxima[offset:offset + n_windows])
 
-    # add the new column in place
-    df['up'] = up_list
-    df['up'] = df['up'].astype(float)
+    return results
 
 
 def add_sma(df, period):
@@ -0,0 +1,181 @@
+import numpy as np
+import pandas as pd
+import talib
+
+from logger import logger
+from metrics import stage
+
+
+class _FeatureContext:
+    """
+    Input columns and intermediate results shared by the features computed for a DataFrame. Every intermediate result
+    is computed once, the first time a feature asks for it.
+    """
+
+    def __init__(self, df):
+        self.df = df
+        self.cache = {}
+
+    def cached(self, key, compute):
+        if key not in self.cache:
+            self.cache[key] = compute()
+        return self.cache[key]
+
+    def column(self, name):
+        # TA-Lib needs contiguous float64 inputs
+        return self.cached(('column', name), lambda: np.ascontiguousarray(self.df[name], dtype=np.float64))
+
+    def ema_chain(self, period, depth):
+        # EMA of the close price applied `depth` times, shared by EMA, DEMA, TEMA and TRIX
+        if depth == 0:
+            return self.column('close')
+        return self.cached(('ema', period, depth), lambda: talib.EMA(self.ema_chain(period, depth - 1), period))
+
+    def rolling_sum(self, name, period):
+        return self.cached(('rolling_sum', name, period),
+                           lambda: pd.Series(self.column(name)).rolling(window=period).sum().to_numpy())
+
+
+def _sma(context, period):
+    return f'sma_{period}', talib.SMA(context.column('close'), period)
+
+
+def _vama(context, period):
+    context.cached(('column', 'volume_price'), lambda: context.column('close') * context.column('volume'))
+    return f'vama_{period}', context.rolling_sum('volume_price', period) / context.rolling_sum('volume', period)
+
+
+def _tema(context, period):
+    ema_1, ema_2, ema_3 = (context.ema_chain(period, depth) for depth in (1, 2, 3))
+    return f'tema_{period}', 3 * ema_1 - 3 * ema_2 + ema_3
+
+
+def _ema(context, period):
+    return f'ema_{period}', context.ema_chain(period, 1)
+
+
+def _dema(context, period):
+    return f'dema_{period}', 2 * context.ema_chain(period, 1) - context.ema_chain(period, 2)
+
+
+def _mom(context, period=10):
+    return f'mom_{period}', talib.MOM(context.column('close'), period)
+
+
+def _macd(context, fast_period=12, slow_period=26, signal_period=9):
+    return (f'macd_{fast_period}_{slow_period}_{signal_period}',
+            talib.MACD(context.column('close'), fast_period, slow_period, signal_period)[0])
+
+
+def _percent_b(context, period=5, stddev_upper=2, stddev_lower=2, ma_type=0):
+    close = context.column('close')
+    upper_band, _, lower_band = talib.BBANDS(close, period, stddev_upper, stddev_lower, ma_type)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        percent_b = (close - lower_band) / (upper_band - lower_band) * 100
+    return f'percent_b_{period}_{stddev_upper}_{stddev_lower}_{ma_type}', percent_b
+
+
+def _chaikin_oscillator(context):
+    return 'chaikin_oscillator', talib.ADOSC(context.column('high'), context.column('low'), context.column('close'),
+                                             context.column('volume'))
+
+
+def _roc(context, period=10):
+    return f'roc_{period}', talib.ROC(context.column('close'), period)
+
+
+def _so(context, fastk_period=5, slow_k_period=3, slow_k_ma_type=0, slow_d_period=3, slow_d_ma_type=0):
+    return (f'so_{fastk_period}_{slow_k_period}_{slow_k_ma_type}_{slow_d_period}_{slow_d_ma_type}',
+            talib.STOCH(context.column('high'), context.column('low'), context.column('close'), fastk_period,
+                        slow_k_period, slow_k_ma_type, slow_d_period, slow_d_ma_type)[0])
+
+
+def _trix(context, period=30):
+    # TA-Lib computes TRIX as the 1-period rate of change of the triple EMA
+    return f'trix_{period}', talib.ROC(context.ema_chain(period, 3), 1)
+
+
+def _rsi(context, period=14):
+    return f'rsi_{period}', talib.RSI(context.column('close'), period)
+
+
+def _williams_percent_r(context, period=14):
+    return f'williams_percent_r_{period}', talib.WILLR(context.column('high'), context.column('low'),
+                                                       context.column('close'), period)
+
+
+def _lagged_values(context, column_name, period):
+    lagged = np.full(len(context.df), np.nan)
+    lagged[period:] = context.column(column_name)[:len(lagged) - period]
+    return f'{column_name}_lagged_{period}', lagged
+
+
+# indicator name of each feature spec to the function computing its column, with the parameters and defaults of its
+# counterpart in `feature_creation`
+FEATURES = {
+    'sma': _sma,
+    'vama': _vama,
+    'tema': _tema,
+    'ema': _ema,
+    'dema': _dema,
+    'mom': _mom,
+    'macd': _macd,
+    'percent_b': _percent_b,
+    'chaikin_oscillator': _chaikin_oscillator,
+    'roc': _roc,
+    'so': _so,
+    'trix': _trix,
+    'rsi': _rsi,
+    'williams_percent_r': _williams_percent_r,
+    'lagged_values': _lagged_values,
+}
+
+
+@stage()
+def compute_features(df, feature_specs, dtype=np.float64):
+    """
+    Compute the features described by a list of specs into a single preallocated array. Intermediate results shared
+    by several features, such as the EMA chains of EMA, DEMA, TEMA and TRIX or the rolling sums of VAMA, are computed
+    only once.
+
+    Args:
+        df (pandas.DataFrame): The input DataFrame containing price and volume data.
+        feature_specs (list): (indicator, params) pairs, where indicator is a key of FEATURES and params is a dict of
+            the keyword arguments of its counterpart in `feature_creation`, e.g. ('sma', {'period': 5}).
+        dtype (numpy.dtype, optional): Data type of the features. Defaults to numpy.float64.
+
+    Returns:
+        pandas.DataFrame: The features, with the same column names as `feature_creation` and the index of `df`,
+        backed by a single array.
+    """
+
+    logger.info(f'Calculating {len(feature_specs)} features')
+
+    context = _FeatureContext(df)
+
+    # column-major, so that every feature is written contiguously and pandas can use the array as its block as is
+    features = np.empty((len(df), len(feature_specs)), dtype=dtype, order='F')
+    names = []
+
+    for i, (indicator, params) in enumerate(feature_specs):
+        name, features[:, i] = FEATURES[indicator](context, **params)
+        names.append(name)
+
+    return pd.DataFrame(features, index=df.index, columns=names, copy=False)
+
+
+def add_features(df, feature_specs, dtype=np.float64):
+    """
+    Compute the features described by a list of specs and attach them to the DataFrame at once. See
+    `compute_features`.
+
+    Args:
+        df (pandas.DataFrame): The input DataFrame containing price and volume data.
+        feature_specs (list): (indicator, params) pairs, see `compute_features`.
+        dtype (numpy.dtype, optional): Data type of the features. Defaults to numpy.float64.
+
+    Returns:
+        pandas.DataFrame: A new DataFrame with the columns of `df` followed by the features.
+    """
+
+    return pd.concat([df, compute_features(df, feature_specs, dtype=dtype)], axis=1)
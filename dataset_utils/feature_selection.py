@@ -1,12 +1,26 @@
+import hashlib
+import json
+import os
+import time
+
 import numpy as np
-import pandas as pd
 from boruta import BorutaPy
+from scipy.linalg import LinAlgError, cho_factor, solve_triangular
 from sklearn.ensemble import RandomForestRegressor
 from sklearn.preprocessing import StandardScaler
 from statsmodels.stats.outliers_influence import variance_inflation_factor
 
+from logger import logger
+from metrics import stage
+
+# VIF cap, as statsmodels clips the R-squared of each auxiliary regression to 1 - 1e-15
+MAX_VIF_VALUE = 1e15
+
 
-def three_step_feature_selection(df, target_column='close', exclude_columns=None, max_correlation=0.95, max_vif=10):
+@stage()
+def three_step_feature_selection(df, target_column='close', exclude_columns=None, max_correlation=0.95, max_vif=10,
+                                 vif_elimination='single', boruta_sample_size=None, boruta_sampling='time_blocked',
+                                 boruta_max_iter=100, boruta_time_budget=None, boruta_cache_directory=None):
     """
     Perform a three-step feature selection process using Boruta, correlation analysis, and Variance Inflation Factor
     (VIF).
@@ -17,6 +31,18 @@ def three_step_feature_selection(df, target_column='close', exclude_columns=None
         exclude_columns (list): List of column names to exclude from feature selection. Default is None.
         max_correlation (float): Maximum allowed correlation between features. Default is 0.95.
         max_vif (float): Maximum allowed Variance Inflation Factor. Default is 10.
+        vif_elimination (str): 'single' to drop every feature whose VIF exceeds max_vif at once, or 'iterative' to drop
+            the feature with the highest VIF and recompute the rest until all of them are below max_vif. Default is
+            'single'.
+        boruta_sample_size (int or float): Number (or fraction, if below 1) of rows Boruta is fitted on. Default is None
+            (every row).
+        boruta_sampling (str): How the Boruta rows are sampled: 'time_blocked' for evenly spaced contiguous blocks of
+            rows, or 'stratified' for a sample preserving the distribution of the target. Default is 'time_blocked'.
+        boruta_max_iter (int): Maximum number of Boruta iterations. Default is 100.
+        boruta_time_budget (float): Maximum wall-clock seconds of Boruta; no new iteration starts once exceeded.
+            Default is None (no limit).
+        boruta_cache_directory (str): Directory caching the Boruta results, keyed by a hash of its input data and
+            parameters. Default is None (no cache).
 
     Returns:
         list: A list of selected feature names after the three-step selection process.
@@ -40,25 +66,29 @@ def three_step_feature_selection(df, target_column='close', exclude_columns=None
     x_scaled = scaler.fit_transform(x)
 
     # Step 1: Boruta feature selection
-    rf = RandomForestRegressor(n_jobs=-1, max_depth=5)
-    boruta_selector = BorutaPy(rf, n_estimators='auto', verbose=2, random_state=1)
-    boruta_selector.fit(x_scaled, y)
+    support = _fit_boruta(x_scaled, y.to_numpy(), x.columns.tolist(), boruta_sample_size, boruta_sampling,
+                          boruta_max_iter, boruta_time_budget, boruta_cache_directory)
 
     # Get selected feature names
-    selected_features = x.columns[boruta_selector.support_].tolist()
+    selected_features = x.columns[support].tolist()
 
     # Step 2: Remove highly correlated features
-    correlation_matrix = x[selected_features].corr().abs()
-    upper_tri = correlation_matrix.where(np.triu(np.ones(correlation_matrix.shape), k=1).astype(bool))
-    to_drop = [column for column in upper_tri.columns if any(upper_tri[column] > max_correlation)]
-    selected_features = [feat for feat in selected_features if feat not in to_drop]
-
-    # Step 3: Filter out variables with high VIF
-    x_vif = x[selected_features]
-    vif_data = pd.DataFrame()
-    vif_data['feature'] = x_vif.columns
-    vif_data['VIF'] = [variance_inflation_factor(x_vif.values, i) for i in range(len(x_vif.columns))]
-    selected_features = vif_data[vif_data['VIF'] <= max_vif]['feature'].tolist()
+    correlation_matrix = _correlation_matrix(x[selected_features].to_numpy(dtype=np.float64))
+    upper_tri = np.triu(np.abs(correlation_matrix), k=1)
+    to_drop = (upper_tri > max_correlation).any(axis=0)
+    kept = np.flatnonzero(~to_drop)
+    selected_features = [selected_features[i] for i in kept]
+
+    # Step 3: Filter out variables with high VIF, reusing the correlation matrix of the remaining features
+    if vif_elimination == 'single':
+        vifs = _variance_inflation_factors(x[selected_features].to_numpy(dtype=np.float64),
+                                           correlation_matrix[np.ix_(kept, kept)])
+        selected_features = [feature for feature, vif in zip(selected_features, vifs) if vif <= max_vif]
+    elif vif_elimination == 'iterative':
+        kept_by_vif = _iterative_vif_elimination(correlation_matrix[np.ix_(kept, kept)], max_vif)
+        selected_features = [selected_features[i] for i in kept_by_vif]
+    else:
+        raise ValueError(f'Unknown VIF elimination: {vif_elimination}')
 
     # Add excluded columns and target column to the selected features
     selected_features.extend(exclude_columns)
@@ -66,3 +96,220 @@ def three_step_feature_selection(df, target_column='close', exclude_columns=None
         selected_features.append(target_column)
 
     return selected_features
+
+
+class _TimeBudgetedBorutaPy(BorutaPy):
+    """
+    BorutaPy that starts no new iteration once its wall-clock budget is exceeded. The tentative features are then
+    resolved as when the maximum number of iterations is reached.
+    """
+
+    def __init__(self, estimator, time_budget=None, **kwargs):
+        super().__init__(estimator, **kwargs)
+        self.time_budget = time_budget
+
+    def fit(self, X, y):
+        self._started_at = time.monotonic()
+        self._iterations = 0
+        max_iter = self.max_iter
+        try:
+            return super().fit(X, y)
+        finally:
+            self.max_iter = max_iter
+
+    def _add_shadows_get_imps(self, X, y, dec_reg):
+        importances = super()._add_shadows_get_imps(X, y, dec_reg)
+
+        # lowering the maximum to the current iteration ends the main loop of BorutaPy after this iteration
+        self._iterations += 1
+        if self.time_budget is not None and time.monotonic() - self._started_at > self.time_budget:
+            logger.info(f'Boruta time budget exceeded after {self._iterations} iterations')
+            self.max_iter = self._iterations
+
+        return importances
+
+
+def _fit_boruta(x, y, feature_names, sample_size, sampling, max_iter, time_budget, cache_directory):
+    """
+    Fit Boruta on a subsample of the rows within an iteration and time budget, reusing cached results if available.
+
+    Args:
+        x (numpy.ndarray): Standardized features.
+        y (numpy.ndarray): Target variable.
+        feature_names (list): Names of the features.
+        sample_size (int or float): Number (or fraction, if below 1) of rows to fit on, or None for every row.
+        sampling (str): 'time_blocked' or 'stratified', see `three_step_feature_selection`.
+        max_iter (int): Maximum number of iterations.
+        time_budget (float): Maximum wall-clock seconds, or None.
+        cache_directory (str): Directory caching the results, or None.
+
+    Returns:
+        numpy.ndarray: Boolean support mask of the selected features.
+    """
+
+    cache_path = None
+    if cache_directory is not None:
+        key = hashlib.sha256()
+        for array in (x, y):
+            key.update(np.ascontiguousarray(array).tobytes())
+        key.update(json.dumps([feature_names, sample_size, sampling, max_iter, time_budget]).encode())
+        cache_path = os.path.join(cache_directory, f'boruta_{key.hexdigest()}.npz')
+
+        if os.path.exists(cache_path):
+            logger.info(f'Loading cached Boruta results from {cache_path}')
+            return np.load(cache_path)['support']
+
+    if sample_size is not None:
+        sample = _sample_rows(y, sample_size, sampling)
+        x, y = x[sample], y[sample]
+
+    logger.info(f'Fitting Boruta on {len(x)} rows')
+
+    rf = RandomForestRegressor(n_jobs=-1, max_depth=5)
+    boruta_selector = _TimeBudgetedBorutaPy(rf, time_budget=time_budget, n_estimators='auto', verbose=2,
+                                            random_state=1, max_iter=max_iter)
+    boruta_selector.fit(x, y)
+
+    if cache_path is not None:
+        os.makedirs(cache_directory, exist_ok=True)
+        np.savez(cache_path, support=boruta_selector.support_, ranking=boruta_selector.ranking_)
+
+    return boruta_selector.support_
+
+
+def _sample_rows(y, sample_size, sampling, n_blocks=10, random_state=1):
+    """
+    Choose the rows of a subsample, in time order.
+
+    Args:
+        y (numpy.ndarray): Target variable.
+        sample_size (int or float): Number (or fraction, if below 1) of rows to sample.
+        sampling (str): 'time_blocked' for `n_blocks` evenly spaced contiguous blocks of rows, which keeps the local
+            time structure of the features, or 'stratified' for a random sample with the same number of rows in each
+            decile of the target.
+        n_blocks (int, optional): Number of blocks of the 'time_blocked' sampling. Defaults to 10.
+        random_state (int, optional): Seed of the 'stratified' sampling. Defaults to 1.
+
+    Returns:
+        numpy.ndarray: Sorted indices of the sampled rows.
+    """
+
+    n_rows = len(y)
+    if sample_size < 1:
+        sample_size = int(n_rows * sample_size)
+    sample_size = min(int(sample_size), n_rows)
+
+    if sampling == 'time_blocked':
+        block_size = -(-sample_size // n_blocks)
+        starts = np.linspace(0, n_rows - block_size, n_blocks).astype(int)
+        return np.unique(np.concatenate([np.arange(start, start + block_size) for start in starts]))[:sample_size]
+
+    if sampling == 'stratified':
+        rng = np.random.default_rng(random_state)
+        deciles = np.searchsorted(np.quantile(y, np.linspace(0.1, 0.9, 9)), y)
+        sample = [rng.choice(np.flatnonzero(deciles == decile),
+                             size=min(round(sample_size * np.mean(deciles == decile)), np.sum(deciles == decile)),
+                             replace=False)
+                  for decile in np.unique(deciles)]
+        return np.sort(np.concatenate(sample))
+
+    raise ValueError(f'Unknown Boruta sampling: {sampling}')
+
+
+def _correlation_matrix(x):
+    """
+    Compute the Pearson correlation matrix of the columns of an array. Constant columns get NaN correlations.
+
+    Args:
+        x (numpy.ndarray): 2-D array with one feature per column.
+
+    Returns:
+        numpy.ndarray: The correlation matrix.
+    """
+
+    centered = x - x.mean(axis=0)
+    norms = np.sqrt(np.einsum('ij,ij->j', centered, centered))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        correlation_matrix = (centered.T @ centered) / np.outer(norms, norms)
+
+    return np.clip(correlation_matrix, -1, 1)
+
+
+def _inverse_cholesky_factor(correlation_matrix):
+    """
+    Compute the inverse of the lower Cholesky factor of a correlation matrix.
+
+    Args:
+        correlation_matrix (numpy.ndarray): Symmetric positive definite matrix.
+
+    Returns:
+        numpy.ndarray: The inverse of L, where correlation_matrix = L @ L.T, or None if the matrix is not positive
+        definite (e.g. perfectly collinear or constant features).
+    """
+
+    if not np.isfinite(correlation_matrix).all():
+        return None
+
+    try:
+        lower, _ = cho_factor(correlation_matrix, lower=True)
+    except LinAlgError:
+        return None
+
+    return solve_triangular(np.tril(lower), np.eye(len(correlation_matrix)), lower=True)
+
+
+def _variance_inflation_factors(x, correlation_matrix):
+    """
+    Compute the Variance Inflation Factor of every feature from the diagonal of the inverse correlation matrix, with a
+    single Cholesky factorization. This is the VIF that statsmodels computes with one auxiliary regression per feature
+    over the standardized features, which is used as a fallback when the matrix is not positive definite.
+
+    Args:
+        x (numpy.ndarray): 2-D array with one feature per column.
+        correlation_matrix (numpy.ndarray): Correlation matrix of the columns of x.
+
+    Returns:
+        numpy.ndarray: The VIF of each feature.
+    """
+
+    inverse_factor = _inverse_cholesky_factor(correlation_matrix)
+    if inverse_factor is None:
+        return np.array([variance_inflation_factor(x, i) for i in range(x.shape[1])])
+
+    # diag(inv(L @ L.T)) = squared column norms of inv(L)
+    return np.clip(np.einsum('ij,ij->j', inverse_factor, inverse_factor), 1, MAX_VIF_VALUE)
+
+
+def _iterative_vif_elimination(correlation_matrix, max_vif):
+    """
+    Drop the feature with the highest Variance Inflation Factor until every VIF is below the maximum. The inverse
+    correlation matrix is downdated with a rank-one Schur complement after each drop, instead of being recomputed.
+
+    Args:
+        correlation_matrix (numpy.ndarray): Correlation matrix of the features.
+        max_vif (float): Maximum allowed Variance Inflation Factor.
+
+    Returns:
+        list: Indices of the features that are kept, in their original order.
+    """
+
+    inverse_factor = _inverse_cholesky_factor(correlation_matrix)
+    if inverse_factor is None:
+        inverse_correlation = np.linalg.pinv(correlation_matrix)
+    else:
+        inverse_correlation = inverse_factor.T @ inverse_factor
+
+    kept = list(range(len(correlation_matrix)))
+    while kept:
+        vifs = np.diag(inverse_correlation)
+        worst = int(np.argmax(vifs))
+        if vifs[worst] <= max_vif:
+            break
+
+        # inverse of the correlation matrix without the worst feature
+        others = np.arange(len(kept)) != worst
+        column = inverse_correlation[others, worst]
+        inverse_correlation = inverse_correlation[np.ix_(others, others)] - np.outer(column, column) / vifs[worst]
+        del kept[worst]
+
+    return kept
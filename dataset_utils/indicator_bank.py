@@ -0,0 +1,165 @@
+import numpy as np
+import pandas as pd
+from scipy.signal import lfilter
+
+from logger import logger
+from metrics import stage
+
+
+def _prefix_sums(values):
+    # prefix sums with a leading zero, so that the sum of values[i - period:i] is sums[i] - sums[i - period]; the
+    # values are offset by their first one to keep the sums small and the differences precise
+    sums = np.empty(len(values) + 1)
+    sums[0] = 0
+    np.cumsum(values - values[0] if len(values) else values, out=sums[1:])
+    return sums
+
+
+def _window_sums(sums, period, offset):
+    # sums of every complete window of `period` values, with `offset` times the offset removed by `_prefix_sums`
+    return sums[period:] - sums[:-period] + period * offset
+
+
+def _exponential_smoothing(values, alpha, seed, start, out):
+    # out[start] = seed and out[i] = alpha * values[i] + (1 - alpha) * out[i - 1] afterwards, as a single linear filter
+    out[:start] = np.nan
+    out[start] = seed
+    out[start + 1:] = lfilter([alpha], [1, alpha - 1], values[start + 1:], zi=[(1 - alpha) * seed])[0]
+
+
+def _sma_bank(columns, periods, out):
+    close = columns('close')
+    sums = _prefix_sums(close)
+    for i, period in enumerate(periods):
+        out[:period - 1, i] = np.nan
+        out[period - 1:, i] = _window_sums(sums, period, close[0]) / period
+
+
+def _vama_bank(columns, periods, out):
+    close, volume = columns('close'), columns('volume')
+    volume_price_sums, volume_sums = _prefix_sums(close * volume), _prefix_sums(volume)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for i, period in enumerate(periods):
+            out[:period - 1, i] = np.nan
+            out[period - 1:, i] = (_window_sums(volume_price_sums, period, close[0] * volume[0])
+                                   / _window_sums(volume_sums, period, volume[0]))
+
+
+def _mom_bank(columns, periods, out):
+    close = columns('close')
+    for i, period in enumerate(periods):
+        out[:period, i] = np.nan
+        np.subtract(close[period:], close[:-period], out=out[period:, i])
+
+
+def _roc_bank(columns, periods, out):
+    close = columns('close')
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for i, period in enumerate(periods):
+            out[:period, i] = np.nan
+            out[period:, i] = (close[period:] / close[:-period] - 1) * 100
+
+
+def _ema_bank(columns, periods, out):
+    # seeded with the SMA of the first `period` values, as TA-Lib does
+    close = columns('close')
+    for i, period in enumerate(periods):
+        if period > len(close):
+            out[:, i] = np.nan
+            continue
+        _exponential_smoothing(close, 2 / (period + 1), close[:period].mean(), period - 1, out[:, i])
+
+
+def _rsi_bank(columns, periods, out):
+    # Wilder's smoothing of the gains and losses, seeded with their mean over the first `period` changes, as TA-Lib
+    # does; the changes are shared by every period
+    close = columns('close')
+    changes = np.diff(close, prepend=np.nan)
+    gains, losses = np.maximum(changes, 0), np.maximum(-changes, 0)
+    average_gains, average_losses = np.empty(len(close)), np.empty(len(close))
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for i, period in enumerate(periods):
+            if period >= len(close):
+                out[:, i] = np.nan
+                continue
+            _exponential_smoothing(gains, 1 / period, gains[1:period + 1].mean(), period, average_gains)
+            _exponential_smoothing(losses, 1 / period, losses[1:period + 1].mean(), period, average_losses)
+            total = average_gains + average_losses
+            out[:, i] = np.where(total == 0, 0, 100 * average_gains / total)
+            out[:period, i] = np.nan
+
+
+# indicator family of each bank spec to the function computing its columns, named as in `feature_creation`
+BANKS = {
+    'sma': _sma_bank,
+    'vama': _vama_bank,
+    'mom': _mom_bank,
+    'roc': _roc_bank,
+    'ema': _ema_bank,
+    'rsi': _rsi_bank,
+}
+
+
+@stage()
+def compute_indicator_bank(df, bank_specs, keep_columns=(), dtype=np.float64):
+    """
+    Compute indicator families over many periods at once into a single preallocated (time x period) array, e.g. to
+    sweep every period from 2 to 200 before feature selection.
+
+    SMA and VAMA come from prefix sums of their inputs shared by every period, MOM and ROC from shifted differences,
+    and EMA and RSI from a single linear filter per period seeded like TA-Lib. The columns match the ones of
+    `feature_creation` up to rounding errors.
+
+    With the target and the excluded columns in `keep_columns`, the result goes straight to
+    `feature_selection.three_step_feature_selection`, without a column insert per indicator.
+
+    Args:
+        df (pandas.DataFrame): The input DataFrame containing price and volume data.
+        bank_specs (list): (family, periods) pairs, where family is a key of BANKS and periods is an iterable of
+            positive integers, e.g. ('sma', range(2, 201)).
+        keep_columns (iterable, optional): Columns of `df` copied in front of the indicators, e.g. ['close', 'up'].
+            Defaults to none.
+        dtype (numpy.dtype, optional): Data type of the result. Defaults to numpy.float64.
+
+    Returns:
+        pandas.DataFrame: The kept columns followed by the indicators, with the same column names as
+        `feature_creation` (e.g. "sma_5") and the index of `df`, backed by a single array.
+    """
+
+    bank_specs = [(family, [int(period) for period in periods]) for family, periods in bank_specs]
+    keep_columns = list(keep_columns)
+    n_indicators = sum(len(periods) for _, periods in bank_specs)
+
+    logger.info(f'Calculating {n_indicators} indicators in {len(bank_specs)} banks')
+
+    for family, periods in bank_specs:
+        if family not in BANKS:
+            raise ValueError(f'Unknown indicator bank: {family}')
+        if any(period < 1 for period in periods):
+            raise ValueError(f'The periods of the {family} bank must be positive')
+
+    inputs = {}
+
+    def columns(name):
+        if name not in inputs:
+            inputs[name] = np.ascontiguousarray(df[name], dtype=np.float64)
+        return inputs[name]
+
+    # column-major, so that every period is written contiguously and pandas can use the array as its block as is
+    values = np.empty((len(df), len(keep_columns) + n_indicators), dtype=dtype, order='F')
+    values[:, :len(keep_columns)] = df[keep_columns].to_numpy(dtype=dtype)
+    names = list(keep_columns)
+
+    start = len(keep_columns)
+    for family, periods in bank_specs:
+        end = start + len(periods)
+        if len(df) > 0:
+            # the banks are computed in float64 and only then converted
+            out = values[:, start:end] if values.dtype == np.float64 else np.empty((len(df), len(periods)), order='F')
+            BANKS[family](columns, periods, out)
+            values[:, start:end] = out
+        names.extend(f'{family}_{period}' for period in periods)
+        start = end
+
+    return pd.DataFrame(values, index=df.index, columns=names, copy=False)
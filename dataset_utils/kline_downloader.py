@@ -0,0 +1,176 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from binance.exceptions import BinanceAPIException, BinanceRequestException
+from binance.helpers import interval_to_milliseconds
+from requests.adapters import HTTPAdapter
+from requests.exceptions import RequestException
+
+from logger import logger
+from metrics import stage
+
+# maximum number of klines returned by a single request
+KLINES_PER_REQUEST = 1000
+
+# request weight of a klines request, and default weight budget of the Binance spot API
+KLINES_REQUEST_WEIGHT = 2
+DEFAULT_WEIGHT_PER_MINUTE = 6000
+
+
+class RequestWeightLimiter:
+    """
+    Thread-safe token bucket sharing a request weight budget among concurrent requests.
+
+    The bucket refills continuously at `weight_per_minute` per minute, up to `weight_per_minute`. When the server
+    answers with a rate limit error, `pause` stops every request until the given time has passed.
+
+    Args:
+        weight_per_minute (int, optional): Weight budget per minute. Defaults to DEFAULT_WEIGHT_PER_MINUTE.
+    """
+
+    def __init__(self, weight_per_minute=DEFAULT_WEIGHT_PER_MINUTE):
+        self.weight_per_minute = weight_per_minute
+        self._available_weight = weight_per_minute
+        self._updated_at = time.monotonic()
+        self._paused_until = 0
+        self._lock = threading.Lock()
+
+    def acquire(self, weight):
+        """
+        Block until `weight` is available in the budget, then consume it.
+
+        Args:
+            weight (int): Weight of the request about to be sent.
+        """
+
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._available_weight = min(self.weight_per_minute, self._available_weight + (
+                        now - self._updated_at) * self.weight_per_minute / 60)
+                self._updated_at = now
+
+                wait = self._paused_until - now
+                if wait <= 0:
+                    if self._available_weight >= weight:
+                        self._available_weight -= weight
+                        return
+                    wait = (weight - self._available_weight) * 60 / self.weight_per_minute
+
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        """
+        Stop every request for the given time and empty the budget, as requested by a rate limit error.
+
+        Args:
+            seconds (float): Time to wait before sending any other request.
+        """
+
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            self._available_weight = 0
+
+
+# budget shared by every download in the process unless another one is given
+default_limiter = RequestWeightLimiter()
+
+
+def split_into_chunks(interval, start_timestamp_millis, end_timestamp_millis):
+    """
+    Split a time range into chunks aligned to the kline pages, so that each chunk is fetched with a single request.
+
+    Args:
+        interval (str): Duration of each candlestick.
+        start_timestamp_millis (int): Start of the time range in Unix timestamp milliseconds.
+        end_timestamp_millis (int): End of the time range in Unix timestamp milliseconds (inclusive).
+
+    Returns:
+        list: (start, end) pairs in Unix timestamp milliseconds, both inclusive, in time order.
+    """
+
+    interval_millis = interval_to_milliseconds(interval)
+    page_millis = KLINES_PER_REQUEST * interval_millis
+
+    # the first kline opening at or after the start
+    first_open_time = -(-start_timestamp_millis // interval_millis) * interval_millis
+
+    return [(chunk_start, min(chunk_start + page_millis - 1, end_timestamp_millis))
+            for chunk_start in range(first_open_time, end_timestamp_millis + 1, page_millis)]
+
+
+@stage()
+def download_klines_concurrently(client, symbols, interval, start_timestamp_millis, end_timestamp_millis,
+                                 max_workers=8, limiter=None, max_retries=5, backoff_seconds=1):
+    """
+    Download the klines of several symbols by fetching page-aligned chunks of their time range concurrently.
+
+    Every request waits for the shared weight budget. Rate limited requests pause the whole budget for the time
+    requested by the server, and failed requests are retried with exponential backoff.
+
+    Args:
+        client (binance.Client): Client used to download the klines.
+        symbols (list): The currency pairs to download data for.
+        interval (str): Duration of each candlestick.
+        start_timestamp_millis (int): Start of the time range in Unix timestamp milliseconds.
+        end_timestamp_millis (int): End of the time range in Unix timestamp milliseconds (inclusive).
+        max_workers (int, optional): Maximum number of concurrent requests. Defaults to 8.
+        limiter (RequestWeightLimiter, optional): Weight budget shared by the requests. Defaults to the budget shared
+            by the whole process.
+        max_retries (int, optional): Maximum number of retries of each chunk. Defaults to 5.
+        backoff_seconds (float, optional): Wait before the first retry of a failed chunk, doubled on each retry.
+            Defaults to 1.
+
+    Returns:
+        dict: Symbol to its klines in the Binance REST API format, sorted by open time and without duplicates.
+    """
+
+    logger.info(f'Downloading {interval} klines of {len(symbols)} symbols with {max_workers} workers')
+
+    if limiter is None:
+        limiter = default_limiter
+
+    # let every worker keep its own connection open
+    if hasattr(client, 'session'):
+        for prefix in ('http://', 'https://'):
+            client.session.mount(prefix, HTTPAdapter(pool_maxsize=max_workers))
+
+    def fetch(symbol, chunk_start, chunk_end, limit=KLINES_PER_REQUEST):
+        for attempt in range(max_retries + 1):
+            limiter.acquire(KLINES_REQUEST_WEIGHT)
+            try:
+                return client.get_klines(symbol=symbol, interval=interval, startTime=chunk_start, endTime=chunk_end,
+                                         limit=limit)
+            except BinanceAPIException as exception:
+                if attempt == max_retries or not (exception.status_code in (418, 429) or exception.status_code >= 500):
+                    raise
+                if exception.status_code in (418, 429):
+                    limiter.pause(float(exception.response.headers.get('Retry-After', backoff_seconds)))
+                    continue
+            except (BinanceRequestException, RequestException):
+                if attempt == max_retries:
+                    raise
+
+            time.sleep(backoff_seconds * 2 ** attempt)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # skip the time before each symbol was listed, finding its first kline with a single request
+        first_candles = dict(zip(symbols, executor.map(
+            lambda symbol: fetch(symbol, start_timestamp_millis, end_timestamp_millis, limit=1), symbols)))
+
+        chunks = [(symbol, chunk_start, chunk_end)
+                  for symbol in symbols if first_candles[symbol]
+                  for chunk_start, chunk_end in split_into_chunks(interval, first_candles[symbol][0][0],
+                                                                  end_timestamp_millis)]
+        chunk_candles = executor.map(lambda chunk: fetch(*chunk), chunks)
+
+        # reassemble the chunks in order, dropping any kline already seen
+        candles = {symbol: [] for symbol in symbols}
+        for (symbol, _, _), chunk in zip(chunks, chunk_candles):
+            symbol_candles = candles[symbol]
+            for candle in chunk:
+                if not symbol_candles or candle[0] > symbol_candles[-1][0]:
+                    symbol_candles.append(candle)
+
+    return candles
@@ -0,0 +1,294 @@
+import io
+import json
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+from config import default_dataset_directory
+from dataset_utils.dataset_generation import KLINE_COLUMNS, get_kline_dtypes, klines_to_arrays
+from dataset_utils.kline_downloader import download_klines_concurrently
+from logger import logger
+from metrics import stage
+
+
+class KlineStore:
+    """
+    On-disk columnar store of klines, keyed by (symbol, interval).
+
+    Every (symbol, interval) pair is a directory holding one `.npy` file per column, sorted by 'open_time', plus a
+    `metadata.json` file recording the time range already downloaded and the number of rows stored. Columns are
+    memory-mapped when read, so serving a time range only touches the rows within it.
+
+    The metadata is the commit point of every insertion: klines after the last stored one are appended in place to
+    the column files, and are only read once the metadata counts them, while any other insertion writes a new
+    generation of the column files and then switches the metadata to it. Either way, an interrupted insertion leaves
+    the previous klines readable as they were. Columns are stored with the compact data types of
+    `dataset_generation.get_kline_dtypes` unless the store is created with high precision.
+
+    Args:
+        directory (str, optional): Root directory of the store. Defaults to the 'klines' directory inside the default
+            dataset directory.
+        high_precision (bool, optional): Whether prices and volumes are stored as float64 instead of float32.
+            Defaults to False.
+    """
+
+    def __init__(self, directory=None, high_precision=False):
+        self.directory = directory if directory is not None else os.path.join(default_dataset_directory, 'klines')
+        self.high_precision = high_precision
+        self.dtypes = get_kline_dtypes(high_precision)
+
+    def coverage(self, symbol, interval):
+        """
+        Get the time range already downloaded for a symbol and interval.
+
+        Args:
+            symbol (str): The currency pair.
+            interval (str): Duration of each candlestick.
+
+        Returns:
+            tuple: (start, end) in Unix timestamp milliseconds, both inclusive, or None if nothing is stored.
+        """
+
+        metadata = self._metadata(symbol, interval)
+        if metadata is None:
+            return None
+
+        return metadata['start'], metadata['end']
+
+    def missing_ranges(self, symbol, interval, start_timestamp_millis, end_timestamp_millis):
+        """
+        Get the time ranges that must be downloaded to serve [start, end] from the store.
+
+        Args:
+            symbol (str): The currency pair.
+            interval (str): Duration of each candlestick.
+            start_timestamp_millis (int): Start of the time range in Unix timestamp milliseconds.
+            end_timestamp_millis (int): End of the time range in Unix timestamp milliseconds.
+
+        Returns:
+            list: (start, end) pairs in Unix timestamp milliseconds, both inclusive.
+        """
+
+        coverage = self.coverage(symbol, interval)
+        if coverage is None:
+            return [(start_timestamp_millis, end_timestamp_millis)]
+
+        covered_start, covered_end = coverage
+        missing = []
+        if start_timestamp_millis < covered_start:
+            missing.append((start_timestamp_millis, covered_start - 1))
+        if end_timestamp_millis > covered_end:
+            missing.append((covered_end + 1, end_timestamp_millis))
+
+        return missing
+
+    @stage()
+    def update(self, client, symbol, interval, start_timestamp_millis, end_timestamp_millis, max_workers=None):
+        """
+        Download the klines missing to serve [start, end] from the store and add them to it. Klines that are still
+        open are not stored, so they are downloaded again once closed.
+
+        Args:
+            client (binance.Client): Client used to download the klines.
+            symbol (str): The currency pair.
+            interval (str): Duration of each candlestick.
+            start_timestamp_millis (int): Start of the time range in Unix timestamp milliseconds.
+            end_timestamp_millis (int): End of the time range in Unix timestamp milliseconds.
+            max_workers (int, optional): If given, the klines are downloaded in concurrent chunks with this maximum
+                number of concurrent requests. Defaults to None (serial download).
+        """
+
+        for missing_start, missing_end in self.missing_ranges(symbol, interval, start_timestamp_millis,
+                                                              end_timestamp_millis):
+            logger.info(f'Downloading {symbol} {interval} klines from {missing_start} to {missing_end}')
+
+            now_millis = int(time.time() * 1000)
+            if max_workers is None:
+                candles = client.get_historical_klines(symbol=symbol, interval=interval, start_str=missing_start,
+                                                       end_str=missing_end)
+            else:
+                candles = download_klines_concurrently(client, [symbol], interval, missing_start, missing_end,
+                                                       max_workers=max_workers)[symbol]
+
+            # discard the klines that are not closed yet, and do not consider their time range as covered
+            closed_candles = [candle for candle in candles if candle[6] < now_millis]
+            covered_end = min(missing_end, now_millis)
+            if len(closed_candles) < len(candles):
+                covered_end = min(covered_end, candles[len(closed_candles)][0] - 1)
+
+            self.insert(symbol, interval, klines_to_arrays(closed_candles, high_precision=self.high_precision),
+                        missing_start, covered_end)
+
+    def insert(self, symbol, interval, columns, covered_start, covered_end):
+        """
+        Insert klines into the store and extend its downloaded time range. The new time range must overlap or be
+        adjacent to the stored one. Klines opening after the last stored one are appended without rewriting the
+        stored ones.
+
+        Args:
+            symbol (str): The currency pair.
+            interval (str): Duration of each candlestick.
+            columns (dict): Column name to numpy.ndarray, with every column in KLINE_COLUMNS.
+            covered_start (int): Start of the time range the klines were downloaded for, in milliseconds.
+            covered_end (int): End of the time range the klines were downloaded for, in milliseconds.
+        """
+
+        metadata = self._metadata(symbol, interval)
+
+        # sort the new klines by open time and drop their duplicates
+        _, unique_indices = np.unique(columns['open_time'], return_index=True)
+        columns = {column: np.asarray(columns[column])[unique_indices].astype(self.dtypes[column], copy=False)
+                   for column in KLINE_COLUMNS}
+
+        if metadata is None:
+            self._write_generation(symbol, interval, columns, covered_start, covered_end, generation=0)
+            return
+
+        covered_start, covered_end = min(covered_start, metadata['start']), max(covered_end, metadata['end'])
+        stored = self.columns(symbol, interval)
+        stored_rows = len(stored['open_time'])
+
+        if stored_rows == 0 or len(columns['open_time']) == 0 or \
+                columns['open_time'][0] > stored['open_time'][-1]:
+            if self._append(symbol, interval, metadata, columns, stored_rows):
+                self._write_metadata(symbol, interval, {**metadata, 'start': int(covered_start),
+                                                        'end': int(covered_end),
+                                                        'rows': stored_rows + len(columns['open_time'])})
+                return
+
+        # the klines overlap or precede the stored ones, so every column is rewritten
+        columns = {column: np.concatenate([stored[column], columns[column]]) for column in KLINE_COLUMNS}
+        _, unique_indices = np.unique(columns['open_time'], return_index=True)
+        del stored
+        self._write_generation(symbol, interval, {column: values[unique_indices] for column, values in columns.items()},
+                               covered_start, covered_end, generation=metadata.get('generation', 0) + 1,
+                               previous_generation=metadata.get('generation', 0))
+
+    @stage()
+    def load(self, symbol, interval, start_timestamp_millis=None, end_timestamp_millis=None):
+        """
+        Read the stored klines opening within [start, end] as a DataFrame.
+
+        Args:
+            symbol (str): The currency pair.
+            interval (str): Duration of each candlestick.
+            start_timestamp_millis (int, optional): Start of the time range in Unix timestamp milliseconds.
+            end_timestamp_millis (int, optional): End of the time range in Unix timestamp milliseconds.
+
+        Returns:
+            pandas.DataFrame: The klines, with the columns in KLINE_COLUMNS.
+        """
+
+        if self.coverage(symbol, interval) is None:
+            return pd.DataFrame({column: [] for column in KLINE_COLUMNS})
+
+        columns = self.columns(symbol, interval)
+
+        # locate the time range with a binary search over the sorted open times
+        open_time = columns['open_time']
+        start_index = 0 if start_timestamp_millis is None else np.searchsorted(open_time, start_timestamp_millis)
+        end_index = len(open_time) if end_timestamp_millis is None else np.searchsorted(open_time,
+                                                                                        end_timestamp_millis,
+                                                                                        side='right')
+
+        return pd.DataFrame({column: np.array(values[start_index:end_index]) for column, values in columns.items()})
+
+    def columns(self, symbol, interval):
+        """
+        Memory-map every stored column of a symbol and interval, without reading them.
+
+        Args:
+            symbol (str): The currency pair.
+            interval (str): Duration of each candlestick.
+
+        Returns:
+            dict: Column name to read-only memory-mapped numpy.ndarray, sorted by open time.
+        """
+
+        metadata = self._metadata(symbol, interval)
+        generation = metadata.get('generation', 0)
+
+        # rows past the ones counted by the metadata belong to an interrupted append
+        return {column: np.load(self._column_path(symbol, interval, column, generation),
+                                mmap_mode='r')[:metadata.get('rows')]
+                for column in KLINE_COLUMNS}
+
+    def _pair_directory(self, symbol, interval):
+        return os.path.join(self.directory, symbol, interval)
+
+    def _column_path(self, symbol, interval, column, generation=0):
+        suffix = f'.{generation}' if generation else ''
+        return os.path.join(self._pair_directory(symbol, interval), f'{column}{suffix}.npy')
+
+    def _metadata(self, symbol, interval):
+        metadata_path = os.path.join(self._pair_directory(symbol, interval), 'metadata.json')
+        if not os.path.exists(metadata_path):
+            return None
+
+        with open(metadata_path) as metadata_file:
+            return json.load(metadata_file)
+
+    def _write_metadata(self, symbol, interval, metadata):
+        # replaced atomically, as the commit point of every insertion
+        metadata_path = os.path.join(self._pair_directory(symbol, interval), 'metadata.json')
+        with open(f'{metadata_path}.tmp', 'w') as metadata_file:
+            json.dump(metadata, metadata_file)
+        os.replace(f'{metadata_path}.tmp', metadata_path)
+
+    def _write_generation(self, symbol, interval, columns, covered_start, covered_end, generation,
+                          previous_generation=None):
+        os.makedirs(self._pair_directory(symbol, interval), exist_ok=True)
+        for column in KLINE_COLUMNS:
+            np.save(self._column_path(symbol, interval, column, generation), columns[column])
+
+        self._write_metadata(symbol, interval, {'start': int(covered_start), 'end': int(covered_end),
+                                                'rows': len(columns['open_time']), 'generation': generation})
+
+        if previous_generation is not None:
+            for column in KLINE_COLUMNS:
+                os.remove(self._column_path(symbol, interval, column, previous_generation))
+
+    def _append(self, symbol, interval, metadata, columns, stored_rows):
+        """
+        Append klines to the column files after their first `stored_rows` rows, overwriting the rows of any
+        interrupted append, and update the shape in their headers. The metadata must be updated afterwards for the
+        klines to be read.
+
+        Returns:
+            bool: Whether the klines were appended, which fails without writing anything if a header would grow.
+        """
+
+        generation = metadata.get('generation', 0)
+        rows = stored_rows + len(columns['open_time'])
+
+        # new headers of every column first, so that nothing is written unless all of them fit in place
+        headers = {}
+        for column in KLINE_COLUMNS:
+            with open(self._column_path(symbol, interval, column, generation), 'rb') as npy_file:
+                version = np.lib.format.read_magic(npy_file)
+                read_header = np.lib.format.read_array_header_1_0 if version == (1, 0) else \
+                    np.lib.format.read_array_header_2_0
+                _, fortran_order, dtype = read_header(npy_file)
+                header_length = npy_file.tell()
+
+            header = io.BytesIO()
+            write_header = np.lib.format.write_array_header_1_0 if version == (1, 0) else \
+                np.lib.format.write_array_header_2_0
+            write_header(header, {'descr': np.lib.format.dtype_to_descr(dtype), 'fortran_order': fortran_order,
+                                  'shape': (rows,)})
+            if header.tell() != header_length or dtype != columns[column].dtype:
+                return False
+            headers[column] = (header.getvalue(), header_length, dtype)
+
+        for column, (header, header_length, dtype) in headers.items():
+            with open(self._column_path(symbol, interval, column, generation), 'r+b') as npy_file:
+                npy_file.seek(header_length + stored_rows * dtype.itemsize)
+                npy_file.write(np.ascontiguousarray(columns[column]).tobytes())
+                npy_file.truncate()
+                npy_file.seek(0)
+                npy_file.write(header)
+
+        return True
+
@@ -0,0 +1,282 @@
+import asyncio
+import inspect
+import json
+import math
+
+import numpy as np
+from binance.exceptions import BinanceAPIException, BinanceRequestException
+from binance.helpers import interval_to_milliseconds
+from requests.exceptions import RequestException
+from websockets.asyncio.client import connect
+from websockets.exceptions import WebSocketException
+
+from dataset_utils.dataset_generation import KLINE_COLUMNS, download_raw_dataset
+from dataset_utils.resampling import interval_open_times
+from dataset_utils.streaming_features import RingBuffer
+from logger import logger
+
+BINANCE_STREAM_URL = 'wss://stream.binance.com:9443'
+
+# field of each kline column in the kline stream events
+KLINE_STREAM_FIELDS = {
+    'open_time': 't',
+    'open': 'o',
+    'high': 'h',
+    'low': 'l',
+    'close': 'c',
+    'volume': 'v',
+    'quote_asset_volume': 'q',
+    'number_of_trades': 'n',
+    'taker_buy_base_asset_volume': 'V',
+    'taker_buy_quote_asset_volume': 'Q',
+}
+
+
+def kline_event_to_candle(kline):
+    """
+    Convert the kline of a kline stream event into a candle with the columns of the downloaded datasets.
+
+    Args:
+        kline (dict): The 'k' object of the event.
+
+    Returns:
+        dict: Column name to value, for every column in KLINE_COLUMNS.
+    """
+
+    return {column: float(kline[KLINE_STREAM_FIELDS[column]]) for column in KLINE_COLUMNS}
+
+
+class _SymbolState:
+    """
+    Live state of a symbol: its streaming features and the ring buffers of its latest feature vectors and labels.
+    """
+
+    def __init__(self, feature_engine, window_size, forecast_horizon, forecast_gap):
+        self.feature_engine = feature_engine
+        self.features = RingBuffer(window_size, len(feature_engine.feature_names), fill_value=math.nan)
+        self.labels = RingBuffer(window_size, fill_value=math.nan)
+        self.closes = RingBuffer(forecast_horizon + forecast_gap + 1)
+        self.last_open_time = None
+
+
+class LiveKlineIngestion:
+    """
+    Asyncio service ingesting the kline streams of several symbols over a single multiplexed websocket connection.
+
+    Every closed candle updates the streaming features of its symbol, which are appended to a fixed-size ring buffer,
+    and labels the candle `forecast_horizon + forecast_gap` candles before it as `feature_creation.add_class_up` does.
+    The latest window of feature vectors is always available without copying through `latest_window`. Candles
+    received again after a reconnection are ignored, and the candles that closed while the connection was down are
+    downloaded over REST and ingested before the next live one, so that the features and labels never skip a candle
+    the exchange has. If the download fails, the live candle is dropped as well and the next one retries the gap.
+
+    Args:
+        symbols (list): The currency pairs to ingest.
+        interval (str): Duration of each candlestick.
+        create_feature_engine (callable): Function returning a new `streaming_features.StreamingFeatureEngine`, called
+            once per symbol, e.g. `tripathi_and_sharma.create_streaming_feature_engine`.
+        window_size (int): Number of feature vectors and labels kept per symbol.
+        forecast_horizon (int, optional): Forecast horizon of the labels. Defaults to 1.
+        forecast_gap (int, optional): Forecast gap of the labels. Defaults to 0.
+        trading_fee_percentage (float, optional): Fee as a percentage of the asset purchased, used in the labels.
+            Defaults to 0.1.
+        url (str, optional): Base URL of the streams. Defaults to BINANCE_STREAM_URL.
+        on_candle (callable, optional): Function or coroutine function called with the symbol and its latest window
+            after every closed candle. Defaults to None.
+        reconnect_seconds (float, optional): Wait before reconnecting after the connection is lost. Defaults to 1.
+        client (binance.Client, optional): Client used to download the missed candles. Created only when needed if
+            not given.
+        store (dataset_utils.kline_store.KlineStore, optional): Store the missed candles are read from and downloaded
+            into. Defaults to None (downloaded directly).
+    """
+
+    def __init__(self, symbols, interval, create_feature_engine, window_size, forecast_horizon=1, forecast_gap=0,
+                 trading_fee_percentage=0.1, url=BINANCE_STREAM_URL, on_candle=None, reconnect_seconds=1, client=None,
+                 store=None):
+        self.symbols = symbols
+        self.interval = interval
+        self.window_size = window_size
+        self.forecast_horizon = forecast_horizon
+        self.forecast_gap = forecast_gap
+        self.fee_factor = (1 - trading_fee_percentage / 100) ** 2
+        self.url = url
+        self.on_candle = on_candle
+        self.reconnect_seconds = reconnect_seconds
+        self.client = client
+        self.store = store
+        self.states = {symbol: _SymbolState(create_feature_engine(), window_size, forecast_horizon, forecast_gap)
+                       for symbol in symbols}
+        self._stopped = False
+        self._websocket = None
+
+    @property
+    def stream_url(self):
+        """
+        str: URL of the combined stream of every symbol.
+        """
+
+        streams = '/'.join(f'{symbol.lower()}@kline_{self.interval}' for symbol in self.symbols)
+        return f'{self.url}/stream?streams={streams}'
+
+    def feature_names(self, symbol):
+        """
+        Get the names of the features of a symbol.
+
+        Args:
+            symbol (str): The currency pair.
+
+        Returns:
+            list: Names of the columns of `latest_window`.
+        """
+
+        return self.states[symbol].feature_engine.feature_names
+
+    def latest_window(self, symbol):
+        """
+        Get the feature vectors of the latest closed candles of a symbol.
+
+        Args:
+            symbol (str): The currency pair.
+
+        Returns:
+            numpy.ndarray: Read-only view with shape (candles, features), oldest first, of at most `window_size`
+            candles. The view is only valid until the next candle of the symbol is ingested.
+        """
+
+        return self.states[symbol].features.window
+
+    def latest_labels(self, symbol):
+        """
+        Get the labels of the latest closed candles of a symbol, aligned with `latest_window`.
+
+        Args:
+            symbol (str): The currency pair.
+
+        Returns:
+            numpy.ndarray: Read-only view of the labels, NaN for the candles whose forecast window is not over yet.
+        """
+
+        return self.states[symbol].labels.window
+
+    def warm_start(self, symbol, df):
+        """
+        Feed the historical candles of a symbol through its state, so that the first live candle gets the same
+        features as in batch mode.
+
+        Args:
+            symbol (str): The currency pair.
+            df (pandas.DataFrame): Historical closed candles, in time order, with the columns in KLINE_COLUMNS.
+        """
+
+        logger.info(f'Warm-starting the live state of {symbol} with {len(df)} candles')
+
+        for candle in df[KLINE_COLUMNS].to_dict('records'):
+            self._ingest(symbol, candle)
+
+    async def run(self):
+        """
+        Ingest the streams until `stop` is called, reconnecting whenever the connection is lost.
+        """
+
+        logger.info(f'Ingesting the {self.interval} kline streams of {len(self.symbols)} symbols')
+
+        while not self._stopped:
+            try:
+                async with connect(self.stream_url) as websocket:
+                    self._websocket = websocket
+                    async for message in websocket:
+                        await self._handle_message(json.loads(message))
+            except (OSError, WebSocketException) as exception:
+                # including the handshakes rejected with 429, 418 or 503 under load
+                if self._stopped:
+                    break
+                logger.warning(f'Lost the kline stream connection ({exception}), reconnecting')
+            finally:
+                self._websocket = None
+
+            if not self._stopped:
+                await asyncio.sleep(self.reconnect_seconds)
+
+    async def stop(self):
+        """
+        Stop ingesting and close the connection.
+        """
+
+        self._stopped = True
+        if self._websocket is not None:
+            await self._websocket.close()
+
+    async def _handle_message(self, message):
+        kline = message['data']['k']
+        if not kline['x']:
+            return
+
+        symbol = kline['s']
+        if symbol not in self.states:
+            return
+
+        candle = kline_event_to_candle(kline)
+        last_open_time = self.states[symbol].last_open_time
+        if last_open_time is not None:
+            next_open_time = self._next_open_time(last_open_time)
+            if candle['open_time'] > next_open_time and \
+                    not await self._backfill(symbol, next_open_time, int(candle['open_time']) - 1):
+                # the candle is skipped too, so that the next closed candle retries the whole gap
+                return
+
+        if not self._ingest(symbol, candle):
+            return
+
+        if self.on_candle is not None:
+            result = self.on_candle(symbol, self.latest_window(symbol))
+            if inspect.isawaitable(result):
+                await result
+
+    async def _backfill(self, symbol, start_timestamp_millis, end_timestamp_millis):
+        logger.warning(f'Missed the {symbol} candles from {start_timestamp_millis} to {end_timestamp_millis}, '
+                       f'downloading them')
+
+        # the download blocks, so it runs in a thread; the stream buffers the messages received meanwhile
+        try:
+            df = await asyncio.to_thread(download_raw_dataset, symbol, self.interval, start_timestamp_millis,
+                                         end_timestamp_millis, store=self.store, client=self.client,
+                                         high_precision=True)
+        except (BinanceAPIException, BinanceRequestException, RequestException) as exception:
+            logger.warning(f'Failed to download the missed {symbol} candles ({exception}), retrying with the next '
+                           f'candle')
+            return False
+
+        # the candles the exchange does not have either are skipped, as in the downloaded datasets
+        for candle in df[KLINE_COLUMNS].to_dict('records'):
+            self._ingest(symbol, candle)
+
+        return True
+
+    def _next_open_time(self, open_time):
+        if self.interval == '1M':
+            # every month has at most 31 days
+            return int(interval_open_times([int(open_time) + 31 * 24 * 60 * 60 * 1000], '1M')[0])
+        return int(open_time) + interval_to_milliseconds(self.interval)
+
+    def _ingest(self, symbol, candle):
+        state = self.states[symbol]
+
+        # ignore the candles already ingested, e.g. sent again after a reconnection
+        if state.last_open_time is not None and candle['open_time'] <= state.last_open_time:
+            return False
+        state.last_open_time = candle['open_time']
+
+        state.features.update(state.feature_engine.update(candle))
+        state.labels.update(math.nan)
+        state.closes.update(candle['close'])
+
+        # label the candle whose forecast window ends with this one, with the window of the last forecast_horizon
+        # closes, as in `feature_creation.add_class_up`
+        closes = state.closes.window
+        labeled_index = state.labels.count - 1 - self.forecast_horizon - self.forecast_gap
+        if labeled_index >= 0:
+            up = np.max(closes[-self.forecast_horizon:]) > closes[0] / self.fee_factor
+            if labeled_index >= state.labels.count - state.labels.size:
+                state.labels.set(labeled_index, float(up))
+
+        return True
@@ -0,0 +1,116 @@
+import numpy as np
+import pandas as pd
+from binance.helpers import interval_to_milliseconds
+
+from dataset_utils.dataset_generation import KLINE_COLUMNS
+from logger import logger
+from metrics import stage
+
+# columns summed over the candles of each resampled candle; the open is the first one, the high the maximum, the low
+# the minimum and the close the last one
+SUMMED_KLINE_COLUMNS = ['volume', 'quote_asset_volume', 'number_of_trades', 'taker_buy_base_asset_volume',
+                        'taker_buy_quote_asset_volume']
+
+# Binance weekly candles open on Mondays, 4 days after the Unix epoch
+WEEK_OFFSET_MILLIS = 4 * 24 * 60 * 60 * 1000
+
+
+def interval_open_times(open_time, interval, offset_millis=None):
+    """
+    Get the open time of the candle of an interval containing each timestamp, as Binance aligns them: to the Unix
+    epoch, to Mondays for weekly candles and to the first day of the month for monthly candles.
+
+    Args:
+        open_time (numpy.ndarray): Timestamps in Unix timestamp milliseconds.
+        interval (str): Duration of each candlestick, e.g. '4h', '1w' or '1M'.
+        offset_millis (int, optional): Open time of any candle of the interval, overriding the Binance alignment.
+            Ignored for monthly candles. Defaults to None.
+
+    Returns:
+        numpy.ndarray: The open times, in Unix timestamp milliseconds.
+    """
+
+    open_time = np.asarray(open_time, dtype=np.int64)
+
+    if interval == '1M':
+        return open_time.astype('datetime64[ms]').astype('datetime64[M]').astype('datetime64[ms]').astype(np.int64)
+
+    interval_millis = interval_to_milliseconds(interval)
+    if interval_millis is None:
+        raise ValueError(f'Unknown interval: {interval}')
+    if offset_millis is None:
+        offset_millis = WEEK_OFFSET_MILLIS if interval.endswith('w') else 0
+
+    return open_time - (open_time - offset_millis) % interval_millis
+
+
+@stage()
+def resample_klines(klines, interval, previous=None, offset_millis=None):
+    """
+    Aggregate klines of a lower interval, e.g. the 1m klines of a `kline_store.KlineStore`, into klines of a higher
+    interval, with segment reductions over the candles of each resampled candle.
+
+    Candles missing from the input are skipped: a resampled candle aggregates the candles available within its
+    interval and intervals without any candle are left out, as Binance does. The first and last resampled candles only
+    cover the part of their interval within the input, so the last one keeps changing while its interval is not over.
+
+    Args:
+        klines (pandas.DataFrame or dict): Klines sorted by open time, with the columns in KLINE_COLUMNS, such as the
+            memory-mapped columns of `KlineStore.columns`.
+        interval (str): Duration of each resampled candlestick, a multiple of the interval of the klines.
+        previous (pandas.DataFrame, optional): Result of a previous call, if the klines are the ones appended since
+            then. Its last candle is merged with the new klines of the same interval instead of being recomputed
+            from the lower interval. Defaults to None.
+        offset_millis (int, optional): Alignment of the resampled candles, see `interval_open_times`. Defaults to
+            None (the Binance alignment).
+
+    Returns:
+        pandas.DataFrame: The resampled klines of `previous` if given, followed by the resampled klines, with the
+        columns in KLINE_COLUMNS and their data types, promoted where `previous` has wider ones (e.g. trade counts
+        summed beyond uint32).
+    """
+
+    columns = {column: np.asarray(klines[column]) for column in KLINE_COLUMNS}
+
+    logger.info(f'Resampling {len(columns["open_time"])} klines into {interval} klines')
+
+    if previous is not None and len(previous) > 0:
+        # the candles are aggregated associatively, so the last previous candle is merged as one more input candle,
+        # at the open time of its interval; the columns are promoted to the wider data type of both, so that trade
+        # counts already summed beyond uint32 do not wrap around
+        columns = {column: np.concatenate([previous[column].to_numpy()[-1:], values],
+                                          dtype=np.result_type(previous[column].dtype, values.dtype))
+                   for column, values in columns.items()}
+
+    open_time = interval_open_times(columns['open_time'], interval, offset_millis=offset_millis)
+
+    # start of each run of candles of the same interval
+    starts = np.flatnonzero(np.concatenate([[True], open_time[1:] != open_time[:-1]])) if len(open_time) else \
+        np.zeros(0, dtype=np.int64)
+    ends = np.append(starts[1:], len(open_time)) - 1
+
+    resampled = {'open_time': open_time[starts]}
+    if len(starts) > 0:
+        resampled['open'] = columns['open'][starts]
+        resampled['high'] = np.maximum.reduceat(columns['high'], starts)
+        resampled['low'] = np.minimum.reduceat(columns['low'], starts)
+        resampled['close'] = columns['close'][ends]
+
+        for column in SUMMED_KLINE_COLUMNS:
+            values = columns[column]
+            # summed in 64 bits, so that the float32 volumes keep their precision and the trade counts do not overflow
+            sums = np.add.reduceat(values, starts, dtype=np.uint64 if values.dtype.kind == 'u' else
+                                   np.int64 if values.dtype.kind == 'i' else np.float64)
+            if values.dtype.kind in 'ui' and sums.max() > np.iinfo(values.dtype).max:
+                resampled[column] = sums
+            else:
+                resampled[column] = sums.astype(values.dtype)
+    else:
+        resampled.update({column: columns[column][:0] for column in KLINE_COLUMNS[1:]})
+
+    df = pd.DataFrame({column: resampled[column] for column in KLINE_COLUMNS}, copy=False)
+
+    if previous is not None and len(previous) > 0:
+        df = pd.concat([previous.iloc[:-1], df], ignore_index=True)
+
+    return df
@@ -0,0 +1,324 @@
+import functools
+import hashlib
+import inspect
+import json
+import os
+import shutil
+import time
+
+import numpy as np
+import pandas as pd
+
+from config import default_dataset_directory
+from dataset_utils.data_preprocessing import (apply_hampel_filter, apply_robust_scaler, apply_sg_filter,
+                                              apply_standard_scaler)
+from dataset_utils.dataset_generation import transform_into_sliding_windows
+from dataset_utils.feature_creation import add_class_up
+from dataset_utils.feature_pipeline import add_features
+from logger import logger
+from metrics import stage
+
+
+def _in_place(func):
+    # stages of `dataset_utils` modifying their input DataFrame in place, made to return it
+    @functools.wraps(func)
+    def run(df, **params):
+        func(df, **params)
+        return df
+    return run
+
+
+def _dropna(df):
+    return df.dropna()
+
+
+def _add_features(df, feature_specs):
+    # the specs come back from JSON as lists
+    return add_features(df, [tuple(feature_spec) for feature_spec in feature_specs])
+
+
+# stage name to the function computing its output from the output of the previous stage and its parameters, and the
+# version of its output; the source of the function is part of the keys, but the version must be bumped whenever the
+# output changes through the code it calls, e.g. a feature of `add_features` or a helper of a filter
+STAGES = {
+    'add_class_up': (_in_place(add_class_up), 1),
+    'add_features': (_add_features, 1),
+    'dropna': (_dropna, 1),
+    'apply_hampel_filter': (_in_place(apply_hampel_filter), 1),
+    'apply_sg_filter': (_in_place(apply_sg_filter), 1),
+    'apply_standard_scaler': (_in_place(apply_standard_scaler), 1),
+    'apply_robust_scaler': (_in_place(apply_robust_scaler), 1),
+    'transform_into_sliding_windows': (transform_into_sliding_windows, 1),
+}
+
+
+@functools.cache
+def _stage_version(stage_name):
+    # version and source hash of a stage, so that changing its implementation invalidates its cached outputs
+    if stage_name not in STAGES:
+        return None
+    func, version = STAGES[stage_name]
+    source = inspect.getsource(inspect.unwrap(func))
+    return f'{version}:{hashlib.sha256(source.encode()).hexdigest()}'
+
+
+def _json_default(value):
+    # numpy scalars and arrays in the parameters, e.g. from a sweep, hash and store as the equal Python values
+    if isinstance(value, (np.generic, np.ndarray)):
+        return value.tolist()
+    if isinstance(value, range):
+        return list(value)
+    raise TypeError(f'Stage parameters must be JSON-serializable, got a {type(value).__name__}: {value!r}')
+
+
+class StageCache:
+    """
+    On-disk memoization of the outputs of the dataset stages, keyed by content.
+
+    The key of a stage output is a hash of the key of its input and of the name, version, source and parameters of the
+    stage, so the key of every stage of a chain follows from the key of the raw data (e.g. its symbol, interval and time
+    range, see `range_key`) without computing anything, and changing a parameter or a stage only invalidates the stages
+    from there on.
+
+    Every output is a directory holding one `.npy` file per DataFrame column or array, which are memory-mapped when
+    read, plus a `metadata.json` file with the stage, its parameters and the column names and index. The least
+    recently used outputs are evicted once the cache grows beyond `max_bytes`.
+
+    Args:
+        directory (str, optional): Root directory of the cache. Defaults to the 'stage_cache' directory inside the
+            default dataset directory.
+        max_bytes (int, optional): Maximum total size of the cached outputs. Defaults to None (no limit).
+    """
+
+    def __init__(self, directory=None, max_bytes=None):
+        self.directory = directory if directory is not None else os.path.join(default_dataset_directory,
+                                                                              'stage_cache')
+        self.max_bytes = max_bytes
+
+    @staticmethod
+    def key(input_key, stage_name, params):
+        """
+        Compute the key of the output of a stage.
+
+        Args:
+            input_key (str): Key of the input of the stage, or None for raw data.
+            stage_name (str): Name of the stage.
+            params (dict): Parameters of the stage, JSON-serializable or numpy scalars and arrays.
+
+        Returns:
+            str: The key, as a hexadecimal SHA-256 digest.
+        """
+
+        return hashlib.sha256(json.dumps([input_key, stage_name, _stage_version(stage_name), params], sort_keys=True,
+                                         default=_json_default).encode()).hexdigest()
+
+    @classmethod
+    def range_key(cls, symbol, interval, start_timestamp_millis, end_timestamp_millis, high_precision=False):
+        """
+        Compute the key of the raw klines of a time range, which must be closed, i.e. fully in the past.
+
+        Args:
+            symbol (str): The currency pair.
+            interval (str): Duration of each candlestick.
+            start_timestamp_millis (int): Start of the time range in Unix timestamp milliseconds.
+            end_timestamp_millis (int): End of the time range in Unix timestamp milliseconds.
+            high_precision (bool, optional): Whether prices and volumes are float64. Defaults to False.
+
+        Returns:
+            str: The key.
+        """
+
+        return cls.key(None, 'download_raw_dataset', {
+            'symbol': symbol,
+            'interval': interval,
+            'start_timestamp_millis': start_timestamp_millis,
+            'end_timestamp_millis': end_timestamp_millis,
+            'high_precision': high_precision,
+        })
+
+    def contains(self, key):
+        """
+        Check whether an output is cached.
+
+        Args:
+            key (str): Key of the output.
+
+        Returns:
+            bool: Whether the output is cached.
+        """
+
+        return os.path.exists(os.path.join(self._entry_directory(key), 'metadata.json'))
+
+    def load(self, key):
+        """
+        Read a cached output and mark it as recently used.
+
+        Args:
+            key (str): Key of the output.
+
+        Returns:
+            pandas.DataFrame or tuple: The output, as stored. DataFrames are read into memory, so they can be modified;
+            the arrays of tuples are read-only memory-mapped arrays.
+        """
+
+        entry_directory = self._entry_directory(key)
+        metadata_path = os.path.join(entry_directory, 'metadata.json')
+        with open(metadata_path) as metadata_file:
+            metadata = json.load(metadata_file)
+
+        # the modification time of the metadata records the last use
+        os.utime(metadata_path)
+
+        def read(name):
+            return np.load(os.path.join(entry_directory, f'{name}.npy'), mmap_mode='r')
+
+        if metadata['kind'] == 'dataframe':
+            index = pd.RangeIndex(metadata['rows']) if metadata['range_index'] else np.array(read('index'))
+            return pd.DataFrame({column: np.array(read(f'column_{i}')) for i, column in enumerate(metadata['columns'])},
+                                index=index)
+
+        return tuple(read(f'item_{i}') if item == 'array' else item for i, item in enumerate(metadata['items']))
+
+    def store(self, key, stage_name, params, output):
+        """
+        Write the output of a stage to the cache, then evict the least recently used outputs beyond the size limit.
+
+        Args:
+            key (str): Key of the output, see `key`.
+            stage_name (str): Name of the stage.
+            params (dict): Parameters of the stage.
+            output (pandas.DataFrame or tuple): The output, a DataFrame or a tuple of arrays and JSON-serializable
+                values.
+        """
+
+        entry_directory = self._entry_directory(key)
+        temporary_directory = f'{entry_directory}.{os.getpid()}.tmp'
+        os.makedirs(temporary_directory, exist_ok=True)
+
+        metadata = {'stage': stage_name, 'version': _stage_version(stage_name), 'params': params,
+                    'created': time.time()}
+        arrays = {}
+
+        if isinstance(output, pd.DataFrame):
+            range_index = output.index.equals(pd.RangeIndex(len(output)))
+            metadata.update(kind='dataframe', columns=output.columns.tolist(), rows=len(output),
+                            range_index=range_index)
+            arrays = {f'column_{i}': output[column].to_numpy() for i, column in enumerate(output.columns)}
+            if not range_index:
+                arrays['index'] = output.index.to_numpy()
+        elif isinstance(output, tuple):
+            metadata.update(kind='tuple', items=[])
+            for i, item in enumerate(output):
+                if isinstance(item, np.ndarray):
+                    arrays[f'item_{i}'] = item
+                    metadata['items'].append('array')
+                else:
+                    metadata['items'].append(item)
+        else:
+            raise TypeError(f'Cannot cache an output of type {type(output).__name__}')
+
+        for name, array in arrays.items():
+            np.save(os.path.join(temporary_directory, f'{name}.npy'), array)
+        metadata['bytes'] = sum(array.nbytes for array in arrays.values())
+
+        with open(os.path.join(temporary_directory, 'metadata.json'), 'w') as metadata_file:
+            json.dump(metadata, metadata_file, default=_json_default)
+
+        # publish the output at once, so that a partial output is never read
+        if os.path.exists(entry_directory):
+            shutil.rmtree(temporary_directory)
+        else:
+            os.replace(temporary_directory, entry_directory)
+
+        if self.max_bytes is not None:
+            self._evict(keep_key=key)
+
+    @stage()
+    def run(self, input_key, load_input, stages):
+        """
+        Run a chain of stages, loading the output of the last cached stage and computing and caching only the stages
+        after it.
+
+        Args:
+            input_key (str): Key of the input of the first stage, e.g. from `range_key`.
+            load_input (callable): Function returning the input of the first stage, only called when none of the
+                stages is cached, e.g. a call to `dataset_generation.download_raw_dataset`.
+            stages (list): (stage, params) pairs, where stage is a key of STAGES and params is a dict of the keyword
+                arguments of its `dataset_utils` function besides the DataFrame, e.g.
+                ('add_class_up', {'forecast_horizon': 1, 'trading_fee_percentage': 0.1}).
+
+        Returns:
+            pandas.DataFrame or tuple: The output of the last stage.
+        """
+
+        # the stages get the parameters as their outputs are keyed, e.g. numpy scalars as Python numbers
+        stages = [(stage_name, json.loads(json.dumps(params, default=_json_default))) for stage_name, params in stages]
+
+        keys = []
+        for stage_name, params in stages:
+            if stage_name not in STAGES:
+                raise ValueError(f'Unknown stage: {stage_name}')
+            keys.append(self.key(keys[-1] if keys else input_key, stage_name, params))
+
+        # the last stage whose output is cached, if any
+        cached_index = next((i for i in reversed(range(len(stages))) if self.contains(keys[i])), None)
+
+        if cached_index is None:
+            logger.info(f'No cached stage, running all {len(stages)} stages')
+            output = load_input()
+            first_index = 0
+        else:
+            logger.info(f'Loading the cached output of {stages[cached_index][0]}, running the '
+                        f'{len(stages) - cached_index - 1} stages after it')
+            output = self.load(keys[cached_index])
+            first_index = cached_index + 1
+
+        for (stage_name, params), key in zip(stages[first_index:], keys[first_index:]):
+            output = STAGES[stage_name][0](output, **params)
+            self.store(key, stage_name, params, output)
+
+        return output
+
+    def size(self):
+        """
+        Get the total size of the cached outputs.
+
+        Returns:
+            int: Size in bytes of the cached arrays.
+        """
+
+        return sum(entry_bytes for _, _, entry_bytes in self._entries())
+
+    def _entry_directory(self, key):
+        return os.path.join(self.directory, key)
+
+    def _entries(self):
+        # (last use, key, bytes) of every cached output
+        if not os.path.isdir(self.directory):
+            return []
+
+        entries = []
+        for key in os.listdir(self.directory):
+            metadata_path = os.path.join(self._entry_directory(key), 'metadata.json')
+            try:
+                with open(metadata_path) as metadata_file:
+                    entry_bytes = json.load(metadata_file)['bytes']
+                entries.append((os.path.getmtime(metadata_path), key, entry_bytes))
+            except (OSError, ValueError):
+                # temporary directories of outputs being written
+                continue
+
+        return entries
+
+    def _evict(self, keep_key=None):
+        entries = sorted(self._entries())
+        total_bytes = sum(entry_bytes for _, _, entry_bytes in entries)
+
+        for _, key, entry_bytes in entries:
+            if total_bytes <= self.max_bytes:
+                break
+            if key == keep_key:
+                continue
+            logger.info(f'Evicting the cached output {key} ({entry_bytes} bytes)')
+            shutil.rmtree(self._entry_directory(key), ignore_errors=True)
+            total_bytes -= entry_bytes
@@ -0,0 +1,582 @@
+import math
+from collections import deque
+
+import numpy as np
+
+from dataset_utils.data_preprocessing import causal_savgol_coefficients
+from logger import logger
+
+
+class _RollingSum:
+    """
+    Running sum over the last `period` values.
+    """
+
+    def __init__(self, period):
+        self.period = period
+        self.values = deque(maxlen=period)
+        self.total = 0.0
+
+    def update(self, value):
+        if len(self.values) == self.period:
+            self.total -= self.values[0]
+        self.values.append(value)
+        self.total += value
+
+    @property
+    def ready(self):
+        return len(self.values) == self.period
+
+
+class _RollingExtreme:
+    """
+    Maximum (or minimum) over the last `period` values, kept in a monotonic deque for O(1) amortized updates.
+    """
+
+    def __init__(self, period, maximum=True):
+        self.period = period
+        self.sign = 1 if maximum else -1
+        self.candidates = deque()
+        self.count = 0
+
+    def update(self, value):
+        # drop the candidates that can no longer be the extreme, then the one leaving the window
+        while self.candidates and self.sign * self.candidates[-1][1] <= self.sign * value:
+            self.candidates.pop()
+        self.candidates.append((self.count, value))
+        if self.candidates[0][0] <= self.count - self.period:
+            self.candidates.popleft()
+        self.count += 1
+
+    @property
+    def value(self):
+        return self.candidates[0][1]
+
+    @property
+    def ready(self):
+        return self.count >= self.period
+
+
+class _EMA:
+    """
+    Exponential moving average seeded with the simple average of its first `period` values, as in TA-Lib. NaN inputs
+    are ignored, so it can be chained after other indicators during their warm-up.
+    """
+
+    def __init__(self, period, skip=0):
+        self.period = period
+        self.k = 2 / (period + 1)
+        self.skip = skip
+        self.seed = _RollingSum(period)
+        self.value = math.nan
+
+    def update(self, value):
+        if math.isnan(value):
+            return math.nan
+        if self.skip > 0:
+            self.skip -= 1
+        elif math.isnan(self.value):
+            self.seed.update(value)
+            if self.seed.ready:
+                self.value = self.seed.total / self.period
+        else:
+            self.value = self.k * value + (1 - self.k) * self.value
+
+        return self.value
+
+
+class StreamingIndicator:
+    """
+    Base class of the indicators updated in O(1) per candle. Each indicator returns NaN until it is warmed up, and then
+    the same value as its batch counterpart in `feature_creation`.
+
+    Attributes:
+        name (str): Name of the column added by the batch counterpart.
+    """
+
+    name = None
+
+    def update(self, candle):
+        """
+        Update the indicator with a new closed candle.
+
+        Args:
+            candle (dict): Mapping with at least the 'high', 'low', 'close' and 'volume' values of the candle.
+
+        Returns:
+            float: The value of the indicator for the candle.
+        """
+
+        raise NotImplementedError
+
+
+class StreamingSMA(StreamingIndicator):
+    """
+    Simple Moving Average (SMA) of the close price, see `feature_creation.add_sma`.
+    """
+
+    def __init__(self, period):
+        self.name = f'sma_{period}'
+        self.sum = _RollingSum(period)
+
+    def update(self, candle):
+        self.sum.update(candle['close'])
+        return self.sum.total / self.sum.period if self.sum.ready else math.nan
+
+
+class StreamingVAMA(StreamingIndicator):
+    """
+    Volume Adjusted Moving Average (VAMA) of the close price, see `feature_creation.add_vama`.
+    """
+
+    def __init__(self, period):
+        self.name = f'vama_{period}'
+        self.volume_price_sum = _RollingSum(period)
+        self.volume_sum = _RollingSum(period)
+
+    def update(self, candle):
+        self.volume_price_sum.update(candle['close'] * candle['volume'])
+        self.volume_sum.update(candle['volume'])
+        return self.volume_price_sum.total / self.volume_sum.total if self.volume_sum.ready else math.nan
+
+
+class StreamingEMA(StreamingIndicator):
+    """
+    Exponential Moving Average (EMA) of the close price, see `feature_creation.add_ema`.
+    """
+
+    def __init__(self, period):
+        self.name = f'ema_{period}'
+        self.ema = _EMA(period)
+
+    def update(self, candle):
+        return self.ema.update(candle['close'])
+
+
+class StreamingDEMA(StreamingIndicator):
+    """
+    Double Exponential Moving Average (DEMA) of the close price, see `feature_creation.add_dema`.
+    """
+
+    def __init__(self, period):
+        self.name = f'dema_{period}'
+        self.ema_1 = _EMA(period)
+        self.ema_2 = _EMA(period)
+
+    def update(self, candle):
+        ema_1 = self.ema_1.update(candle['close'])
+        return 2 * ema_1 - self.ema_2.update(ema_1)
+
+
+class StreamingTEMA(StreamingIndicator):
+    """
+    Triple Exponential Moving Average (TEMA) of the close price, see `feature_creation.add_tema`.
+    """
+
+    def __init__(self, period):
+        self.name = f'tema_{period}'
+        self.ema_1 = _EMA(period)
+        self.ema_2 = _EMA(period)
+        self.ema_3 = _EMA(period)
+
+    def update(self, candle):
+        ema_1 = self.ema_1.update(candle['close'])
+        ema_2 = self.ema_2.update(ema_1)
+        return 3 * ema_1 - 3 * ema_2 + self.ema_3.update(ema_2)
+
+
+class StreamingMOM(StreamingIndicator):
+    """
+    Momentum of the close price, see `feature_creation.add_mom`.
+    """
+
+    def __init__(self, period=10):
+        self.name = f'mom_{period}'
+        self.closes = deque(maxlen=period + 1)
+
+    def update(self, candle):
+        self.closes.append(candle['close'])
+        return self.closes[-1] - self.closes[0] if len(self.closes) == self.closes.maxlen else math.nan
+
+
+class StreamingROC(StreamingIndicator):
+    """
+    Rate of Change (ROC) of the close price, see `feature_creation.add_roc`.
+    """
+
+    def __init__(self, period=10):
+        self.name = f'roc_{period}'
+        self.closes = deque(maxlen=period + 1)
+
+    def update(self, candle):
+        self.closes.append(candle['close'])
+        if len(self.closes) < self.closes.maxlen:
+            return math.nan
+        return (self.closes[-1] / self.closes[0] - 1) * 100 if self.closes[0] != 0 else 0.0
+
+
+class StreamingMACD(StreamingIndicator):
+    """
+    Moving Average Convergence/Divergence (MACD) line, see `feature_creation.add_macd`. As in TA-Lib, the fast EMA
+    starts when it is aligned with the slow one, and the line is reported once the signal line is warmed up.
+    """
+
+    def __init__(self, fast_period=12, slow_period=26, signal_period=9):
+        self.name = f'macd_{fast_period}_{slow_period}_{signal_period}'
+        self.fast_ema = _EMA(fast_period, skip=max(slow_period - fast_period, 0))
+        self.slow_ema = _EMA(slow_period)
+        self.signal_ema = _EMA(signal_period)
+
+    def update(self, candle):
+        macd = self.fast_ema.update(candle['close']) - self.slow_ema.update(candle['close'])
+        return macd if not math.isnan(self.signal_ema.update(macd)) else math.nan
+
+
+class StreamingPercentB(StreamingIndicator):
+    """
+    %B indicator with simple moving average Bollinger Bands, see `feature_creation.add_percent_b`.
+    """
+
+    def __init__(self, period=5, stddev_upper=2, stddev_lower=2):
+        self.name = f'percent_b_{period}_{stddev_upper}_{stddev_lower}_0'
+        self.stddev_upper = stddev_upper
+        self.stddev_lower = stddev_lower
+        self.sum = _RollingSum(period)
+        self.squares_sum = _RollingSum(period)
+
+    def update(self, candle):
+        close = candle['close']
+        self.sum.update(close)
+        self.squares_sum.update(close * close)
+        if not self.sum.ready:
+            return math.nan
+
+        mean = self.sum.total / self.sum.period
+        variance = self.squares_sum.total / self.sum.period - mean * mean
+        stddev = math.sqrt(variance) if variance > 0 else 0.0
+
+        upper_band, lower_band = mean + self.stddev_upper * stddev, mean - self.stddev_lower * stddev
+        return (close - lower_band) / (upper_band - lower_band) * 100 if upper_band != lower_band else math.nan
+
+
+class StreamingChaikinOscillator(StreamingIndicator):
+    """
+    Chaikin A/D Oscillator, see `feature_creation.chaikin_oscillator`. As in TA-Lib, both EMAs of the A/D line start
+    from its first value.
+    """
+
+    name = 'chaikin_oscillator'
+
+    def __init__(self, fast_period=3, slow_period=10):
+        self.fast_k = 2 / (fast_period + 1)
+        self.slow_k = 2 / (slow_period + 1)
+        self.lookback = slow_period - 1
+        self.ad = 0.0
+        self.fast_ema = None
+        self.slow_ema = None
+        self.count = 0
+
+    def update(self, candle):
+        high, low, close = candle['high'], candle['low'], candle['close']
+        if high > low:
+            self.ad += ((close - low) - (high - close)) / (high - low) * candle['volume']
+
+        if self.fast_ema is None:
+            self.fast_ema = self.slow_ema = self.ad
+        else:
+            self.fast_ema = self.fast_k * self.ad + (1 - self.fast_k) * self.fast_ema
+            self.slow_ema = self.slow_k * self.ad + (1 - self.slow_k) * self.slow_ema
+
+        self.count += 1
+        return self.fast_ema - self.slow_ema if self.count > self.lookback else math.nan
+
+
+class StreamingSO(StreamingIndicator):
+    """
+    Stochastic Oscillator slow %K with simple moving averages, see `feature_creation.add_so`.
+    """
+
+    def __init__(self, fastk_period=5, slow_k_period=3, slow_d_period=3):
+        self.name = f'so_{fastk_period}_{slow_k_period}_0_{slow_d_period}_0'
+        self.highest = _RollingExtreme(fastk_period, maximum=True)
+        self.lowest = _RollingExtreme(fastk_period, maximum=False)
+        self.slow_k = _RollingSum(slow_k_period)
+        self.slow_d = _RollingSum(slow_d_period)
+
+    def update(self, candle):
+        self.highest.update(candle['high'])
+        self.lowest.update(candle['low'])
+        if not self.highest.ready:
+            return math.nan
+
+        highest, lowest = self.highest.value, self.lowest.value
+        fast_k = (candle['close'] - lowest) / (highest - lowest) * 100 if highest != lowest else 0.0
+
+        self.slow_k.update(fast_k)
+        if not self.slow_k.ready:
+            return math.nan
+
+        slow_k = self.slow_k.total / self.slow_k.period
+        self.slow_d.update(slow_k)
+        return slow_k if self.slow_d.ready else math.nan
+
+
+class StreamingTRIX(StreamingIndicator):
+    """
+    TRIX indicator of the close price, see `feature_creation.add_trix`.
+    """
+
+    def __init__(self, period=30):
+        self.name = f'trix_{period}'
+        self.ema_1 = _EMA(period)
+        self.ema_2 = _EMA(period)
+        self.ema_3 = _EMA(period)
+        self.previous = math.nan
+
+    def update(self, candle):
+        ema_3 = self.ema_3.update(self.ema_2.update(self.ema_1.update(candle['close'])))
+        trix = (ema_3 / self.previous - 1) * 100
+        self.previous = ema_3
+        return trix
+
+
+class StreamingRSI(StreamingIndicator):
+    """
+    Relative Strength Index (RSI) of the close price with Wilder's smoothing, see `feature_creation.add_rsi`.
+    """
+
+    def __init__(self, period=14):
+        self.name = f'rsi_{period}'
+        self.period = period
+        self.previous_close = None
+        self.count = 0
+        self.average_gain = 0.0
+        self.average_loss = 0.0
+
+    def update(self, candle):
+        close = candle['close']
+        if self.previous_close is None:
+            self.previous_close = close
+            return math.nan
+
+        change, self.previous_close = close - self.previous_close, close
+        gain, loss = max(change, 0.0), max(-change, 0.0)
+        self.count += 1
+
+        # the first averages are simple, the next ones are smoothed
+        if self.count <= self.period:
+            self.average_gain += gain / self.period
+            self.average_loss += loss / self.period
+            if self.count < self.period:
+                return math.nan
+        else:
+            self.average_gain = (self.average_gain * (self.period - 1) + gain) / self.period
+            self.average_loss = (self.average_loss * (self.period - 1) + loss) / self.period
+
+        total = self.average_gain + self.average_loss
+        return 100 * self.average_gain / total if total != 0 else 0.0
+
+
+class StreamingWilliamsPercentR(StreamingIndicator):
+    """
+    Williams %R indicator, see `feature_creation.add_williams_percent_r`.
+    """
+
+    def __init__(self, period=14):
+        self.name = f'williams_percent_r_{period}'
+        self.highest = _RollingExtreme(period, maximum=True)
+        self.lowest = _RollingExtreme(period, maximum=False)
+
+    def update(self, candle):
+        self.highest.update(candle['high'])
+        self.lowest.update(candle['low'])
+        if not self.highest.ready:
+            return math.nan
+
+        highest, lowest = self.highest.value, self.lowest.value
+        return (highest - candle['close']) / (highest - lowest) * -100 if highest != lowest else 0.0
+
+
+class StreamingLaggedValue(StreamingIndicator):
+    """
+    Lagged value of a candle column, see `feature_creation.add_lagged_values`.
+    """
+
+    def __init__(self, column_name, period):
+        self.name = f'{column_name}_lagged_{period}'
+        self.column_name = column_name
+        self.values = deque(maxlen=period + 1)
+
+    def update(self, candle):
+        self.values.append(candle[self.column_name])
+        return self.values[0] if len(self.values) == self.values.maxlen else math.nan
+
+
+class RingBuffer:
+    """
+    Last `size` values (or rows of `width` values) in time order. Every value is kept twice, in an array of twice the
+    size, so that the window is always a contiguous slice: appending is O(1) and reading the window copies nothing.
+
+    Args:
+        size (int): Number of values kept.
+        width (int, optional): If given, every value is a row of this many values. Defaults to None (scalar values).
+        fill_value (float, optional): Initial value of the array. Defaults to 0.
+
+    Attributes:
+        count (int): Number of values appended so far.
+    """
+
+    def __init__(self, size, width=None, fill_value=0.0):
+        self.size = size
+        self.buffer = np.full((2 * size,) if width is None else (2 * size, width), fill_value, dtype=np.float64)
+        self.count = 0
+
+    def update(self, value):
+        """
+        Append a value, dropping the oldest one if the buffer is full.
+
+        Args:
+            value (float or numpy.ndarray): The value, or row of values.
+        """
+
+        self.set(self.count, value)
+        self.count += 1
+
+    def set(self, index, value):
+        """
+        Replace a value still in the buffer, e.g. a label that became known after the value was appended.
+
+        Args:
+            index (int): Position of the value among every value appended, counted from 0.
+            value (float or numpy.ndarray): The new value, or row of values.
+        """
+
+        position = index % self.size
+        self.buffer[position] = self.buffer[position + self.size] = value
+
+    @property
+    def window(self):
+        """
+        numpy.ndarray: Read-only view of the values in the buffer, oldest first, valid until the next update.
+        """
+
+        if self.count < self.size:
+            window = self.buffer[:self.count]
+        else:
+            position = self.count % self.size
+            window = self.buffer[position:position + self.size]
+
+        window = window.view()
+        window.flags.writeable = False
+        return window
+
+
+class StreamingHampelFilter:
+    """
+    Causal Hampel filter, replacing each value with the median of the window ending at it when it deviates from that
+    median by more than `n_sigmas` median absolute deviations. Values are passed through until the window is full.
+    Returns the same values as `data_preprocessing.apply_hampel_filter` with `causal=True`, in O(window) per value.
+
+    Args:
+        window_size (int, optional): Size of the sliding window. Defaults to 15.
+        n_sigmas (int, optional): Number of standard deviations to use as threshold. Defaults to 3.
+    """
+
+    def __init__(self, window_size=15, n_sigmas=3):
+        self.n_sigmas = n_sigmas
+        self.values = RingBuffer(window_size)
+
+    def update(self, value):
+        self.values.update(value)
+        if self.values.count < self.values.size:
+            return value
+
+        window = self.values.window
+        median = np.median(window)
+        mad = np.median(np.abs(window - median))
+        return median if abs(value - median) > self.n_sigmas * mad else value
+
+
+class StreamingSGFilter:
+    """
+    Causal Savitzky-Golay filter, evaluating at each value the polynomial fitted to the window ending at it with
+    precomputed end-point coefficients, or to every value so far while the window fills up. Returns the same values as
+    `data_preprocessing.apply_sg_filter` with `causal=True`, in O(window) per value.
+
+    Args:
+        window_size (int, optional): The length of the filter window. Defaults to 51.
+        polynomial_degree (int, optional): The order of the polynomial used to fit the samples. Defaults to 5.
+    """
+
+    def __init__(self, window_size=51, polynomial_degree=5):
+        self.coefficients = causal_savgol_coefficients(window_size, polynomial_degree)
+        self.values = RingBuffer(window_size)
+
+    def update(self, value):
+        self.values.update(value)
+        window = self.values.window
+        return float(np.dot(self.coefficients[len(window)], window))
+
+
+class StreamingFeatureEngine:
+    """
+    Stateful feature computation for live candles, emitting one feature vector per closed candle.
+
+    Args:
+        indicators (list): StreamingIndicator instances, in the order of their columns.
+        passthrough_columns (list): Candle columns copied into the feature vector before the indicators.
+        filters (dict, optional): Passthrough column name to the streaming filters applied to it, in order, after the
+            indicators are updated with the raw candle, e.g. from `PreprocessingPipeline.create_streaming_filters`.
+            Defaults to None.
+
+    Attributes:
+        feature_names (list): Names of the values of each feature vector.
+    """
+
+    def __init__(self, indicators, passthrough_columns, filters=None):
+        self.indicators = indicators
+        self.passthrough_columns = passthrough_columns
+        self.filters = filters or {}
+        self.feature_names = list(passthrough_columns) + [indicator.name for indicator in indicators]
+
+    def update(self, candle):
+        """
+        Update every indicator with a new closed candle.
+
+        Args:
+            candle (dict): Mapping with the values of the candle.
+
+        Returns:
+            numpy.ndarray: The feature vector of the candle, with NaNs for the indicators still warming up.
+        """
+
+        features = [indicator.update(candle) for indicator in self.indicators]
+
+        passthrough = []
+        for column in self.passthrough_columns:
+            value = candle[column]
+            for column_filter in self.filters.get(column, ()):
+                value = column_filter.update(value)
+            passthrough.append(value)
+
+        return np.array(passthrough + features)
+
+    def warm_start(self, df):
+        """
+        Feed the historical candles of a DataFrame through the indicators, so that the next live candle gets the same
+        features as in batch mode.
+
+        Args:
+            df (pandas.DataFrame): Historical candles, in time order.
+
+        Returns:
+            numpy.ndarray: The feature vector of the last candle.
+        """
+
+        logger.info(f'Warm-starting the streaming features with {len(df)} candles')
+
+        features = None
+        for candle in df.to_dict('records'):
+            features = self.update(candle)
+
+        return features
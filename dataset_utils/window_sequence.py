@@ -0,0 +1,101 @@
+import math
+
+import numpy as np
+from keras.utils import PyDataset
+
+from logger import logger
+
+
+class WindowSequence(PyDataset):
+    """
+    Keras dataset of sliding windows sliced on demand from a feature array, usually memory-mapped, so that only the
+    rows of the batches being trained on are ever read into memory.
+
+    The windows and labels are the same as the ones of `dataset_generation.transform_into_sliding_windows`: each
+    window holds `window_size` consecutive rows and is labeled with the label of its last row. Batches are prefetched
+    by `workers` threads.
+
+    Args:
+        features (numpy.ndarray): 2-D feature array, with one row per time step, e.g. a `numpy.memmap`.
+        labels (numpy.ndarray): 1-D array with the label of every row of `features`.
+        window_size (int): Size of the sliding windows.
+        batch_size (int, optional): Number of windows per batch. Defaults to 32.
+        stride (int, optional): Stride of the sliding windows. Defaults to 1.
+        start (int, optional): First row the windows are taken from. Defaults to 0.
+        end (int, optional): Row after the last one the windows are taken from. Defaults to the number of rows.
+        shuffle (bool, optional): Whether the windows are shuffled across batches at every epoch. Defaults to False.
+        seed (int, optional): Seed of the shuffling. Defaults to None.
+        columns (list, optional): Indices of the feature columns to keep. Defaults to every column.
+        dtype (numpy.dtype, optional): Data type of the batches. Defaults to numpy.float32.
+        **kwargs: `workers`, `use_multiprocessing` and `max_queue_size` of `keras.utils.PyDataset`.
+    """
+
+    def __init__(self, features, labels, window_size, batch_size=32, stride=1, start=0, end=None, shuffle=False,
+                 seed=None, columns=None, dtype=np.float32, **kwargs):
+        super().__init__(**kwargs)
+
+        self.features = features
+        self.labels = labels
+        self.window_size = window_size
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.columns = columns
+        self.dtype = dtype
+
+        if end is None:
+            end = len(features)
+
+        # last row of every window, so that every window lies within [start, end)
+        self.window_ends = np.arange(start + window_size - 1, end, stride)
+        self._offsets = np.arange(1 - window_size, 1)
+        self._rng = np.random.default_rng(seed)
+
+        logger.info(f'Serving {len(self.window_ends)} windows of rows {start} to {end} in {len(self)} batches')
+
+        if shuffle:
+            self._rng.shuffle(self.window_ends)
+
+    def __len__(self):
+        return math.ceil(len(self.window_ends) / self.batch_size)
+
+    def __getitem__(self, index):
+        # read the rows in order, which is how memory-mapped files are read the fastest
+        window_ends = np.sort(self.window_ends[index * self.batch_size:(index + 1) * self.batch_size])
+
+        # read every row covered by the batch once, then slice the overlapping windows out of them
+        first_row, last_row = window_ends[0] - self.window_size + 1, window_ends[-1] + 1
+        if last_row - first_row <= len(window_ends) * self.window_size:
+            rows = np.asarray(self.features[first_row:last_row])
+            x = rows[window_ends[:, None] + self._offsets - first_row]
+        else:
+            x = self.features[(window_ends[:, None] + self._offsets).ravel()].reshape(len(window_ends),
+                                                                                      self.window_size, -1)
+
+        if self.columns is not None:
+            x = x[:, :, self.columns]
+
+        return x.astype(self.dtype, copy=False), np.asarray(self.labels[window_ends])
+
+    def on_epoch_end(self):
+        if self.shuffle:
+            self._rng.shuffle(self.window_ends)
+
+
+def split_row_ranges(n_rows, training_size, validation_size):
+    """
+    Split the rows of a dataset into training, validation and test ranges, the same way as
+    `dataset_generation.split_train_val_test`, to be used as the `start` and `end` of WindowSequence.
+
+    Args:
+        n_rows (int): Number of rows of the dataset.
+        training_size (float): Percentage of the dataset to be used for training.
+        validation_size (float): Percentage of the dataset to be used for validation.
+
+    Returns:
+        tuple: A 3-tuple containing the (start, end) row ranges of the training, validation and test sets.
+    """
+
+    train_end = int(n_rows * training_size)
+    val_end = train_end + int(n_rows * validation_size)
+
+    return (0, train_end), (train_end, val_end), (val_end, n_rows)
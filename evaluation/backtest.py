@@ -0,0 +1,140 @@
+import numpy as np
+import pandas as pd
+
+from logger import logger
+from metrics import stage
+
+EXIT_RULES = ('first_profit', 'horizon')
+
+
+def trade_returns(close, forecast_horizons, trading_fee_percentage, forecast_gap=0, exit_rule='first_profit'):
+    """
+    Calculate the net return of a trade entered at the close of every candle, with the fee and horizon semantics of
+    `feature_creation.add_class_up`: the fee is paid on both the purchase and the sale, and the trade can only be
+    closed within the forecast window, from `forecast_gap + 1` to `forecast_gap + forecast_horizon` candles later.
+
+    Every horizon is computed in a single scan of the candles after the entry.
+
+    Args:
+        close (numpy.ndarray): Close prices.
+        forecast_horizons (list): Forecast horizons to calculate the returns for.
+        trading_fee_percentage (float): Fee as a percentage of the asset purchased or sold.
+        forecast_gap (int, optional): Number of candles between the entry and the forecast window. Defaults to 0.
+        exit_rule (str, optional): When the trade is closed. Defaults to 'first_profit'.
+
+            - 'first_profit': at the first close of the window above the break-even price including fees, which the
+              trades labeled 1 by `add_class_up` reach, or at the last close of the window otherwise.
+            - 'horizon': at the last close of the window.
+
+    Returns:
+        numpy.ndarray: Array with shape (horizons, candles) of the net returns, as fractions of the amount invested,
+        NaN for the candles whose forecast window is not complete.
+    """
+
+    if exit_rule not in EXIT_RULES:
+        raise ValueError(f'Unknown exit rule: {exit_rule}')
+
+    close = np.asarray(close, dtype=np.float64)
+    n = len(close)
+    fee_factor = (1 - trading_fee_percentage / 100) ** 2
+    break_even = close / fee_factor
+
+    returns = np.full((len(forecast_horizons), n), np.nan)
+    exit_prices = np.full(n, np.nan)
+    open_trades = np.ones(n, dtype=bool)
+    last_offset = forecast_gap + max(forecast_horizons, default=0)
+
+    # scan the candles after every entry by increasing offset, closing the trades that reach the break-even in the
+    # forecast window and recording the returns of every horizon once its window is over
+    for offset in range(1, min(last_offset, n - 1) + 1):
+        entries = n - offset
+        offset_close = close[offset:]
+
+        if exit_rule == 'first_profit' and offset > forecast_gap:
+            hits = open_trades[:entries] & (offset_close > break_even[:entries])
+            exit_prices[:entries][hits] = offset_close[hits]
+            open_trades[:entries] &= ~hits
+
+        for i, forecast_horizon in enumerate(forecast_horizons):
+            if forecast_gap + forecast_horizon == offset:
+                exit_price = np.where(open_trades[:entries], offset_close, exit_prices[:entries])
+                returns[i, :entries] = exit_price / close[:entries] * fee_factor - 1
+
+    return returns
+
+
+@stage()
+def backtest_grid(close, probabilities, thresholds, trading_fee_percentages, forecast_horizons, forecast_gap=0,
+                  exit_rule='first_profit'):
+    """
+    Backtest the predictions of a model over a grid of probability thresholds, trading fees and forecast horizons.
+
+    A trade is entered at the close of every candle whose predicted probability of the class "up" is at or above the
+    threshold and closed as in `trade_returns`. Every trade stakes the same amount, regardless of the other open
+    trades. The trade returns are computed once per fee and horizon, and the candles are sorted once by probability,
+    so every threshold is scored from cumulative sums without looping over the trades.
+
+    Args:
+        close (numpy.ndarray): Close prices, aligned with the predictions.
+        probabilities (numpy.ndarray): Predicted probability of the class "up" at every candle, e.g. the output of a
+            model on the test set. NaN values never trade.
+        thresholds (list): Probability thresholds, each trading the candles with a probability at or above it.
+        trading_fee_percentages (list): Fees as a percentage of the asset purchased or sold.
+        forecast_horizons (list): Forecast horizons, in candles.
+        forecast_gap (int, optional): Number of candles between the entry and the forecast window. Defaults to 0.
+        exit_rule (str, optional): When the trades are closed, see `trade_returns`. Defaults to 'first_profit'.
+
+    Returns:
+        pandas.DataFrame: One row per (trading_fee_percentage, forecast_horizon, threshold) configuration, with its
+        number of trades, win rate, mean and standard deviation of the trade returns and total return (the sum of the
+        trade returns). Use `pivot` to get any 2-D slice of the grid.
+    """
+
+    close = np.asarray(close, dtype=np.float64)
+    probabilities = np.asarray(probabilities, dtype=np.float64).ravel()
+    thresholds = np.asarray(thresholds, dtype=np.float64)
+
+    if len(probabilities) != len(close):
+        raise ValueError(f'Got {len(probabilities)} probabilities for {len(close)} candles')
+
+    logger.info(f'Backtesting {len(thresholds) * len(trading_fee_percentages) * len(forecast_horizons)} '
+                f'configurations on {len(close)} candles')
+
+    # candles by decreasing probability, so that the trades of a threshold are a prefix of them
+    probabilities = np.where(np.isnan(probabilities), -np.inf, probabilities)
+    order = np.argsort(-probabilities, kind='stable')
+    n_signals = np.searchsorted(-probabilities[order], -thresholds, side='right')
+
+    frames = []
+    for trading_fee_percentage in trading_fee_percentages:
+        returns = trade_returns(close, forecast_horizons, trading_fee_percentage, forecast_gap=forecast_gap,
+                                exit_rule=exit_rule)[:, order]
+
+        # trades whose forecast window is not complete are not taken
+        complete = ~np.isnan(returns)
+        returns = np.where(complete, returns, 0)
+
+        sums = {}
+        for name, values in (('trades', complete), ('wins', returns > 0), ('returns', returns),
+                             ('squared_returns', np.square(returns))):
+            sums[name] = np.concatenate([np.zeros((len(forecast_horizons), 1)), np.cumsum(values, axis=1)],
+                                        axis=1)[:, n_signals]
+
+        trades = sums['trades']
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean_return = sums['returns'] / trades
+            variance = np.maximum(sums['squared_returns'] / trades - np.square(mean_return), 0)
+            win_rate = sums['wins'] / trades
+
+        frames.append(pd.DataFrame({
+            'trading_fee_percentage': trading_fee_percentage,
+            'forecast_horizon': np.repeat(forecast_horizons, len(thresholds)),
+            'threshold': np.tile(thresholds, len(forecast_horizons)),
+            'trades': trades.ravel().astype(np.int64),
+            'win_rate': win_rate.ravel(),
+            'mean_return': mean_return.ravel(),
+            'return_std': np.sqrt(variance).ravel(),
+            'total_return': sums['returns'].ravel(),
+        }))
+
+    return pd.concat(frames, ignore_index=True)
@@ -0,0 +1,259 @@
+import cProfile
+import functools
+import json
+import os
+import threading
+import time
+import tracemalloc
+
+from config import metrics_enabled, metrics_export, metrics_path, metrics_profile_stage, metrics_trace_memory
+from logger import logger
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows, where the peak RSS is not recorded
+    resource = None
+
+# whether the stages are measured, checked before anything else on every call so that it costs nothing when off
+_enabled = False
+
+_settings = {
+    'export': metrics_export,
+    'path': metrics_path,
+    'profile_stage': metrics_profile_stage,
+    'trace_memory': metrics_trace_memory,
+}
+
+# stage name to its aggregated measurements
+_totals = {}
+_lock = threading.Lock()
+
+
+def enable(export=None, path=None, profile_stage=None, trace_memory=None):
+    """
+    Start measuring the stages. Arguments that are not given keep the values of the `[metrics]` section of the
+    config file.
+
+    Args:
+        export (str, optional): 'log' to log every measurement as a JSON line, 'prometheus' to only aggregate them
+            for `export_prometheus`, or 'none'.
+        path (str, optional): Directory the Prometheus text file and the profiles are written to.
+        profile_stage (str, optional): Name of a stage to capture a cProfile and a tracemalloc snapshot of.
+        trace_memory (bool, optional): Whether to record the bytes allocated by every stage with tracemalloc, which
+            slows down allocation-heavy code.
+    """
+
+    global _enabled
+
+    for key, value in (('export', export), ('path', path), ('profile_stage', profile_stage),
+                       ('trace_memory', trace_memory)):
+        if value is not None:
+            _settings[key] = value
+
+    if _settings['trace_memory'] and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+    _enabled = True
+
+
+def disable():
+    """
+    Stop measuring the stages. The measurements already aggregated are kept.
+    """
+
+    global _enabled
+    _enabled = False
+
+    if tracemalloc.is_tracing():
+        tracemalloc.stop()
+
+
+def stage(name=None):
+    """
+    Decorator measuring every call of a function as a pipeline stage: its duration, the rows of its first array or
+    DataFrame argument and of its result, the bytes it allocated and the peak RSS of the process after it.
+
+    Args:
+        name (str, optional): Name of the stage. Defaults to the qualified name of the function.
+
+    Returns:
+        function: The decorator.
+    """
+
+    def decorator(func):
+        stage_name = name or func.__qualname__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return func(*args, **kwargs)
+            return _measure(stage_name, func, args, kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def _rows(value):
+    # rows of the first array or DataFrame found in a value, possibly nested in a tuple
+    if isinstance(value, (tuple, list)):
+        value = next((item for item in value if hasattr(item, 'shape')), None)
+    return int(value.shape[0]) if hasattr(value, 'shape') and len(value.shape) > 0 else None
+
+
+def _peak_rss_bytes():
+    if resource is None:
+        return None
+    # kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _measure(stage_name, func, args, kwargs):
+    profiler = cProfile.Profile() if stage_name == _settings['profile_stage'] else None
+    tracing = tracemalloc.is_tracing()
+    if profiler is not None and not tracing:
+        tracemalloc.start()
+
+    if tracemalloc.is_tracing():
+        allocated_before = tracemalloc.get_traced_memory()[0]
+
+    started_at = time.perf_counter()
+    if profiler is not None:
+        profiler.enable()
+    try:
+        result = func(*args, **kwargs)
+    finally:
+        if profiler is not None:
+            profiler.disable()
+        seconds = time.perf_counter() - started_at
+
+    # stages returning nothing modify their input in place
+    rows_in = _rows(next((arg for arg in args if hasattr(arg, 'shape')), None))
+    record = {
+        'stage': stage_name,
+        'seconds': seconds,
+        'rows_in': rows_in,
+        'rows_out': rows_in if result is None else _rows(result),
+        'allocated_bytes': None,
+        'peak_rss_bytes': _peak_rss_bytes(),
+    }
+
+    if tracemalloc.is_tracing():
+        record['allocated_bytes'] = max(tracemalloc.get_traced_memory()[0] - allocated_before, 0)
+
+    if profiler is not None:
+        _write_profile(stage_name, profiler)
+        if not tracing:
+            tracemalloc.stop()
+
+    _record(record)
+
+    return result
+
+
+def _write_profile(stage_name, profiler):
+    os.makedirs(_settings['path'], exist_ok=True)
+    profile_path = os.path.join(_settings['path'], f'{stage_name}.prof')
+    profiler.dump_stats(profile_path)
+
+    snapshot_path = os.path.join(_settings['path'], f'{stage_name}.tracemalloc')
+    tracemalloc.take_snapshot().dump(snapshot_path)
+
+    logger.info(f'Wrote the profile of {stage_name} to {profile_path} and its allocations to {snapshot_path}')
+
+
+def _record(record):
+    with _lock:
+        totals = _totals.setdefault(record['stage'], {'calls': 0, 'seconds': 0, 'rows_in': 0, 'rows_out': 0,
+                                                      'allocated_bytes': 0})
+        totals['calls'] += 1
+        for key in ('seconds', 'rows_in', 'rows_out', 'allocated_bytes'):
+            totals[key] += record[key] or 0
+
+    if _settings['export'] == 'log':
+        logger.info(json.dumps(record))
+
+
+def get_totals():
+    """
+    Get the measurements aggregated for every stage since the start or the last `reset`.
+
+    Returns:
+        dict: Stage name to a dict with its number of calls and its total seconds, rows in, rows out and allocated
+        bytes.
+    """
+
+    with _lock:
+        return {stage_name: dict(totals) for stage_name, totals in _totals.items()}
+
+
+def reset():
+    """
+    Discard the aggregated measurements.
+    """
+
+    with _lock:
+        _totals.clear()
+
+
+def flush():
+    """
+    Write the aggregated measurements to the Prometheus text file if the stages are measured and exported that way.
+    Meant to be called at the end of the scripts.
+    """
+
+    if _enabled and _settings['export'] == 'prometheus':
+        logger.info(f'Wrote the stage metrics to {export_prometheus()}')
+
+
+def export_prometheus(path=None):
+    """
+    Write the aggregated measurements in the Prometheus text exposition format, e.g. for the textfile collector of
+    the node exporter.
+
+    Args:
+        path (str, optional): Path of the text file. Defaults to `metrics.prom` in the metrics directory.
+
+    Returns:
+        str: Path of the text file.
+    """
+
+    if path is None:
+        path = os.path.join(_settings['path'], 'metrics.prom')
+
+    metrics = [
+        ('calls', 'counter', 'Number of calls of the stage'),
+        ('seconds', 'counter', 'Total duration of the stage in seconds'),
+        ('rows_in', 'counter', 'Total rows received by the stage'),
+        ('rows_out', 'counter', 'Total rows returned by the stage'),
+        ('allocated_bytes', 'counter', 'Total bytes allocated by the stage and not released'),
+    ]
+
+    totals = get_totals()
+    lines = []
+    for key, metric_type, description in metrics:
+        metric_name = f'cryptosurf_stage_{key}_total'
+        lines.append(f'# HELP {metric_name} {description}')
+        lines.append(f'# TYPE {metric_name} {metric_type}')
+        for stage_name, stage_totals in sorted(totals.items()):
+            lines.append(f'{metric_name}{{stage="{stage_name}"}} {stage_totals[key]}')
+
+    peak_rss_bytes = _peak_rss_bytes()
+    if peak_rss_bytes is not None:
+        lines.append('# HELP cryptosurf_peak_rss_bytes Peak resident set size of the process in bytes')
+        lines.append('# TYPE cryptosurf_peak_rss_bytes gauge')
+        lines.append(f'cryptosurf_peak_rss_bytes {peak_rss_bytes}')
+
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+
+    # write atomically, so that a collector never reads a partial file
+    with open(f'{path}.tmp', 'w') as metrics_file:
+        metrics_file.write('\n'.join(lines) + '\n')
+    os.replace(f'{path}.tmp', path)
+
+    return path
+
+
+if metrics_enabled:
+    enable()
@@ -0,0 +1,365 @@
+import argparse
+import asyncio
+import json
+import random
+import time
+
+import keras
+import numpy as np
+import pandas as pd
+from binance.helpers import interval_to_milliseconds
+
+from dataset_utils.data_preprocessing import PreprocessingPipeline
+from dataset_utils.dataset_generation import KLINE_COLUMNS
+from dataset_utils.fake_binance import generate_synthetic_klines
+from dataset_utils.live_ingestion import LiveKlineIngestion
+from logger import logger
+from metrics import flush as flush_metrics, stage
+from paper_inspired_models.tripathi_and_sharma import create_streaming_feature_engine
+
+# latencies and batch sizes kept for the stats, the most recent ones
+MAX_RECORDED_REQUESTS = 100000
+
+
+class PredictionServer:
+    """
+    Asyncio inference service micro-batching the prediction requests of many symbols into single `predict` calls.
+
+    Every request takes the latest feature window of its symbol from the live state of a `LiveKlineIngestion`,
+    already computed candle by candle, and scales it with the fitted state of the preprocessing pipeline. Requests
+    arriving within `max_delay_seconds` of the first one of a batch, up to `max_batch_size`, are predicted together
+    in a worker thread, so that the event loop keeps ingesting candles and accepting requests meanwhile.
+
+    Args:
+        model (keras.Model): The trained model, taking windows with shape (window_size, features).
+        pipeline (dataset_utils.data_preprocessing.PreprocessingPipeline): The preprocessing pipeline fitted on the
+            training data of the model.
+        ingestion (dataset_utils.live_ingestion.LiveKlineIngestion): The live state of the symbols, whose window size
+            is the one of the model.
+        max_batch_size (int, optional): Maximum number of windows per `predict` call. Defaults to 64.
+        max_delay_seconds (float, optional): Maximum wait for more requests after the first one of a batch. Defaults
+            to 0.002.
+    """
+
+    def __init__(self, model, pipeline, ingestion, max_batch_size=64, max_delay_seconds=0.002):
+        self.model = model
+        self.pipeline = pipeline
+        self.ingestion = ingestion
+        self.max_batch_size = max_batch_size
+        self.max_delay_seconds = max_delay_seconds
+        self.center = pipeline.center.astype(np.float32)
+        self.scale = pipeline.scale.astype(np.float32)
+        self.latencies = []
+        self.batch_sizes = []
+        self._column_indices = {}
+        self._queue = None
+        self._batcher = None
+        self._batch = []
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.stop()
+
+    async def start(self):
+        """
+        Start batching the requests.
+        """
+
+        logger.info(f'Serving predictions in batches of up to {self.max_batch_size} windows')
+
+        self._queue = asyncio.Queue()
+        self._batcher = asyncio.create_task(self._batch_requests())
+
+    async def stop(self):
+        """
+        Stop batching the requests, failing the pending ones, including the batch being predicted.
+        """
+
+        self._batcher.cancel()
+        try:
+            await self._batcher
+        except asyncio.CancelledError:
+            pass
+
+        pending = self._batch
+        self._batch = []
+        while not self._queue.empty():
+            pending.append(self._queue.get_nowait())
+
+        for _, future in pending:
+            if not future.done():
+                future.set_exception(RuntimeError('The prediction server was stopped'))
+
+    async def predict(self, symbol):
+        """
+        Predict from the latest feature window of a symbol.
+
+        Args:
+            symbol (str): The currency pair.
+
+        Returns:
+            numpy.ndarray: The output of the model for the window, e.g. the probability of the class "up".
+        """
+
+        started_at = time.perf_counter()
+
+        # the window is scaled right away, since the view of the ring buffer changes with the next candle
+        window = self.scaled_window(symbol)
+
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((window, future))
+        prediction = await future
+
+        self.latencies.append(time.perf_counter() - started_at)
+        _keep_latest(self.latencies)
+
+        return prediction
+
+    def scaled_window(self, symbol):
+        """
+        Get the latest feature window of a symbol, with the columns and scaling of the preprocessing pipeline.
+
+        Args:
+            symbol (str): The currency pair.
+
+        Returns:
+            numpy.ndarray: The window, with shape (window_size, features).
+        """
+
+        window = self.ingestion.latest_window(symbol)
+        if len(window) < self.ingestion.window_size:
+            raise ValueError(f'Only {len(window)} of the {self.ingestion.window_size} candles of the window of '
+                             f'{symbol} were ingested')
+
+        scaled = window[:, self._columns(symbol)].astype(np.float32)
+        scaled -= self.center
+        scaled /= self.scale
+
+        if np.isnan(scaled).any():
+            raise ValueError(f'The features of {symbol} are still warming up')
+
+        return scaled
+
+    @stage()
+    def predict_batch(self, windows):
+        """
+        Predict from a batch of scaled windows in a single `predict` call.
+
+        Args:
+            windows (numpy.ndarray): Windows with shape (batch, window_size, features).
+
+        Returns:
+            numpy.ndarray: The outputs of the model, one row per window.
+        """
+
+        return np.asarray(self.model.predict(windows, batch_size=len(windows), verbose=0))
+
+    def latency_stats(self):
+        """
+        Get the latency percentiles of the latest requests, from the call of `predict` to its result, and the batch
+        sizes.
+
+        Returns:
+            dict: Number of requests and batches, mean batch size and 50th and 99th latency percentiles in
+            milliseconds.
+        """
+
+        latencies = np.array(self.latencies) * 1000
+        return {
+            'requests': len(latencies),
+            'batches': len(self.batch_sizes),
+            'mean_batch_size': float(np.mean(self.batch_sizes)) if self.batch_sizes else 0.0,
+            'p50_milliseconds': float(np.percentile(latencies, 50)) if len(latencies) else None,
+            'p99_milliseconds': float(np.percentile(latencies, 99)) if len(latencies) else None,
+        }
+
+    def _columns(self, symbol):
+        # indices of the pipeline columns among the features of the symbol
+        if symbol not in self._column_indices:
+            feature_names = self.ingestion.feature_names(symbol)
+            missing = [column for column in self.pipeline.columns if column not in feature_names]
+            if missing:
+                raise ValueError(f'The live features of {symbol} are missing the columns {missing}')
+            self._column_indices[symbol] = [feature_names.index(column) for column in self.pipeline.columns]
+        return self._column_indices[symbol]
+
+    async def _batch_requests(self):
+        loop = asyncio.get_running_loop()
+
+        while True:
+            # kept on the server until its predictions are set, so that `stop` can fail it when cancelled meanwhile
+            self._batch = batch = [await self._queue.get()]
+            deadline = loop.time() + self.max_delay_seconds
+
+            while len(batch) < self.max_batch_size:
+                if not self._queue.empty():
+                    batch.append(self._queue.get_nowait())
+                    continue
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            self.batch_sizes.append(len(batch))
+            _keep_latest(self.batch_sizes)
+            try:
+                predictions = await asyncio.to_thread(self.predict_batch, np.stack([window for window, _ in batch]))
+            except Exception as exception:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(exception)
+                self._batch = []
+                continue
+
+            for (_, future), prediction in zip(batch, predictions):
+                if not future.done():
+                    future.set_result(prediction)
+            self._batch = []
+
+
+def _keep_latest(values):
+    if len(values) > MAX_RECORDED_REQUESTS:
+        del values[:len(values) - MAX_RECORDED_REQUESTS]
+
+
+def load_prediction_server(model_path, pipeline_path, symbols, interval, window_size=None, allow_non_causal=False,
+                           **kwargs):
+    """
+    Load a trained model and its fitted preprocessing pipeline, and create the prediction server of some symbols
+    with their live state, still to be warm-started and fed with live candles.
+
+    Args:
+        model_path (str): Path of the saved Keras model.
+        pipeline_path (str): Path of the pipeline saved with `PreprocessingPipeline.save`.
+        symbols (list): The currency pairs.
+        interval (str): Duration of each candlestick.
+        window_size (int, optional): Number of candles of each window. Defaults to the input shape of the model.
+        allow_non_causal (bool, optional): Whether to serve a pipeline whose filters are not causal, with the live
+            candles unfiltered, unlike the training data. Defaults to False.
+        **kwargs: Keyword arguments of the PredictionServer.
+
+    Returns:
+        PredictionServer: The prediction server, whose `ingestion` must be run or warm-started.
+    """
+
+    logger.info(f'Loading the model from {model_path} and the preprocessing pipeline from {pipeline_path}')
+
+    model = keras.models.load_model(model_path)
+    pipeline = PreprocessingPipeline.load(pipeline_path)
+    if window_size is None:
+        window_size = model.input_shape[1]
+
+    if pipeline.causal:
+        filters_factory = pipeline.create_streaming_filters
+    elif allow_non_causal:
+        logger.warning('The preprocessing pipeline is not causal, so the live candles are served unfiltered')
+        filters_factory = dict
+    else:
+        raise ValueError('The preprocessing pipeline is not causal, so its filters cannot be applied to live candles; '
+                         'refit it with causal filters or pass allow_non_causal=True to serve unfiltered candles')
+
+    def create_feature_engine():
+        feature_engine = create_streaming_feature_engine()
+        feature_engine.filters = filters_factory()
+        return feature_engine
+
+    ingestion = LiveKlineIngestion(symbols, interval, create_feature_engine, window_size)
+
+    return PredictionServer(model, pipeline, ingestion, **kwargs)
+
+
+def warm_start_synthetic(ingestion, n_candles, seed=0):
+    """
+    Warm-start the live state of every symbol with synthetic candles, to serve predictions without any network.
+
+    Args:
+        ingestion (dataset_utils.live_ingestion.LiveKlineIngestion): The live state of the symbols.
+        n_candles (int): Number of candles per symbol, at least the window size plus the warmup of the features.
+        seed (int, optional): Seed of the synthetic candles of the first symbol, incremented for the next ones.
+            Defaults to 0.
+    """
+
+    interval_millis = interval_to_milliseconds(ingestion.interval)
+    end_timestamp_millis = int(time.time() * 1000) // interval_millis * interval_millis
+    start_timestamp_millis = end_timestamp_millis - (n_candles - 1) * interval_millis
+
+    for i, symbol in enumerate(ingestion.symbols):
+        klines = generate_synthetic_klines(start_timestamp_millis, end_timestamp_millis, ingestion.interval,
+                                           seed=seed + i)
+        ingestion.warm_start(symbol, pd.DataFrame({column: klines[column] for column in KLINE_COLUMNS}))
+
+
+async def run_load_test(server, n_requests, concurrency, seed=0):
+    """
+    Send prediction requests for random symbols from concurrent clients, each waiting for its previous prediction
+    before sending the next request.
+
+    Args:
+        server (PredictionServer): The started prediction server.
+        n_requests (int): Total number of requests.
+        concurrency (int): Number of concurrent clients.
+        seed (int, optional): Seed of the symbols requested. Defaults to 0.
+
+    Returns:
+        dict: The latency stats of the server, see `PredictionServer.latency_stats`, with the throughput in requests
+        per second.
+    """
+
+    logger.info(f'Sending {n_requests} prediction requests from {concurrency} concurrent clients')
+
+    rng = random.Random(seed)
+    symbols = [rng.choice(server.ingestion.symbols) for _ in range(n_requests)]
+    next_request = iter(range(n_requests))
+
+    async def client():
+        for request in next_request:
+            await server.predict(symbols[request])
+
+    started_at = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    seconds = time.perf_counter() - started_at
+
+    return {**server.latency_stats(), 'requests_per_second': n_requests / seconds}
+
+
+async def _load_test(args):
+    server = load_prediction_server(args.model, args.pipeline, args.symbols, args.interval,
+                                    allow_non_causal=args.allow_non_causal, max_batch_size=args.max_batch_size,
+                                    max_delay_seconds=args.max_delay_milliseconds / 1000)
+    warm_start_synthetic(server.ingestion, server.ingestion.window_size + args.warmup_candles)
+
+    async with server:
+        return await run_load_test(server, args.requests, args.concurrency)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load-test the prediction server offline on synthetic candles.')
+    parser.add_argument('--model', required=True, help='path of the saved Keras model')
+    parser.add_argument('--pipeline', required=True, help='path of the saved preprocessing pipeline')
+    parser.add_argument('--symbols', nargs='+', default=[f'SYMBOL{i}USDT' for i in range(32)],
+                        help='currency pairs to serve')
+    parser.add_argument('--interval', default='1d', help='duration of each candlestick')
+    parser.add_argument('--warmup-candles', type=int, default=100,
+                        help='candles before the first window, for the features to warm up')
+    parser.add_argument('--requests', type=int, default=10000, help='total number of requests')
+    parser.add_argument('--concurrency', type=int, default=256, help='number of concurrent clients')
+    parser.add_argument('--max-batch-size', type=int, default=64, help='maximum windows per predict call')
+    parser.add_argument('--max-delay-milliseconds', type=float, default=2,
+                        help='maximum wait for more requests after the first one of a batch')
+    parser.add_argument('--allow-non-causal', action='store_true',
+                        help='serve a pipeline with non-causal filters, with the live candles unfiltered')
+    args = parser.parse_args()
+
+    logger.info(json.dumps(asyncio.run(_load_test(args))))
+
+    flush_metrics()
+
+
+if __name__ == '__main__':
+    main()
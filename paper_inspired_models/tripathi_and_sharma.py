@@ -1,56 +1,116 @@
-from dataset_utils.data_preprocessing import apply_hampel_filter, apply_sg_filter, apply_standard_scaler, \
-    apply_robust_scaler
-from dataset_utils.dataset_generation import download_raw_dataset, split_train_val_test, split_x_y
+from dataset_utils.data_preprocessing import PreprocessingPipeline
+from dataset_utils.dataset_generation import KLINE_COLUMNS, download_raw_dataset, split_train_val_test
 from dataset_utils.feature_creation import *
+from dataset_utils.feature_pipeline import add_features
+from dataset_utils.streaming_features import *
+from metrics import flush as flush_metrics, stage
 
 
 def main():
     df_original = download_raw_dataset('BTCUSDT', '1d', 1364774400000, 1720009820000)
 
-    for forecast_horizon in [1, 3, 5, 7]:
-        df = df_original.copy()
-        add_class_up(df, forecast_horizon, 0, forecast_gap=0)
-        add_new_features(df)
+    # label every horizon in a single scan and compute the features only once
+    forecast_horizons = [1, 3, 5, 7]
+    up_columns = [f'up_{forecast_horizon}' for forecast_horizon in forecast_horizons]
+    add_classes_up(df_original, [(forecast_horizon, 0) for forecast_horizon in forecast_horizons], 0,
+                   column_names=up_columns)
+    df_original = add_new_features(df_original)
+
+    for up_column in up_columns:
+        df = df_original.drop(columns=[column for column in up_columns if column != up_column])
+        df = df.rename(columns={up_column: 'up'})
         df.dropna(inplace=True)
-        apply_hampel_filter(df, 'close', window_size=15, n_sigmas=3)
-        apply_sg_filter(df, 'close', window_size=51, polynomial_degree=5, mode='nearest')
         df_train, df_val, df_test = split_train_val_test(df, 0.7, 0.15)
 
-        # Apply scaling to each split separately
-        for split_df in [df_train, df_val, df_test]:
-            apply_standard_scaler(split_df, exclude_columns=['up'])
-            apply_robust_scaler(split_df, exclude_columns=['up'])
+        # Filter every split separately, rather than the whole dataset before splitting it, so that the centered
+        # filter windows near the split boundaries never carry validation or test values into the training split,
+        # and scale them with the scalers fitted on the training split
+        pipeline = PreprocessingPipeline(exclude_columns=['up'], hampel_columns=['close'], hampel_window_size=15,
+                                         hampel_n_sigmas=3, sg_columns=['close'], sg_window_size=51,
+                                         sg_polynomial_degree=5, sg_mode='nearest')
+        x_train, y_train = pipeline.fit_transform(df_train), df_train['up'].to_numpy()
+        x_val, y_val = pipeline.transform(df_val), df_val['up'].to_numpy()
+        x_test, y_test = pipeline.transform(df_test), df_test['up'].to_numpy()
+
+    flush_metrics()
+
+
+FEATURE_SPECS = [
+    # moving averages
+    ('sma', {'period': 5}),
+    ('sma', {'period': 10}),
+    ('vama', {'period': 9}),
+    ('tema', {'period': 9}),
+    ('ema', {'period': 9}),
+    ('dema', {'period': 9}),
 
-        # Split the DataFrame into X and y
-        x_train, y_train = split_x_y(df_train)
-        x_val, y_val = split_x_y(df_val)
-        x_test, y_test = split_x_y(df_test)
+    # momentum and oscillator indicators
+    ('mom', {'period': 10}),
+    ('macd', {'fast_period': 12, 'slow_period': 26, 'signal_period': 9}),
+    ('percent_b', {'period': 5, 'stddev_upper': 2, 'stddev_lower': 2, 'ma_type': 0}),
+    ('chaikin_oscillator', {}),
+    ('roc', {'period': 10}),
+    ('so', {'fastk_period': 5, 'slow_k_period': 3, 'slow_k_ma_type': 0, 'slow_d_period': 3, 'slow_d_ma_type': 0}),
+    ('trix', {'period': 30}),
+    ('rsi', {'period': 14}),
+    ('williams_percent_r', {'period': 14}),
 
+    # lagged values
+    ('lagged_values', {'column_name': 'close', 'period': 1}),
+    ('lagged_values', {'column_name': 'close', 'period': 2}),
+    ('lagged_values', {'column_name': 'close', 'period': 3}),
+]
 
+
+@stage()
 def add_new_features(df):
-    # Add moving averages
-    add_sma(df, period=5)
-    add_sma(df, period=10)
-    add_vama(df, period=9)
-    add_tema(df, period=9)
-    add_ema(df, period=9)
-    add_dema(df, period=9)
-
-    # Add momentum and oscillator indicators
-    add_mom(df, period=10)
-    add_macd(df, fast_period=12, slow_period=26, signal_period=9)
-    add_percent_b(df, period=5, stddev_upper=2, stddev_lower=2, ma_type=0)
-    chaikin_oscillator(df)
-    add_roc(df, period=10)
-    add_so(df, fastk_period=5, slow_k_period=3, slow_k_ma_type=0, slow_d_period=3, slow_d_ma_type=0)
-    add_trix(df, period=30)
-    add_rsi(df, period=14)
-    add_williams_percent_r(df, period=14)
-
-    # Add lagged values
-    add_lagged_values(df, column_name='close', period=1)
-    add_lagged_values(df, column_name='close', period=2)
-    add_lagged_values(df, column_name='close', period=3)
+    """
+    Add the features of the paper to the dataset, computed in a single pass over FEATURE_SPECS.
+
+    Args:
+        df (pandas.DataFrame): The input DataFrame containing price and volume data.
+
+    Returns:
+        pandas.DataFrame: A new DataFrame with the columns of `df` followed by the features.
+    """
+
+    return add_features(df, FEATURE_SPECS)
+
+
+def create_streaming_feature_engine():
+    """
+    Create the streaming counterpart of `add_new_features`, emitting for every live candle the same columns as the
+    downloaded dataset after `add_new_features`.
+
+    Returns:
+        StreamingFeatureEngine: The feature engine, to be warm-started with the latest historical candles.
+    """
+
+    return StreamingFeatureEngine([
+        # moving averages
+        StreamingSMA(period=5),
+        StreamingSMA(period=10),
+        StreamingVAMA(period=9),
+        StreamingTEMA(period=9),
+        StreamingEMA(period=9),
+        StreamingDEMA(period=9),
+
+        # momentum and oscillator indicators
+        StreamingMOM(period=10),
+        StreamingMACD(fast_period=12, slow_period=26, signal_period=9),
+        StreamingPercentB(period=5, stddev_upper=2, stddev_lower=2),
+        StreamingChaikinOscillator(),
+        StreamingROC(period=10),
+        StreamingSO(fastk_period=5, slow_k_period=3, slow_d_period=3),
+        StreamingTRIX(period=30),
+        StreamingRSI(period=14),
+        StreamingWilliamsPercentR(period=14),
+
+        # lagged values
+        StreamingLaggedValue(column_name='close', period=1),
+        StreamingLaggedValue(column_name='close', period=2),
+        StreamingLaggedValue(column_name='close', period=3),
+    ], passthrough_columns=KLINE_COLUMNS)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,112 @@
+import asyncio
+
+import numpy as np
+from binance.exceptions import BinanceRequestException
+from binance.helpers import interval_to_milliseconds
+from websockets.asyncio.server import serve
+
+from dataset_utils.dataset_generation import klines_to_dataframe
+from dataset_utils.fake_binance import FakeClient, FakeKlineStreamServer
+from dataset_utils.live_ingestion import LiveKlineIngestion
+from paper_inspired_models.tripathi_and_sharma import create_streaming_feature_engine
+
+SYMBOL = 'BTCUSDT'
+INTERVAL = '1h'
+WINDOW_SIZE = 20
+
+
+def _create_ingestion(**kwargs):
+    return LiveKlineIngestion([SYMBOL], INTERVAL, create_streaming_feature_engine, WINDOW_SIZE, **kwargs)
+
+
+async def _ingest_with_disconnect(client, history, live, disconnect_after, missed_klines):
+    ingestion = _create_ingestion(reconnect_seconds=0.01, client=client)
+    ingestion.warm_start(SYMBOL, history)
+    last_open_time = live[-1][0]
+
+    async with FakeKlineStreamServer({SYMBOL: live}, INTERVAL, speedup=3600 * 1000, disconnect_after=disconnect_after,
+                                     missed_klines=missed_klines) as server:
+        ingestion.url = server.url
+        task = asyncio.create_task(ingestion.run())
+        while ingestion.states[SYMBOL].last_open_time != last_open_time:
+            await asyncio.sleep(0.01)
+        await ingestion.stop()
+        await task
+
+    return ingestion
+
+
+def test_missed_klines_are_backfilled_after_a_disconnect():
+    interval_millis = interval_to_milliseconds(INTERVAL)
+    client = FakeClient(now_millis=1720000000000)
+    end_timestamp_millis = 1719990000000 // interval_millis * interval_millis
+    klines = client.get_historical_klines(SYMBOL, INTERVAL, end_timestamp_millis - 199 * interval_millis,
+                                          end_timestamp_millis)
+    history, live = klines_to_dataframe(klines[:150], high_precision=True), klines[150:]
+    client.requests.clear()
+
+    ingestion = asyncio.run(_ingest_with_disconnect(client, history, live, disconnect_after=10, missed_klines=5))
+
+    # only the klines that closed while disconnected were downloaded
+    assert client.requests == [(SYMBOL, INTERVAL, live[10][0], live[15][0] - 1)]
+
+    # same state as without any disconnection
+    expected = _create_ingestion()
+    expected.warm_start(SYMBOL, klines_to_dataframe(klines, high_precision=True))
+    np.testing.assert_allclose(ingestion.latest_window(SYMBOL), expected.latest_window(SYMBOL), rtol=1e-10)
+    np.testing.assert_array_equal(ingestion.latest_labels(SYMBOL), expected.latest_labels(SYMBOL))
+
+
+class _FlakyClient(FakeClient):
+    # fails its first `failures` kline requests, as a Binance outage or an unparsable response would
+    def __init__(self, failures, **kwargs):
+        super().__init__(**kwargs)
+        self.failures = failures
+
+    def get_historical_klines(self, symbol, interval, start_str=None, end_str=None, limit=None):
+        if self.failures > 0:
+            self.failures -= 1
+            self.requests.append((symbol, interval, start_str, end_str))
+            raise BinanceRequestException('bad json')
+        return super().get_historical_klines(symbol, interval, start_str, end_str, limit)
+
+
+def test_failed_backfills_are_retried_with_the_next_kline():
+    interval_millis = interval_to_milliseconds(INTERVAL)
+    client = _FlakyClient(failures=1, now_millis=1720000000000)
+    end_timestamp_millis = 1719990000000 // interval_millis * interval_millis
+    klines = FakeClient(now_millis=1720000000000).get_historical_klines(
+        SYMBOL, INTERVAL, end_timestamp_millis - 199 * interval_millis, end_timestamp_millis)
+    history, live = klines_to_dataframe(klines[:150], high_precision=True), klines[150:]
+
+    ingestion = asyncio.run(_ingest_with_disconnect(client, history, live, disconnect_after=10, missed_klines=5))
+
+    # the gap before the first kline after the reconnection failed, and was downloaded with the kline before the next
+    assert client.requests == [(SYMBOL, INTERVAL, live[10][0], live[15][0] - 1),
+                               (SYMBOL, INTERVAL, live[10][0], live[16][0] - 1)]
+
+    expected = _create_ingestion()
+    expected.warm_start(SYMBOL, klines_to_dataframe(klines, high_precision=True))
+    np.testing.assert_allclose(ingestion.latest_window(SYMBOL), expected.latest_window(SYMBOL), rtol=1e-10)
+    np.testing.assert_array_equal(ingestion.latest_labels(SYMBOL), expected.latest_labels(SYMBOL))
+
+
+def test_handshake_rejections_are_retried():
+    ingestion = _create_ingestion(reconnect_seconds=0.01)
+    attempts = []
+
+    async def reject(connection, request):
+        attempts.append(request.path)
+        if len(attempts) == 1:
+            return connection.respond(429, 'Too many requests\n')
+        await ingestion.stop()
+        return connection.respond(503, 'Service unavailable\n')
+
+    async def run():
+        async with serve(lambda websocket: None, '127.0.0.1', 0, process_request=reject) as server:
+            ingestion.url = f'ws://127.0.0.1:{server.sockets[0].getsockname()[1]}'
+            await asyncio.wait_for(ingestion.run(), 5)
+
+    asyncio.run(run())
+
+    assert len(attempts) == 2